@@ -0,0 +1,77 @@
+"""Measures outbound email throughput against a local SMTP server.
+
+    python -m benchmarks.email [messages]
+
+Starts a sink SMTP server in a thread, then sends the messages with a new
+connection per message, like every send_email used to, and through the
+pooled sender, which reuses its connections.
+"""
+from time import perf_counter
+import socketserver
+import sys
+import threading
+from flask_mail import Message
+from src import create_app, mail
+from src.email import send_email, _sender
+
+class Sink(socketserver.StreamRequestHandler):
+    """Just enough SMTP to accept and count messages. smtpd and asyncore are
+    gone from Python 3.12."""
+    received = 0
+    lock = threading.Lock()
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 sink')
+        for line in self.rfile:
+            command = line[:4].upper()
+            if command in (b'EHLO', b'HELO'):
+                self.reply('250 sink')
+            elif command == b'DATA':
+                self.reply('354 go ahead')
+                for data in self.rfile:
+                    if data == b'.\r\n':
+                        break
+                with Sink.lock:
+                    Sink.received += 1
+                self.reply('250 queued')
+            elif command == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    server = Server(('127.0.0.1', 0), Sink)
+    port = server.server_address[1]
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    app = create_app()
+    app.config.update(MAIL_SERVER='127.0.0.1', MAIL_PORT=port, MAIL_USE_TLS=False, MAIL_USERNAME=None,
+        MAIL_PASSWORD=None, EMAIL_QUEUE_SIZE=count)
+    mail.init_app(app)
+    app.app_context().push()
+
+    started = perf_counter()
+    for i in range(count):
+        mail.send(Message('Benchmark', sender='noreply@demo.com', recipients=['user{}@demo.com'.format(i)], body='hello'))
+    elapsed = perf_counter() - started
+    print('connection per message: {} messages in {:.2f} s ({:.0f} msgs/sec)'.format(count, elapsed, count / elapsed))
+
+    Sink.received = 0
+    started = perf_counter()
+    for i in range(count):
+        send_email('Benchmark', sender='noreply@demo.com', recipients=['user{}@demo.com'.format(i)], text_body='hello')
+    _sender.queue.join()
+    elapsed = perf_counter() - started
+    print('pooled sender:          {} messages in {:.2f} s ({:.0f} msgs/sec), {} received'.format(
+        count, elapsed, count / elapsed, Sink.received))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+"""Measures sustained likes/sec on one hot tweet with and without LIKE_BUFFER.
+
+    python -m benchmarks.likes [seconds] [threads] [users]
+
+Every thread posts to /tweet/like as its own users, switching between like
+and unlike so every request changes something. With the buffer a thread
+flushes every LIKE_FLUSH_INTERVAL seconds like the scheduled job would, and
+the run ends with a last flush and a check that SQL matches what was
+buffered. Uses a SQLite file and the redis server at REDIS_URL, or an
+in-process fake one if it can not be reached.
+"""
+from time import perf_counter, sleep
+import os
+import sys
+import tempfile
+import threading
+import redis
+import rq
+from src import create_app, db, likes
+from src.models import User, Tweet
+
+directory = tempfile.mkdtemp()
+app = create_app()
+app.config.update(SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(directory, 'likes.db'),
+    SECRET_KEY='benchmark', RATE_LIMITS=dict(app.config['RATE_LIMITS'], like=(10 ** 6, 10 ** 6)))
+app.search = None
+
+def setup(users):
+    db.drop_all()
+    db.create_all()
+    accounts = [User(username='user{}'.format(i), showname='user', password='x') for i in range(users)]
+    db.session.add_all(accounts)
+    db.session.flush()
+    tweet = Tweet(identifier='hot', textbody_source='tweet', textbody_markdown='tweet', author=accounts[0])
+    db.session.add(tweet)
+    db.session.commit()
+    return [user.id for user in accounts]
+
+def client(user_id):
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+    return client
+
+def run(buffered, seconds, threads, user_ids):
+    app.config['LIKE_BUFFER'] = buffered
+    deadline = perf_counter() + seconds
+    done = []
+    errors = []
+
+    def liker(ids):
+        clients = [client(user_id) for user_id in ids]
+        liked = [False] * len(ids)
+        count = failed = 0
+        i = 0
+        while perf_counter() < deadline:
+            i = (i + 1) % len(clients)
+            liked[i] = not liked[i]
+            response = clients[i].post('/tweet/like', json={'ident': 'hot', 'liked': liked[i]})
+            if response.status_code == 200 and response.get_json()['statuscode'] == 0:
+                count += 1
+            else:
+                liked[i] = not liked[i]
+                failed += 1
+        done.append(count)
+        errors.append(failed)
+
+    flushes = []
+    def flusher():
+        with app.app_context():
+            while perf_counter() < deadline:
+                sleep(app.config['LIKE_FLUSH_INTERVAL'])
+                started = perf_counter()
+                flushes.append((likes.flush(), perf_counter() - started))
+                db.session.remove()
+
+    workers = [threading.Thread(target=liker, args=(user_ids[i::threads],)) for i in range(threads)]
+    if buffered:
+        workers.append(threading.Thread(target=flusher))
+    started = perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = perf_counter() - started
+    print('{:<9} {:8.1f} likes/sec  {} errors'.format('buffered' if buffered else 'direct', sum(done) / elapsed, sum(errors)))
+    if buffered:
+        with app.app_context():
+            entries = likes.snapshot()
+            started = perf_counter()
+            flushes.append((likes.flush(), perf_counter() - started))
+            diverged, miscounted = likes.check(entries)
+            tweet = Tweet.query.filter_by(identifier='hot').one()
+            print('          {} flushes, {} pairs, slowest {:.0f} ms, {} diverged, {} miscounted, like_count {} of {} rows'.format(
+                len(flushes), sum(n for n, _ in flushes), max(t for _, t in flushes) * 1000,
+                len(diverged), len(miscounted), tweet.like_count, tweet.likes.count()))
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 10
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    users = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+    try:
+        app.redis.ping()
+    except redis.exceptions.RedisError:
+        import fakeredis
+        app.redis = fakeredis.FakeStrictRedis()
+    app.task_queue = rq.Queue('kura-benchmark', connection=app.redis)
+    print('{}s of likes on one tweet from {} threads, {} users'.format(seconds, threads, users))
+    for buffered in (False, True):
+        app.redis.flushdb()
+        with app.app_context():
+            user_ids = setup(users)
+        run(buffered, seconds, threads, user_ids)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+"""Measures the markup pipeline on tweet creation and bulk re-rendering.
+
+    python -m benchmarks.markup [tweets] [workers]
+
+Compares the per-request markdown2 + bleach.clean calls tweets used to be
+rendered with against markup.render(), cold and cached, then re-renders a
+table of stale tweets with `Tweet.rerender()`.
+"""
+from random import Random
+from time import perf_counter
+import os
+import sys
+import tempfile
+import bleach
+import markdown2
+from src import create_app, db, markup
+from src.models import User, Tweet
+
+app = create_app()
+app.search = None
+app.config['IDENTIFIER_NODE'] = 0
+
+WORDS = ['kura', 'tweet', '**bold**', '*italic*', '`code`', 'word', 'http://example.com', '<b>raw</b>']
+
+def sources(count, rng):
+    return ['{}\n\n- {}\n- {}'.format(' '.join(rng.choice(WORDS) for _ in range(30)), i, i + 1)
+        for i in range(count)]
+
+def old_render(source):
+    return bleach.clean(markdown2.markdown(source), tags=['b', 'i', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'abbr',
+        'acronym', 'p', 'code', 'blockquote', 'table', 'tr', 'td', 'br', 'ol', 'li', 'pre', 'div', 'span', 'em',
+        'strong', 'cite', 'col', 'colgroup', 'datalist', 'dd', 'dt', 'dl', 'q', 's', 'small', 'sub', 'sup', 'td',
+        'tbody', 'th', 'thead', 'u'])
+
+def timed(name, fn, texts):
+    started = perf_counter()
+    for text in texts:
+        fn(text)
+    elapsed = perf_counter() - started
+    print('{:<24} {:8.0f} tweets/sec'.format(name, len(texts) / elapsed))
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    texts = sources(count, Random(42))
+    timed('create, old', old_render, texts)
+    markup._cache.clear()
+    timed('create, pipeline cold', markup.render, texts)
+    timed('create, pipeline cached', markup.render, texts)
+
+    with tempfile.TemporaryDirectory() as directory:
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(directory, 'bench.db')
+        with app.app_context():
+            db.create_all()
+            user = User(username='bench', showname='bench', password='x')
+            db.session.add(user)
+            db.session.add_all([Tweet(identifier=Tweet.get_identifier(), textbody_source=text, textbody_markdown='',
+                author=user) for text in texts])
+            db.session.commit()
+            for n in sorted({1, workers}):
+                Tweet.query.update({Tweet.render_version: None})
+                db.session.commit()
+                markup._cache.clear()
+                rendered, rate = Tweet.rerender(workers=n)
+                print('rerender, {} worker(s)    {:8.0f} tweets/sec ({} tweets)'.format(n, rate, rendered))
+
+if __name__ == '__main__':
+    main()
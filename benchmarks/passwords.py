@@ -0,0 +1,66 @@
+"""Measures login throughput at different password pool sizes.
+
+    python -m benchmarks.passwords [logins] [threads]
+
+Checks a BCRYPT_LOG_ROUNDS hash from several request threads at once, inline
+like logins used to and through pools of 1, 2 and 4 processes, and times a
+cheap page render running next to them to show how much logins slow the
+rest of the site.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from time import perf_counter
+import statistics
+import sys
+import threading
+from src import create_app, passwords
+
+app = create_app()
+app.search = None
+
+def page():
+    # Stands in for a request that needs a little CPU and no hashing
+    started = perf_counter()
+    sum(i * i for i in range(20000))
+    return perf_counter() - started
+
+def run(workers, logins, threads, hashed):
+    app.config.update(PASSWORD_WORKERS=workers, PASSWORD_QUEUE_DEPTH=threads)
+    passwords._pool = passwords.Pool()
+
+    def login(_):
+        with app.app_context():
+            try:
+                return passwords.check(hashed, 'secret')
+            except passwords.Saturated:
+                return None
+
+    done = threading.Event()
+    pages = []
+    def render_pages():
+        while not done.is_set():
+            pages.append(page())
+    renderer = threading.Thread(target=render_pages)
+    renderer.start()
+    started = perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        results = list(executor.map(login, range(logins)))
+    elapsed = perf_counter() - started
+    done.set()
+    renderer.join()
+    if passwords._pool.executor:
+        passwords._pool.executor.shutdown()
+    print('{:<8} {:8.1f} logins/sec  {:3} rejected  page p50 {:6.1f} ms  p95 {:6.1f} ms'.format(
+        'inline' if not workers else '{} procs'.format(workers), (logins - results.count(None)) / elapsed, results.count(None),
+        statistics.median(pages) * 1000, sorted(pages)[int(len(pages) * 0.95)] * 1000))
+
+def main():
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 40
+    threads = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    with app.app_context():
+        hashed = passwords._hash('secret', app.config['BCRYPT_LOG_ROUNDS'])
+    print('{} logins from {} threads, {} rounds'.format(logins, threads, app.config['BCRYPT_LOG_ROUNDS']))
+    for workers in (0, 1, 2, 4):
+        run(workers, logins, threads, hashed)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Measures indexing throughput and query latency of the search backends,
+without the result cache.
+
+    python -m benchmarks.search [documents]
+
+Always runs against the embedded SQLite FTS5 backend, in a temporary file,
+and also against elasticsearch when ELASTICSEARCH_URL is set.
+"""
+from random import Random
+from time import perf_counter
+import os
+import sys
+import tempfile
+from elasticsearch import Elasticsearch
+from src import create_app
+from src.search import ElasticsearchBackend, SQLiteBackend, Search
+
+app = create_app()
+app.app_context().push()
+
+WORDS = ['word{}'.format(i) for i in range(20000)]
+QUERIES = ['word1', 'word17 word230', 'word4999', 'word12 word13 word14', 'nomatch']
+
+def documents(count, rng):
+    for id in range(1, count + 1):
+        # Zipf-like word frequencies, like real text
+        yield id, ' '.join(WORDS[int(rng.paretovariate(1)) % len(WORDS)] for _ in range(20))
+
+def run(name, backend, count, index='bench'):
+    rng = Random(42)
+    started = perf_counter()
+    batch = []
+    for id, text in documents(count, rng):
+        batch.append(('index', index, id, {'textbody_source': text}))
+        if len(batch) == 5000:
+            backend.bulk(batch)
+            batch = []
+    backend.bulk(batch)
+    elapsed = perf_counter() - started
+    print('{}: indexed {} documents in {:.1f} s ({:.0f} docs/sec)'.format(name, count, elapsed, count / elapsed))
+    if isinstance(backend, ElasticsearchBackend):
+        backend.client.indices.refresh(index=index)
+    for query in QUERIES:
+        rounds = 20
+        started = perf_counter()
+        for _ in range(rounds):
+            # the first five pages, following search_after cursors
+            after = None
+            for _ in range(5):
+                (hits, total), = backend.multi_query([Search(index, query, 20, after, {}, [])])
+                if not hits:
+                    break
+                after = hits[-1][1]
+        print('  {:<24} {:>8} hits {:8.2f} ms/page'.format(
+            query, total, (perf_counter() - started) / rounds / 5 * 1000))
+    started = perf_counter()
+    for _ in range(rounds):
+        backend.multi_query([Search(index, query, 20, None, {}, []) for query in QUERIES])
+    print('  all queries in one request {:8.2f} ms'.format((perf_counter() - started) / rounds * 1000))
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    with tempfile.TemporaryDirectory() as directory:
+        run('sqlite', SQLiteBackend(os.path.join(directory, 'search.db')), count)
+    if app.config['ELASTICSEARCH_URL']:
+        client = Elasticsearch([app.config['ELASTICSEARCH_URL']])
+        client.indices.delete(index='bench', ignore=[404])
+        try:
+            run('elasticsearch', ElasticsearchBackend(client), count)
+        finally:
+            client.indices.delete(index='bench', ignore=[404])
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+"""Compares the home timeline served from redis against followed_posts().
+
+    python -m benchmarks.timeline [followed] [tweets_per_user]
+
+Uses the redis server at REDIS_URL, or an in-process fake one if it can not
+be reached.
+"""
+from datetime import datetime, timedelta
+from time import perf_counter
+import sys
+import redis
+from src import create_app, db
+from src.models import User, Tweet
+from src.pagination import decode_cursor, paginate
+
+app = create_app()
+app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+app.search = None
+app.app_context().push()
+
+def setup(followed, tweets_per_user):
+    reader = User(username='reader', showname='reader', password='x')
+    db.session.add(reader)
+    now = datetime.utcnow()
+    for i in range(followed):
+        user = User(username='user{}'.format(i), showname='user', password='x')
+        reader.followed.append(user)
+        db.session.add_all([Tweet(identifier='{}-{}'.format(i, j), textbody_source='tweet', textbody_markdown='tweet',
+            author=user, created_utc=now - timedelta(seconds=i * tweets_per_user + j)) for j in range(tweets_per_user)])
+    db.session.commit()
+    return reader
+
+def timed(fn, rounds=50):
+    start = perf_counter()
+    for _ in range(rounds):
+        fn()
+        db.session.expire_all()
+    return (perf_counter() - start) / rounds * 1000
+
+def main():
+    followed = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    tweets_per_user = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    try:
+        app.redis.ping()
+    except redis.exceptions.RedisError:
+        import fakeredis
+        app.redis = fakeredis.FakeStrictRedis()
+    app.redis.flushdb()
+    db.create_all()
+    reader = setup(followed, tweets_per_user)
+    per_page = app.config['TWEETS_PER_PAGE']
+
+    rebuild = timed(reader.rebuild_timeline, rounds=5)
+    print('following {} users, {} tweets'.format(followed, followed * tweets_per_user))
+    print('rebuild timeline:      {:8.2f} ms'.format(rebuild))
+    cursors = {1: None}
+    for page in range(2, 11):
+        cursors[page] = decode_cursor(reader.home_timeline(per_page, cursors[page - 1]).next_cursor)
+    for page in (1, 10):
+        before = cursors[page]
+        sql = timed(lambda: paginate(reader.followed_posts(), Tweet, per_page, before).items)
+        cached = timed(lambda: reader.home_timeline(per_page, before).items)
+        print('page {:<3} followed_posts: {:8.2f} ms  timeline: {:8.2f} ms  ({:.1f}x)'.format(
+            page, sql, cached, sql / cached))
+
+if __name__ == '__main__':
+    main()
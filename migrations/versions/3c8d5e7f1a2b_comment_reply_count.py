@@ -0,0 +1,31 @@
+"""Comment reply count
+
+Revision ID: 3c8d5e7f1a2b
+Revises: 9a4e6b1f0c27
+Create Date: 2026-10-18 19:41:07.215934
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c8d5e7f1a2b'
+down_revision = '9a4e6b1f0c27'
+branch_labels = None
+depends_on = None
+
+comment = sa.table('comment', sa.column('id'), sa.column('parent_id'), sa.column('reply_count'))
+
+
+def upgrade():
+    op.add_column('comment', sa.Column('reply_count', sa.Integer(), server_default='0', nullable=False))
+
+    reply = comment.alias('reply')
+    op.execute(comment.update().values(reply_count=sa.select([sa.func.count()]).select_from(reply).where(
+        reply.c.parent_id == comment.c.id).as_scalar()))
+
+
+def downgrade():
+    with op.batch_alter_table('comment') as batch_op:
+        batch_op.drop_column('reply_count')
@@ -0,0 +1,54 @@
+"""Denormalized counters
+
+Revision ID: 5f1d2c7a9e3b
+Revises: af289bb03ccf
+Create Date: 2026-10-18 10:12:40.513208
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5f1d2c7a9e3b'
+down_revision = 'af289bb03ccf'
+branch_labels = None
+depends_on = None
+
+user = sa.table('user', sa.column('id'), sa.column('tweet_count'),
+    sa.column('follower_count'), sa.column('following_count'))
+tweet = sa.table('tweet', sa.column('id'), sa.column('userid'),
+    sa.column('like_count'), sa.column('comment_count'))
+like = sa.table('like', sa.column('tweetid'))
+comment = sa.table('comment', sa.column('tweet_id'))
+followers = sa.table('followers', sa.column('follower_id'), sa.column('followed_id'))
+
+
+def count(table, key, id):
+    return sa.select([sa.func.count()]).select_from(table).where(key == id).as_scalar()
+
+
+def upgrade():
+    op.add_column('user', sa.Column('tweet_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('user', sa.Column('follower_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('user', sa.Column('following_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('tweet', sa.Column('like_count', sa.Integer(), server_default='0', nullable=False))
+    op.add_column('tweet', sa.Column('comment_count', sa.Integer(), server_default='0', nullable=False))
+
+    op.execute(user.update().values(
+        tweet_count=count(tweet, tweet.c.userid, user.c.id),
+        follower_count=count(followers, followers.c.followed_id, user.c.id),
+        following_count=count(followers, followers.c.follower_id, user.c.id)))
+    op.execute(tweet.update().values(
+        like_count=count(like, like.c.tweetid, tweet.c.id),
+        comment_count=count(comment, comment.c.tweet_id, tweet.c.id)))
+
+
+def downgrade():
+    with op.batch_alter_table('tweet') as batch_op:
+        batch_op.drop_column('comment_count')
+        batch_op.drop_column('like_count')
+    with op.batch_alter_table('user') as batch_op:
+        batch_op.drop_column('following_count')
+        batch_op.drop_column('follower_count')
+        batch_op.drop_column('tweet_count')
@@ -0,0 +1,72 @@
+"""Indexes for hot lookups
+
+Revision ID: 7e2a9c4b6d10
+Revises: 3c8d5e7f1a2b
+Create Date: 2026-10-18 20:26:51.604417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7e2a9c4b6d10'
+down_revision = '3c8d5e7f1a2b'
+branch_labels = None
+depends_on = None
+
+like = sa.table('like', sa.column('id'), sa.column('userid'), sa.column('tweetid'))
+followers = sa.table('followers', sa.column('follower_id'), sa.column('followed_id'))
+
+
+def remove_duplicates():
+    """Unique indexes can not be built over duplicate likes and follows, which
+    racing requests could insert. The counters they inflated are fixed by
+    the reconcile task."""
+    bind = op.get_bind()
+    duplicates = bind.execute(sa.select([like.c.userid, like.c.tweetid, sa.func.min(like.c.id)]).group_by(
+        like.c.userid, like.c.tweetid).having(sa.func.count() > 1)).fetchall()
+    for userid, tweetid, keep in duplicates:
+        bind.execute(like.delete().where(sa.and_(
+            like.c.userid == userid, like.c.tweetid == tweetid, like.c.id != keep)))
+    duplicates = bind.execute(sa.select([followers.c.follower_id, followers.c.followed_id]).group_by(
+        followers.c.follower_id, followers.c.followed_id).having(sa.func.count() > 1)).fetchall()
+    for follower_id, followed_id in duplicates:
+        pair = sa.and_(followers.c.follower_id == follower_id, followers.c.followed_id == followed_id)
+        bind.execute(followers.delete().where(pair))
+        bind.execute(followers.insert().values(follower_id=follower_id, followed_id=followed_id))
+
+
+def upgrade():
+    remove_duplicates()
+    op.create_index(op.f('ix_tweet_identifier'), 'tweet', ['identifier'], unique=True)
+    op.create_index('ix_tweet_userid_created_utc', 'tweet', ['userid', 'created_utc'], unique=False)
+    op.create_index(op.f('ix_comment_identifier'), 'comment', ['identifier'], unique=True)
+    op.create_index('ix_comment_tweet_id_path', 'comment', ['tweet_id', 'path'], unique=False)
+    op.create_index('ix_comment_author_id_created_utc', 'comment', ['author_id', 'created_utc'], unique=False)
+    op.create_index(op.f('ix_comment_parent_id'), 'comment', ['parent_id'], unique=False)
+    op.drop_index(op.f('ix_comment_path'), table_name='comment')
+    op.create_index('ix_like_userid_tweetid', 'like', ['userid', 'tweetid'], unique=True)
+    op.create_index(op.f('ix_like_tweetid'), 'like', ['tweetid'], unique=False)
+    op.create_index('ix_followers_follower_id_followed_id', 'followers', ['follower_id', 'followed_id'], unique=True)
+    op.create_index('ix_followers_followed_id', 'followers', ['followed_id'], unique=False)
+    op.create_index('ix_message_recipient_id_created_utc', 'message', ['recipient_id', 'created_utc'], unique=False)
+    op.create_index('ix_notification_user_id_timestamp', 'notification', ['user_id', 'timestamp'], unique=False)
+    op.create_index(op.f('ix_task_user_id'), 'task', ['user_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_task_user_id'), table_name='task')
+    op.drop_index('ix_notification_user_id_timestamp', table_name='notification')
+    op.drop_index('ix_message_recipient_id_created_utc', table_name='message')
+    op.drop_index('ix_followers_followed_id', table_name='followers')
+    op.drop_index('ix_followers_follower_id_followed_id', table_name='followers')
+    op.drop_index(op.f('ix_like_tweetid'), table_name='like')
+    op.drop_index('ix_like_userid_tweetid', table_name='like')
+    op.create_index(op.f('ix_comment_path'), 'comment', ['path'], unique=False)
+    op.drop_index(op.f('ix_comment_parent_id'), table_name='comment')
+    op.drop_index('ix_comment_author_id_created_utc', table_name='comment')
+    op.drop_index('ix_comment_tweet_id_path', table_name='comment')
+    op.drop_index(op.f('ix_comment_identifier'), table_name='comment')
+    op.drop_index('ix_tweet_userid_created_utc', table_name='tweet')
+    op.drop_index(op.f('ix_tweet_identifier'), table_name='tweet')
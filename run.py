@@ -1,5 +1,6 @@
-from src import create_app, db
-from src.models import User, Tweet, Notification, Message, Task, Comment
+from src import create_app, db, assets, likes
+from src.models import User, Tweet, Notification, Message, Task, Comment, SearchOutbox, SearchableMixin
+import click
 
 app = create_app()
 
@@ -14,5 +15,47 @@ def apply_headers(response):
 def make_shell_context():
     return {'db': db, 'User': User, 'Tweet': Tweet, 'Message': Message, 'Comment': Comment, 'Notification': Notification, 'Task': Task}
 
+@app.cli.command('search-status')
+def search_status():
+    """Show how many changes wait in the search outbox and how old the oldest is."""
+    stats = SearchOutbox.stats()
+    print('outbox depth: {depth}, lag: {lag:.1f}s'.format(**stats))
+
+@app.cli.command('reindex')
+@click.argument('index')
+@click.option('--workers', default=4, help='Number of worker processes.')
+@click.option('--batch-size', default=1000, help='Rows per bulk request.')
+def reindex(index, workers, batch_size):
+    """Rebuild a search index without downtime."""
+    model = next((model for model in SearchableMixin.__subclasses__() if model.__tablename__ == index), None)
+    if model is None:
+        raise click.BadParameter('no searchable model for index {}'.format(index))
+    indexed, rate = model.reindex(workers=workers, batch_size=batch_size)
+    print('indexed {} documents, {:.0f} docs/sec'.format(indexed, rate))
+
+@app.cli.command('rerender')
+@click.option('--workers', default=4, help='Number of worker processes.')
+@click.option('--batch-size', default=500, help='Tweets per batch.')
+def rerender(workers, batch_size):
+    """Render tweets made by an older version of the markup pipeline again."""
+    rendered, rate = Tweet.rerender(workers=workers, batch_size=batch_size)
+    print('rendered {} tweets, {:.0f} tweets/sec'.format(rendered, rate))
+
+@app.cli.command('build-assets')
+def build_assets():
+    """Fingerprint and precompress the static files."""
+    manifest = assets.build(app.static_folder, app.config['STATIC_BUILD_PATH'])
+    print('built {} files into {}'.format(len(manifest), app.config['STATIC_BUILD_PATH']))
+
+@app.cli.command('flush-likes')
+@click.option('--check', is_flag=True, help='Verify SQL matches what was buffered.')
+def flush_likes(check):
+    """Write the likes buffered in redis to the database."""
+    entries = likes.snapshot() if check else None
+    print('flushed {} likes'.format(likes.flush()))
+    if check:
+        diverged, miscounted = likes.check(entries)
+        print('{} of {} buffered likes diverged, {} tweets miscounted'.format(len(diverged), len(entries), len(miscounted)))
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -6,6 +6,8 @@ from flask_migrate import Migrate
 from flask_mail import Mail
 from flask_moment import Moment
 from src.config import Config
+from src.search import ElasticsearchBackend, SQLiteBackend
+from src import assets, images
 from redis import Redis
 from elasticsearch import Elasticsearch
 import rq
@@ -32,8 +34,10 @@ def create_app(config_class=Config):
     app.redis = Redis.from_url(app.config['REDIS_URL'])
     app.task_queue = rq.Queue('kura-tasks', connection=app.redis)
 
-    app.elasticsearch = Elasticsearch([app.config['ELASTICSEARCH_URL']]) \
-                        if app.config['ELASTICSEARCH_URL'] else None
+    if app.config['ELASTICSEARCH_URL']:
+        app.search = ElasticsearchBackend(Elasticsearch([app.config['ELASTICSEARCH_URL']]))
+    else:
+        app.search = SQLiteBackend(app.config['SEARCH_INDEX_PATH'], app.config['SEARCH_MAX_HITS'])
 
     db.init_app(app)
     bcrypt.init_app(app)
@@ -41,6 +45,8 @@ def create_app(config_class=Config):
     mail.init_app(app)
     moment.init_app(app)
     migrate = Migrate(app, db)
+    assets.init_app(app)
+    images.init_app(app)
 
     from src.main.routes import main
     from src.users.routes import users
@@ -0,0 +1,108 @@
+from flask import current_app, g, request, send_from_directory
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# `flask build-assets` copies every static file into STATIC_BUILD_PATH under a
+# name with the hash of its content, next to gzip and brotli compressed
+# copies, and writes the manifest url_for('static') uses to link them. Built
+# files never change, so they are served as immutable for a year.
+PREFIX = 'dist/'
+MANIFEST = 'manifest.json'
+YEAR = 365 * 24 * 3600
+COMPRESSIBLE = ('.css', '.js', '.svg', '.json', '.txt', '.html')
+# Profile pictures are served by images.send_picture
+SKIPPED = ('profile_pics', 'dist')
+
+def build(static_folder, target):
+    """Fingerprints and compresses the static files and returns the manifest,
+    mapping every file to the name it is served under."""
+    manifest = {}
+    for root, dirs, files in os.walk(static_folder):
+        dirs[:] = sorted(d for d in dirs if os.path.join(root, d) != target and
+            os.path.relpath(os.path.join(root, d), static_folder) not in SKIPPED)
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            filename = os.path.relpath(path, static_folder).replace(os.sep, '/')
+            with open(path, 'rb') as f:
+                data = f.read()
+            base, ext = os.path.splitext(filename)
+            hashed = '{}.{}{}'.format(base, hashlib.sha256(data).hexdigest()[:12], ext)
+            output = os.path.join(target, hashed)
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+            shutil.copyfile(path, output)
+            if ext in COMPRESSIBLE:
+                with open(output + '.gz', 'wb') as f:
+                    f.write(gzip.compress(data, 9))
+                if brotli:
+                    with open(output + '.br', 'wb') as f:
+                        f.write(brotli.compress(data))
+            manifest[filename] = PREFIX + hashed
+    with open(os.path.join(target, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+def load(app):
+    path = os.path.join(app.config['STATIC_BUILD_PATH'], MANIFEST)
+    try:
+        with open(path) as f:
+            app.extensions['assets'] = json.load(f)
+    except FileNotFoundError:
+        # Not built, static files are linked and served as they are
+        app.extensions['assets'] = {}
+
+def fingerprint(endpoint, values):
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = current_app.extensions['assets'].get(values['filename'], values['filename'])
+
+def send_static(filename):
+    """Serves built files, precompressed if the client accepts it, with an
+    immutable Cache-Control. Anything else is served like Flask does."""
+    if not filename.startswith(PREFIX):
+        return current_app.send_static_file(filename)
+    directory = current_app.config['STATIC_BUILD_PATH']
+    filename = filename[len(PREFIX):]
+    mimetype = mimetypes.guess_type(filename)[0]
+    for encoding, ext in (('br', '.br'), ('gzip', '.gz')):
+        if request.accept_encodings[encoding] and os.path.exists(os.path.join(directory, filename + ext)):
+            response = send_from_directory(directory, filename + ext, mimetype=mimetype, cache_timeout=YEAR)
+            response.headers['Content-Encoding'] = encoding
+            break
+    else:
+        response = send_from_directory(directory, filename, mimetype=mimetype, cache_timeout=YEAR)
+    response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(YEAR)
+    response.vary.add('Accept-Encoding')
+    return response
+
+def compress(response):
+    """Gzips dynamic text responses of at least COMPRESS_MIN_SIZE bytes for
+    clients that accept it. Files and streams are left alone, and so is
+    anything rendered with a CSRF token: compressing a secret next to
+    reflected input lets an attacker guess it from the sizes (BREACH)."""
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed or
+            'Content-Encoding' in response.headers or response.mimetype not in current_app.config['COMPRESS_MIMETYPES'] or
+            current_app.config.get('WTF_CSRF_FIELD_NAME', 'csrf_token') in g):
+        return response
+    response.vary.add('Accept-Encoding')
+    if not request.accept_encodings['gzip']:
+        return response
+    data = response.get_data()
+    if len(data) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+    response.set_data(gzip.compress(data, current_app.config['COMPRESS_LEVEL']))
+    response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+def init_app(app):
+    load(app)
+    app.url_defaults(fingerprint)
+    app.view_functions['static'] = send_static
+    app.after_request(compress)
@@ -0,0 +1,92 @@
+from flask import current_app
+from collections import OrderedDict
+import redis
+import sys
+import threading
+import time
+
+class LRUCache(object):
+    """A thread safe in-process cache holding at most maxsize entries, the
+    least recently used ones are evicted first. With a ttl, given here or
+    to set(), entries also expire ttl seconds after they were set."""
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self.lock:
+            try:
+                expires, value = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires is not None and expires < time.monotonic():
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = ttl or self.ttl
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl if ttl else None, value)
+            self.entries.move_to_end(key)
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def delete(self, key):
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+class FragmentCache(object):
+    """Caches rendered HTML fragments in two levels: an LRUCache in every
+    process in front of redis, which all processes share."""
+
+    def __init__(self, maxsize):
+        self.local = LRUCache(maxsize)
+
+    def get_many(self, keys):
+        found = {}
+        missing = []
+        for key in keys:
+            value = self.local.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                found[key] = value
+        if missing:
+            try:
+                values = current_app.redis.mget(missing)
+            except redis.exceptions.RedisError:
+                current_app.logger.error('Error while reading fragments', exc_info=sys.exc_info())
+                values = [None] * len(missing)
+            for key, value in zip(missing, values):
+                if value is not None:
+                    found[key] = value.decode('utf-8')
+                    self.local.set(key, found[key])
+        return found
+
+    def set_many(self, fragments, ttl):
+        for key, value in fragments.items():
+            self.local.set(key, value)
+        try:
+            pipe = current_app.redis.pipeline()
+            for key, value in fragments.items():
+                pipe.setex(key, ttl, value)
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Error while writing fragments', exc_info=sys.exc_info())
@@ -13,6 +13,62 @@ class Config:
     MAIL_USE_TLS = int(os.environ.get('MAIL_USE_TLS') or 1)
     MAIL_USERNAME = os.environ.get('EMAIL_USER')
     MAIL_PASSWORD = os.environ.get('EMAIL_PASS')
+    EMAIL_WORKERS = 2
+    EMAIL_QUEUE_SIZE = 1000
+    EMAIL_QUEUE_TIMEOUT = 5
+    EMAIL_IDLE_TIMEOUT = 30
+    EMAIL_RETRIES = 3
+    EMAIL_RETRY_DELAY = 1
+    BCRYPT_LOG_ROUNDS = 12
+    PASSWORD_WORKERS = os.cpu_count() or 1
+    PASSWORD_QUEUE_DEPTH = 16
+    PASSWORD_TIMEOUT = 5
     ELASTICSEARCH_URL = os.environ.get('ELASTICSEARCH_URL')
+    SEARCH_INDEX_PATH = os.environ.get('SEARCH_INDEX_PATH') or os.path.join(basedir, 'search.db')
+    SEARCH_MAX_HITS = 1000
+    SEARCH_CACHE_TTL = 60
+    SEARCH_BUILD_TTL = 600
+    # Index changes through the outbox and a worker, by default only with
+    # Elasticsearch. The local SQLite index is written on commit instead.
+    SEARCH_OUTBOX = bool(int(os.environ.get('SEARCH_OUTBOX') or (1 if ELASTICSEARCH_URL else 0)))
+    BASE_URL = os.environ.get('BASE_URL') or 'http://localhost:5000'
+    EXPORT_PATH = os.environ.get('EXPORT_PATH') or os.path.join(basedir, 'exports')
+    EXPORT_BATCH_SIZE = 500
+    EXPORT_PROGRESS_STEP = 5
+    EXPORT_PROGRESS_INTERVAL = 2
+    EXPORT_ATTACHMENT_LIMIT = 5 * 1024 * 1024
+    EXPORT_TTL = 7 * 24 * 3600
+    STATIC_BUILD_PATH = os.environ.get('STATIC_BUILD_PATH') or os.path.join(basedir, 'static', 'dist')
+    # No text/html: pages carry the CSRF token next to reflected input (BREACH)
+    COMPRESS_MIMETYPES = ('application/json', 'text/plain', 'text/css', 'application/javascript')
+    COMPRESS_MIN_SIZE = 1024
+    COMPRESS_LEVEL = 6
+    IMAGE_PATH = os.environ.get('IMAGE_PATH') or os.path.join(basedir, 'static', 'profile_pics')
+    IMAGE_UPLOAD_PATH = os.environ.get('IMAGE_UPLOAD_PATH') or os.path.join(basedir, 'uploads')
+    IMAGE_MAX_BYTES = 8 * 1024 * 1024
+    IMAGE_MAX_PIXELS = 40 * 1000 * 1000
     REDIS_URL = os.environ.get('REDIS_URL') or 'redis://'
+    IDENTIFIER_NODE = os.environ.get('IDENTIFIER_NODE')
+    IDENTIFIER_NODE_TTL = 60
     TWEETS_PER_PAGE = 20
+    COMMENTS_PER_PAGE = 50
+    CARD_CACHE_TTL = 24 * 3600
+    COMMENT_THREAD_DEPTH = 5
+    TIMELINE_LENGTH = 800
+    TIMELINE_TTL = 7 * 24 * 3600
+    TIMELINE_FANOUT_LIMIT = 10000
+    # (tokens per second, burst) of the per user buckets
+    RATE_LIMITS = {'like': (2, 20), 'follow': (1, 10)}
+    # Buffer likes in redis and write them to SQL in batches, see likes.py.
+    # Flushes are scheduled jobs, the rq worker needs --with-scheduler.
+    LIKE_BUFFER = bool(int(os.environ.get('LIKE_BUFFER') or 0))
+    LIKE_FLUSH_INTERVAL = 2
+    LIKE_FLUSH_BATCH = 1000
+    LIKE_FLUSH_TIMEOUT = 60
+    UNREAD_TTL = 24 * 3600
+    SESSION_USER_TTL = 3600
+    SESSION_USER_LOCAL_TTL = 5
+    TASK_PROGRESS_TTL = 24 * 3600
+    NOTIFICATION_STREAM_TIMEOUT = 300
+    NOTIFICATION_KEEPALIVE = 15
+    NOTIFICATION_RESUME_WINDOW = 30
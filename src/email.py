@@ -1,13 +1,90 @@
 from flask import current_app
 from src import mail
 from flask_mail import Message
-from threading import Thread
+import os
+import queue
+import smtplib
+import sys
+import threading
+import time
 
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+class Sender(object):
+    """Sends queued messages from a few worker threads. Every worker keeps its
+    SMTP connection open while there is mail to send and closes it once it has
+    been idle for EMAIL_IDLE_TIMEOUT seconds. The queue is bounded, when it is
+    full submit waits up to timeout, by default EMAIL_QUEUE_TIMEOUT, seconds
+    for room and returns False if there is none."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.queue = None
+
+    def submit(self, msg, timeout=None):
+        app = current_app._get_current_object()
+        with self.lock:
+            if self.pid != os.getpid():
+                # Threads do not survive a fork, start them again in the child
+                self.pid = os.getpid()
+                self.queue = queue.Queue(app.config['EMAIL_QUEUE_SIZE'])
+                for _ in range(app.config['EMAIL_WORKERS']):
+                    threading.Thread(target=self._run, args=(app, self.queue), daemon=True).start()
+        try:
+            self.queue.put(msg, timeout=app.config['EMAIL_QUEUE_TIMEOUT'] if timeout is None else timeout)
+        except queue.Full:
+            app.logger.error('Email queue is full, dropped message to {}'.format(msg.recipients))
+            return False
+        return True
+
+    def _run(self, app, messages):
+        with app.app_context():
+            connection = None
+            while True:
+                try:
+                    msg = messages.get(timeout=app.config['EMAIL_IDLE_TIMEOUT'] if connection else None)
+                except queue.Empty:
+                    connection = _close(connection)
+                    continue
+                try:
+                    connection = self._send(app, connection, msg)
+                except Exception:
+                    # A bad message must not take the worker down with it
+                    app.logger.error('Error while sending email to {}'.format(msg.recipients), exc_info=sys.exc_info())
+                    connection = _close(connection)
+                finally:
+                    messages.task_done()
 
-def send_email(subject, sender, recipients, text_body, attachments=None, sync=False):
+    def _send(self, app, connection, msg):
+        retries = app.config['EMAIL_RETRIES']
+        for attempt in range(retries + 1):
+            try:
+                if connection is None:
+                    connection = mail.connect()
+                    connection.__enter__()
+                connection.send(msg)
+                return connection
+            except (smtplib.SMTPException, OSError):
+                connection = _close(connection)
+                if attempt == retries:
+                    app.logger.error('Error while sending email to {}'.format(msg.recipients), exc_info=sys.exc_info())
+                else:
+                    time.sleep(app.config['EMAIL_RETRY_DELAY'] * 2 ** attempt)
+        return connection
+
+def _close(connection):
+    if connection is not None:
+        try:
+            connection.__exit__(None, None, None)
+        except (smtplib.SMTPException, OSError):
+            pass
+    return None
+
+_sender = Sender()
+
+def send_email(subject, sender, recipients, text_body, attachments=None, sync=False, timeout=None):
+    """Sends or queues an email and returns whether it was. Requests pass a
+    timeout of 0, so a full queue is reported right away instead of holding
+    the request."""
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     if attachments:
@@ -15,6 +92,5 @@ def send_email(subject, sender, recipients, text_body, attachments=None, sync=Fa
             msg.attach(*attachment)
     if sync:
         mail.send(msg)
-    else:
-        Thread(target=send_async_email, args=(current_app._get_current_object(), msg)).start()
-
+        return True
+    return _sender.submit(msg, timeout)
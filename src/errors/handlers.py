@@ -1,4 +1,5 @@
 from flask import Blueprint, render_template
+from src.passwords import Saturated
 
 errors = Blueprint('errors', __name__)
 
@@ -13,3 +14,11 @@ def error_403(error):
 @errors.app_errorhandler(500)
 def error_500(error):
     return render_template('errors/500.html'), 500
+
+@errors.app_errorhandler(503)
+def error_503(error):
+    return render_template('errors/503.html'), 503
+
+@errors.app_errorhandler(Saturated)
+def error_saturated(error):
+    return render_template('errors/503.html'), 503, {'Retry-After': '1'}
@@ -0,0 +1,105 @@
+from flask import current_app
+from src import db
+from src.models import Tweet, Comment, Like
+import gzip
+import json
+import os
+import time
+
+# Archives are gzip'd JSON Lines, one {"type": ...} object per line, written
+# in keyset batches so memory use does not grow with the number of posts.
+
+def path(task_id):
+    return os.path.join(current_app.config['EXPORT_PATH'], '{}.jsonl.gz'.format(task_id))
+
+class Progress(object):
+    """Reports progress through report(percent) at most every step percent or
+    every interval seconds, whichever comes first."""
+
+    def __init__(self, total, report, step, interval):
+        self.total = max(total, 1)
+        self.report = report
+        self.step = step
+        self.interval = interval
+        self.done = 0
+        self.reported = 0
+        self.reported_at = time.monotonic()
+
+    def add(self, n):
+        self.done += n
+        percent = min(100 * self.done / self.total, 99)
+        if percent - self.reported >= self.step or time.monotonic() - self.reported_at >= self.interval:
+            self.report(percent)
+            self.reported = percent
+            self.reported_at = time.monotonic()
+
+def _batches(query, key, batch_size):
+    last = None
+    while True:
+        batch = query.filter(key > last) if last is not None else query
+        rows = batch.order_by(key).limit(batch_size).all()
+        if not rows:
+            return
+        yield rows
+        last = rows[-1][0]
+
+def _tweets(user_id, batch_size):
+    query = db.session.query(Tweet.id, Tweet.identifier, Tweet.textbody_source, Tweet.created_utc,
+        Tweet.edited_utc, Tweet.like_count, Tweet.comment_count).filter(Tweet.userid == user_id)
+    for rows in _batches(query, Tweet.id, batch_size):
+        yield [{'type': 'tweet', 'identifier': identifier, 'body': body, 'created_utc': _timestamp(created_utc),
+            'edited_utc': _timestamp(edited_utc), 'like_count': like_count, 'comment_count': comment_count}
+            for _, identifier, body, created_utc, edited_utc, like_count, comment_count in rows]
+
+def _comments(user_id, batch_size):
+    query = db.session.query(Comment.id, Comment.identifier, Tweet.identifier, Comment.textbody,
+        Comment.created_utc).join(Tweet, Tweet.id == Comment.tweet_id).filter(Comment.commenter_id == user_id)
+    for rows in _batches(query, Comment.id, batch_size):
+        yield [{'type': 'comment', 'identifier': identifier, 'tweet': tweet, 'body': body,
+            'created_utc': _timestamp(created_utc)}
+            for _, identifier, tweet, body, created_utc in rows]
+
+def _likes(user_id, batch_size):
+    query = db.session.query(Like.id, Tweet.identifier).join(Tweet, Tweet.id == Like.tweetid).filter(
+        Like.userid == user_id)
+    for rows in _batches(query, Like.id, batch_size):
+        yield [{'type': 'like', 'tweet': tweet} for _, tweet in rows]
+
+def _timestamp(value):
+    return value.isoformat() + 'Z' if value else None
+
+def count(user_id):
+    return (Tweet.query.filter_by(userid=user_id).count() + Comment.query.filter_by(commenter_id=user_id).count() +
+        Like.query.filter_by(userid=user_id).count())
+
+def write(user_id, filename, progress=None, batch_size=500):
+    """Writes the tweets, comments and likes of a user to filename and returns
+    how many records were written. The archive is written next to filename
+    and renamed into place, so a half written archive is never served."""
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    partial = filename + '.part'
+    written = 0
+    try:
+        with gzip.open(partial, 'wt', encoding='utf-8') as f:
+            for records in (_tweets, _comments, _likes):
+                for batch in records(user_id, batch_size):
+                    f.writelines(json.dumps(record) + '\n' for record in batch)
+                    written += len(batch)
+                    if progress:
+                        progress.add(len(batch))
+        os.replace(partial, filename)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return written
+
+def prune(max_age):
+    """Deletes archives older than max_age seconds."""
+    directory = current_app.config['EXPORT_PATH']
+    if not os.path.isdir(directory):
+        return
+    now = time.time()
+    for name in os.listdir(directory):
+        filename = os.path.join(directory, name)
+        if now - os.path.getmtime(filename) > max_age:
+            os.remove(filename)
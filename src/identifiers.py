@@ -0,0 +1,141 @@
+from flask import current_app
+from datetime import datetime, timedelta
+import os
+import random
+import redis
+import sys
+import threading
+import time
+import uuid
+
+# An identifier is a 64 bit number made of the milliseconds since EPOCH, the
+# node that generated it and a sequence number within the millisecond. It is
+# written as 13 characters of Crockford's base32, whose alphabet is in ASCII
+# order, so identifiers sort by creation time as plain strings. Identifiers
+# generated before this scheme are 32 or 64 hex characters and never collide.
+EPOCH = datetime(2020, 1, 1)
+LENGTH = 13
+
+_NODE_BITS = 10
+_SEQUENCE_BITS = 12
+_ALPHABET = '0123456789abcdefghjkmnpqrstvwxyz'
+_EPOCH_MS = int((EPOCH - datetime(1970, 1, 1)).total_seconds() * 1000)
+
+# Every process leases its node for IDENTIFIER_NODE_TTL seconds and renews
+# the lease while it generates, so two live processes never share a node.
+# Tries the nodes from ARGV[1] on and returns the first one it got, or -1.
+_LEASE = """
+local nodes = tonumber(ARGV[3])
+for i = 0, nodes - 1 do
+    local node = (tonumber(ARGV[1]) + i) % nodes
+    if redis.call('SET', ARGV[4] .. node, ARGV[2], 'NX', 'EX', ARGV[5]) then
+        return node
+    end
+end
+return -1
+"""
+
+_RENEW = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+class NodesExhausted(Exception):
+    pass
+
+class Generator(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.node = None
+        self.token = None
+        self.renewed = 0
+        self.last = 0
+        self.sequence = 0
+
+    def next(self):
+        with self.lock:
+            if self.pid != os.getpid():
+                # Forked workers must not share the node of their parent
+                self.pid = os.getpid()
+                self.node = self.token = None
+            if self.node is None or time.monotonic() - self.renewed > current_app.config['IDENTIFIER_NODE_TTL'] / 3:
+                self.allocate()
+            now = max(_now(), self.last)
+            if now == self.last:
+                self.sequence = (self.sequence + 1) & ((1 << _SEQUENCE_BITS) - 1)
+                if self.sequence == 0:
+                    # Sequence exhausted, wait for the next millisecond
+                    while now <= self.last:
+                        now = _now()
+            else:
+                self.sequence = 0
+            self.last = now
+            return encode((now << (_NODE_BITS + _SEQUENCE_BITS)) | (self.node << _SEQUENCE_BITS) | self.sequence)
+
+    def allocate(self):
+        """Renews the lease of the node or leases another one if it was lost.
+        Raises NodesExhausted when every node is leased."""
+        config = current_app.config
+        self.renewed = time.monotonic()
+        if config['IDENTIFIER_NODE'] is not None:
+            self.node = int(config['IDENTIFIER_NODE']) % (1 << _NODE_BITS)
+            return
+        try:
+            if self.token and current_app.redis.eval(_RENEW, 1, _node_key(self.node), self.token,
+                    config['IDENTIFIER_NODE_TTL']):
+                return
+            token = uuid.uuid4().hex
+            node = current_app.redis.eval(_LEASE, 0, random.getrandbits(_NODE_BITS), token, 1 << _NODE_BITS,
+                _node_key(''), config['IDENTIFIER_NODE_TTL'])
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Error while leasing identifier node', exc_info=sys.exc_info())
+            if self.node is None:
+                # Unleased until redis is back, leasing is retried on renewal
+                self.node = random.getrandbits(_NODE_BITS)
+            self.token = None
+            return
+        if node < 0:
+            raise NodesExhausted('All {} identifier nodes are leased'.format(1 << _NODE_BITS))
+        self.node, self.token = node, token
+
+def _node_key(node):
+    return 'identifiers:node:{}'.format(node)
+
+def _now():
+    return int(time.time() * 1000) - _EPOCH_MS
+
+_generator = Generator()
+
+def generate():
+    return _generator.next()
+
+def encode(n):
+    chars = []
+    for _ in range(LENGTH):
+        n, digit = divmod(n, 32)
+        chars.append(_ALPHABET[digit])
+    return ''.join(reversed(chars))
+
+def decode(identifier):
+    """Returns the number behind an identifier, or None for identifiers of the
+    old random scheme."""
+    if len(identifier) != LENGTH:
+        return None
+    n = 0
+    for char in identifier:
+        digit = _ALPHABET.find(char)
+        if digit < 0:
+            return None
+        n = n * 32 + digit
+    return n
+
+def created_utc(identifier):
+    """Returns when an identifier was generated, so identifiers can be used as
+    time cursors. None for identifiers of the old random scheme."""
+    n = decode(identifier)
+    if n is None:
+        return None
+    return EPOCH + timedelta(milliseconds=n >> (_NODE_BITS + _SEQUENCE_BITS))
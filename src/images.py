@@ -0,0 +1,139 @@
+from flask import current_app, send_from_directory
+from markupsafe import Markup, escape
+from PIL import Image, ImageOps, features
+import hashlib
+import os
+import re
+import tempfile
+
+# Profile pictures are stored under the first 16 hex digits of the sha256 of
+# the upload, so the same upload is stored once and a name never changes
+# content. Every picture is resized into square variants named
+# <name>-<width>.<format>. Pictures are not upscaled: one smaller than the
+# largest size gets -<side> added to its name and is stored at the sizes below
+# its side plus its own side. Names with an extension are pictures saved
+# before.
+SIZES = (64, 128, 256)
+# WebP is only written when Pillow was built with it
+FORMATS = ('webp', 'jpeg') if features.check('webp') else ('jpeg',)
+ACCEPTED = ('JPEG', 'PNG', 'WEBP', 'GIF')
+# Pictures are served from IMAGE_PATH under URL, wherever that directory is
+URL = '/static/profile_pics/'
+YEAR = 365 * 24 * 3600
+_VARIANT = re.compile(r'^[0-9a-f]{16}(-\d+)?-\d+\.\w+$')
+
+class PictureError(ValueError):
+    pass
+
+def _directory():
+    return current_app.config['IMAGE_PATH']
+
+def _uploads():
+    return current_app.config['IMAGE_UPLOAD_PATH']
+
+def variant(name, size, format):
+    return '{}-{}.{}'.format(name, size, 'jpg' if format == 'jpeg' else format)
+
+def widths(name):
+    """Returns the widths the variants of name are stored at."""
+    if '-' not in name:
+        return SIZES
+    side = int(name.rsplit('-', 1)[1])
+    return tuple(size for size in SIZES if size < side) + (side,)
+
+def is_processed(name):
+    return all(os.path.exists(os.path.join(_directory(), variant(name, width, format)))
+        for width in widths(name) for format in FORMATS)
+
+def _write(path, save):
+    # Written next to the target and renamed, so nobody sees half a file
+    fd, partial = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            save(f)
+        os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+
+def store(upload):
+    """Stores an uploaded picture as is and returns its name. Only the header
+    is decoded here, to enforce IMAGE_MAX_BYTES and IMAGE_MAX_PIXELS, resizing
+    is left to process()."""
+    data = upload.read(current_app.config['IMAGE_MAX_BYTES'] + 1)
+    if len(data) > current_app.config['IMAGE_MAX_BYTES']:
+        raise PictureError('Pictures can be at most {} MB'.format(current_app.config['IMAGE_MAX_BYTES'] // 2 ** 20))
+    upload.seek(0)
+    try:
+        image = Image.open(upload)
+    except (OSError, Image.DecompressionBombError):
+        raise PictureError('This file is not a picture')
+    if image.format not in ACCEPTED:
+        raise PictureError('Pictures must be JPEG, PNG, WebP or GIF')
+    if image.width * image.height > current_app.config['IMAGE_MAX_PIXELS']:
+        raise PictureError('Pictures can be at most {} megapixels'.format(current_app.config['IMAGE_MAX_PIXELS'] // 10 ** 6))
+    name = hashlib.sha256(data).hexdigest()[:16]
+    side = min(image.width, image.height)
+    if side < SIZES[-1]:
+        name = '{}-{}'.format(name, side)
+    os.makedirs(_uploads(), exist_ok=True)
+    path = os.path.join(_uploads(), name)
+    if not is_processed(name) and not os.path.exists(path):
+        _write(path, lambda f: f.write(data))
+    return name
+
+def process(name):
+    """Writes the variants of a stored upload and removes the upload."""
+    path = os.path.join(_uploads(), name)
+    if is_processed(name):
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image).convert('RGB')
+    side = min(image.size)
+    image = ImageOps.fit(image, (side, side), Image.LANCZOS)
+    os.makedirs(_directory(), exist_ok=True)
+    for width in widths(name):
+        resized = image.resize((width, width), Image.LANCZOS) if width < side else image
+        for format in FORMATS:
+            _write(os.path.join(_directory(), variant(name, width, format)),
+                lambda f: resized.save(f, format, quality=85, optimize=True))
+    os.remove(path)
+
+def path(image_file):
+    return os.path.join(_directory(), image_file)
+
+def url(image_file, size):
+    if '.' in image_file:
+        return URL + image_file
+    available = widths(image_file)
+    return URL + variant(image_file, next((width for width in available if width >= size), available[-1]), 'jpeg')
+
+def srcset(image_file, format):
+    return ', '.join('{}{} {}w'.format(URL, variant(image_file, width, format), width) for width in widths(image_file))
+
+def send_picture(filename):
+    """Serves a picture from IMAGE_PATH. Variants never change content, so
+    they are served as immutable for a year."""
+    response = send_from_directory(_directory(), filename)
+    if _VARIANT.match(filename):
+        response.headers['Cache-Control'] = 'public, max-age={}, immutable'.format(YEAR)
+    return response
+
+def picture(image_file, size, **attrs):
+    """Returns a <picture> showing image_file at size pixels, with a srcset
+    of every variant so browsers pick the size and format they need."""
+    attrs = ''.join(' {}="{}"'.format(key, escape(value)) for key, value in sorted(attrs.items()))
+    if '.' in image_file:
+        return Markup('<img src="{}"{}>'.format(escape(url(image_file, size)), attrs))
+    sources = ''.join('<source type="image/{}" srcset="{}" sizes="{}px">'.format(format, srcset(image_file, format), size)
+        for format in FORMATS if format != 'jpeg')
+    return Markup('<picture>{}<img src="{}" srcset="{}" sizes="{}px"{}></picture>'.format(
+        sources, url(image_file, size), srcset(image_file, 'jpeg'), size, attrs))
+
+def init_app(app):
+    # More specific than the static rule, so it is matched first
+    app.add_url_rule(URL + '<filename>', 'picture', send_picture)
+    app.add_template_global(picture, 'profile_picture')
+    app.add_template_global(url, 'profile_picture_url')
@@ -0,0 +1,232 @@
+from flask import current_app
+from datetime import timedelta
+from src import db
+from src.models import Like, Tweet, insert_ignore
+import redis
+import sys
+
+# With LIKE_BUFFER set, likes and unlikes are written to redis instead of
+# SQL. PENDING holds the latest state of every changed (user, tweet) pair and
+# DELTA how much each tweet count moved, so pages show the new count at once.
+# Every LIKE_FLUSH_INTERVAL seconds flush() renames both to FLUSHING, applies
+# them to SQL in one transaction and deletes them. The rename is atomic and the
+# SQL writes are idempotent, so a flusher dying half way leaves FLUSHING behind
+# and the next flush replays it before taking new changes.
+# After the commit FLUSHING is kept as FLUSHED, until the next flush commits,
+# and GENERATION counts the commits. A state read from SQL before a commit is
+# corrected with FLUSHED, see _SET.
+PENDING = 'likes:pending'
+DELTA = 'likes:delta'
+FLUSHING = 'likes:flushing'
+FLUSHING_DELTA = 'likes:flushing-delta'
+FLUSHED = 'likes:flushed'
+GENERATION = 'likes:generation'
+RETRIES = 3
+
+# Sets the state of a pair unless it already has it, as read from PENDING,
+# then FLUSHING, then SQL. A pair set back to the state it has below PENDING
+# is dropped instead of flushed. The SQL state is passed with the GENERATION
+# it was read at: if one flush committed since, FLUSHED overrides it, if more
+# did it returns nil and the caller reads SQL again. Otherwise returns
+# whether anything changed and the buffered delta of the tweet.
+_SET = """
+local generation = tonumber(redis.call('GET', KEYS[6]) or 0)
+local persisted = ARGV[4]
+if generation == tonumber(ARGV[5]) + 1 then
+    persisted = redis.call('HGET', KEYS[5], ARGV[1]) or persisted
+elseif generation ~= tonumber(ARGV[5]) then
+    return nil
+end
+local state = redis.call('HGET', KEYS[1], ARGV[1])
+local base = redis.call('HGET', KEYS[2], ARGV[1]) or persisted
+local changed = 0
+if (state or base) ~= ARGV[3] then
+    if base == ARGV[3] then
+        redis.call('HDEL', KEYS[1], ARGV[1])
+    else
+        redis.call('HSET', KEYS[1], ARGV[1], ARGV[3])
+    end
+    redis.call('HINCRBY', KEYS[3], ARGV[2], ARGV[3] == '1' and 1 or -1)
+    changed = 1
+end
+local delta = (tonumber(redis.call('HGET', KEYS[3], ARGV[2])) or 0) + (tonumber(redis.call('HGET', KEYS[4], ARGV[2])) or 0)
+return {changed, delta}
+"""
+
+# Moves the pending changes to the flushing keys, unless a failed flush left
+# some there. Returns 0 if there is nothing to flush, 1 if changes were moved
+# and 2 if a failed flush has to be replayed first.
+_CLAIM = """
+if redis.call('EXISTS', KEYS[3]) == 1 or redis.call('EXISTS', KEYS[4]) == 1 then
+    return 2
+end
+local claimed = 0
+for i = 1, 2 do
+    if redis.call('EXISTS', KEYS[i]) == 1 then
+        redis.call('RENAME', KEYS[i], KEYS[i + 2])
+        claimed = 1
+    end
+end
+return claimed
+"""
+REPLAY = 2
+
+# Keeps the applied changes as FLUSHED and counts the commit.
+_DONE = """
+if redis.call('EXISTS', KEYS[1]) == 1 then
+    redis.call('RENAME', KEYS[1], KEYS[3])
+else
+    redis.call('DEL', KEYS[3])
+end
+redis.call('DEL', KEYS[2])
+return redis.call('INCR', KEYS[4])
+"""
+
+def _field(user_id, tweet_id):
+    return '{}:{}'.format(user_id, tweet_id)
+
+def set_state(user_id, tweet, liked):
+    """Buffers whether user_id likes tweet and returns whether anything
+    changed and the like count including buffered changes. Raises RedisError
+    when the buffer can not be reached, or WatchError when flushes kept
+    committing while the like table was read."""
+    for _ in range(RETRIES):
+        generation = int(current_app.redis.get(GENERATION) or 0)
+        persisted = db.session.query(Like.query.filter(
+            Like.userid == user_id, Like.tweetid == tweet.id).exists()).scalar()
+        result = current_app.redis.eval(_SET, 6, PENDING, FLUSHING, DELTA, FLUSHING_DELTA, FLUSHED, GENERATION,
+            _field(user_id, tweet.id), tweet.id, int(liked), int(persisted), generation)
+        if result is not None:
+            break
+    else:
+        raise redis.exceptions.WatchError('Like flushes kept committing')
+    changed, delta = result
+    if changed:
+        schedule_flush()
+    return bool(changed), tweet.like_count + delta
+
+def states(user_id, tweet_ids):
+    """Returns the buffered like state of user_id for tweet_ids, by tweet id.
+    Tweets without buffered changes are left out."""
+    fields = [_field(user_id, tweet_id) for tweet_id in tweet_ids]
+    pipe = current_app.redis.pipeline()
+    pipe.hmget(PENDING, fields)
+    pipe.hmget(FLUSHING, fields)
+    pending, flushing = pipe.execute()
+    return {tweet_id: (state if state is not None else older) == b'1'
+        for tweet_id, state, older in zip(tweet_ids, pending, flushing) if (state or older) is not None}
+
+def deltas(tweet_ids):
+    """Returns how far the like count of each of tweet_ids is from the one in
+    SQL, by tweet id."""
+    pipe = current_app.redis.pipeline()
+    pipe.hmget(DELTA, tweet_ids)
+    pipe.hmget(FLUSHING_DELTA, tweet_ids)
+    pending, flushing = pipe.execute()
+    return {tweet_id: int(a or 0) + int(b or 0) for tweet_id, a, b in zip(tweet_ids, pending, flushing)}
+
+def schedule_flush():
+    interval = current_app.config['LIKE_FLUSH_INTERVAL']
+    try:
+        if current_app.redis.set('likes:flush-scheduled', 1, nx=True, ex=interval * 10):
+            current_app.task_queue.enqueue_in(timedelta(seconds=interval), 'src.tasks.flush_likes')
+    except redis.exceptions.RedisError:
+        current_app.logger.error('Error while scheduling like flush', exc_info=sys.exc_info())
+
+def _read(*keys):
+    pipe = current_app.redis.pipeline()
+    for key in keys:
+        pipe.hgetall(key)
+    entries = {}
+    for buffered in pipe.execute():
+        for field, state in buffered.items():
+            user_id, tweet_id = field.split(b':')
+            entries[(int(user_id), int(tweet_id))] = state == b'1'
+    return entries
+
+def snapshot():
+    """Returns every buffered state by (user_id, tweet_id)."""
+    return _read(FLUSHING, PENDING)
+
+def _chunks(items, size):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+def apply(entries, batch_size):
+    """Writes the (user_id, tweet_id): liked entries to the like table and
+    recounts the tweets they touch, all in one transaction. Applying the
+    same entries again changes nothing."""
+    tweet_ids = {tweet_id for _, tweet_id in entries}
+    existing = set()
+    for chunk in _chunks(tweet_ids, batch_size):
+        existing.update(id for (id,) in db.session.query(Tweet.id).filter(Tweet.id.in_(chunk)))
+    likes = [{'userid': user_id, 'tweetid': tweet_id}
+        for (user_id, tweet_id), liked in entries.items() if liked and tweet_id in existing]
+    unlikes = [{'user_id': user_id, 'tweet_id': tweet_id}
+        for (user_id, tweet_id), liked in entries.items() if not liked]
+    delete = Like.__table__.delete().where(db.and_(
+        Like.userid == db.bindparam('user_id'), Like.tweetid == db.bindparam('tweet_id')))
+    for chunk in _chunks(likes, batch_size):
+        db.session.execute(insert_ignore(Like.__table__), chunk)
+    for chunk in _chunks(unlikes, batch_size):
+        db.session.execute(delete, chunk)
+    recount = db.select([db.func.count(Like.id)]).where(Like.tweetid == Tweet.id).as_scalar()
+    for chunk in _chunks(existing, batch_size):
+        Tweet.query.filter(Tweet.id.in_(chunk)).update({Tweet.like_count: recount}, synchronize_session=False)
+    db.session.commit()
+
+def flush(batch_size=None):
+    """Applies the buffered likes to SQL, after replaying a failed flush if
+    there is one, and returns how many (user, tweet) pairs were written.
+    Returns 0 right away if another flush is running."""
+    batch_size = batch_size or current_app.config['LIKE_FLUSH_BATCH']
+    lock = current_app.redis.lock('likes:flush-lock', timeout=current_app.config['LIKE_FLUSH_TIMEOUT'])
+    if not lock.acquire(blocking=False):
+        return 0
+    try:
+        flushed = 0
+        while True:
+            claimed = current_app.redis.eval(_CLAIM, 4, PENDING, DELTA, FLUSHING, FLUSHING_DELTA)
+            if not claimed:
+                return flushed
+            entries = _read(FLUSHING)
+            try:
+                apply(entries, batch_size)
+            except:
+                db.session.rollback()
+                raise
+            # Counts read between the commit and here include the flushed
+            # changes twice, for a moment
+            current_app.redis.eval(_DONE, 4, FLUSHING, FLUSHING_DELTA, FLUSHED, GENERATION)
+            flushed += len(entries)
+            if claimed != REPLAY:
+                return flushed
+    finally:
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            current_app.logger.warning('Like flush took longer than LIKE_FLUSH_TIMEOUT')
+
+def check(entries):
+    """Compares SQL with the (user_id, tweet_id): liked entries of a snapshot
+    taken before a flush. Returns the entries SQL disagrees with and the ids of
+    the tweets whose like_count is not the number of their likes. Entries of
+    deleted tweets are left out, apply() drops them."""
+    batch_size = current_app.config['LIKE_FLUSH_BATCH']
+    by_tweet = {}
+    for (user_id, tweet_id), liked in entries.items():
+        by_tweet.setdefault(tweet_id, {})[user_id] = liked
+    diverged = {}
+    miscounted = []
+    counted = db.select([db.func.count(Like.id)]).where(Like.tweetid == Tweet.id).as_scalar()
+    for chunk in _chunks(by_tweet, batch_size):
+        for id, like_count, likes in db.session.query(Tweet.id, Tweet.like_count, counted).filter(Tweet.id.in_(chunk)).all():
+            if like_count != likes:
+                miscounted.append(id)
+            stored = set()
+            for users in _chunks(by_tweet[id], batch_size):
+                stored.update(user_id for (user_id,) in db.session.query(Like.userid).filter(
+                    Like.tweetid == id, Like.userid.in_(users)))
+            diverged.update({(user_id, id): liked for user_id, liked in by_tweet[id].items() if (user_id in stored) != liked})
+    return diverged, sorted(miscounted)
@@ -3,6 +3,9 @@ from flask_login import current_user
 from sqlalchemy import or_
 from src.models import db, Tweet, User
 from src.main.forms import SearchForm
+from src.pagination import decode_cursor, encode_search_cursor, decode_search_cursor
+from src.search import multi_search
+from src.tweets.utils import hydrate_tweets
 
 main = Blueprint('main', __name__)
 
@@ -15,12 +18,12 @@ def before_request():
 @main.route("/home")
 def home():
     if current_user.is_authenticated:
-        page = request.args.get('page', 1, type=int)
-        tweets = current_user.followed_posts().paginate(
-            page, current_app.config['TWEETS_PER_PAGE'], False)
-        next_url = url_for('main.home', page=tweets.next_num) if tweets.has_next else None
-        prev_url = url_for('main.home', page=tweets.prev_num) if tweets.has_prev else None
-        return render_template('home.html', tweets=tweets.items, showCreateTweet=True, next_url=next_url, prev_url=prev_url)
+        tweets = current_user.home_timeline(current_app.config['TWEETS_PER_PAGE'],
+            before=decode_cursor(request.args.get('before')), after=decode_cursor(request.args.get('after')))
+        next_url = url_for('main.home', before=tweets.next_cursor) if tweets.has_next else None
+        prev_url = url_for('main.home', after=tweets.prev_cursor) if tweets.has_prev else None
+        return render_template('home.html', tweets=tweets.items, showCreateTweet=True, next_url=next_url, prev_url=prev_url,
+            **hydrate_tweets(tweets.items, current_user))
     return render_template('home.html', emptyTweets=True, showCreateTweet=True)
 
 @main.route("/search", methods=['GET'])
@@ -28,14 +31,22 @@ def search():
     if not g.search_form.validate():
         return redirect(url_for('main.home'))
     query = g.search_form.q.data
-    page = request.args.get('page', 1, type=int)
-    tweets, total_tweets = Tweet.search(query, page, 3)
-    if current_user.is_anonymous or current_user.filter_nsfw:
-        tweets = tweets.filter_by(is_nsfw=False).all()
-    users, total_users = User.search(query, page, 3)
+    after = decode_search_cursor(request.args.get('after'))
+    filters = {'is_nsfw': False} if current_user.is_anonymous or current_user.filter_nsfw else {}
+    exclude = [current_user.id] if current_user.is_authenticated else []
+    tweet_results, user_results = multi_search([
+        Tweet.search(query, 3, after.get('tweet'), **filters),
+        User.search(query, 3, after.get('user'), exclude=exclude)])
+    tweets = Tweet.from_results(tweet_results)
+    users = User.from_results(user_results)
+    followed_ids = set()
     if current_user.is_authenticated:
-        users = users.filter(User.id != current_user.id)
+        followed_ids = current_user.followed_ids([user.id for user in users])
 
-    next_url = url_for('main.search', q=query, page=page + 1) if total_tweets > page * 3 else None
-    prev_url = url_for('main.search', q=query, page=page - 1) if page > 1 else None
-    return render_template('search_results.html', tweets=tweets, users=users, query=query, next_url=next_url, prev_url=prev_url, total_tweets=total_tweets, total_users=total_users)
+    # search_after only pages forward, the browser history goes back
+    next_url = url_for('main.search', q=query, after=encode_search_cursor(
+        {'tweet': tweet_results.after, 'user': user_results.after})) \
+        if tweet_results.has_next or user_results.has_next else None
+    return render_template('search_results.html', tweets=tweets, users=users, query=query, next_url=next_url, prev_url=None,
+        total_tweets=tweet_results.total, total_users=user_results.total,
+        followed_ids=followed_ids, **hydrate_tweets(tweets, current_user))
@@ -0,0 +1,38 @@
+from src.cache import LRUCache
+import bleach
+import hashlib
+import markdown2
+import threading
+
+# Bump whenever the output changes, `flask rerender` then renders every tweet
+# again with the new pipeline.
+VERSION = 1
+
+TAGS = frozenset(['b', 'i', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'abbr', 'acronym', 'p', 'code', 'blockquote',
+    'table', 'tr', 'td', 'br', 'ol', 'li', 'pre', 'div', 'span', 'em', 'strong', 'cite', 'col', 'colgroup',
+    'datalist', 'dd', 'dt', 'dl', 'q', 's', 'small', 'sub', 'sup', 'tbody', 'th', 'thead', 'u'])
+
+_cache = LRUCache(4096)
+# Markdown and Cleaner instances keep state while converting, every thread
+# reuses its own.
+_local = threading.local()
+
+def _pipeline():
+    if not hasattr(_local, 'markdown'):
+        _local.markdown = markdown2.Markdown()
+        _local.cleaner = bleach.sanitizer.Cleaner(tags=TAGS)
+    return _local.markdown, _local.cleaner
+
+def render(source):
+    """Renders markdown source to sanitized HTML. Results are cached by a hash
+    of the source and VERSION."""
+    key = hashlib.sha1('{}:{}'.format(VERSION, source).encode('utf-8')).digest()
+    html = _cache.get(key)
+    if html is None:
+        markdown, cleaner = _pipeline()
+        html = cleaner.clean(markdown.convert(source))
+        _cache.set(key, html)
+    return html
+
+def render_many(sources):
+    return [render(source) for source in sources]
@@ -1,62 +1,278 @@
 from flask import current_app
 from flask_login import UserMixin
 from src import db, login_manager
-from src.search import add_to_index, remove_from_index, query_index
+from src.search import Search, bulk_index, start_build, keep_building, finish_build, abort_build
+from src import timeline, identifiers, markup
+from src.pagination import Page, paginate
+from src.cache import LRUCache
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.orm import make_transient_to_detached
+from sqlalchemy.orm.attributes import get_history
 from itsdangerous import TimedJSONWebSignatureSerializer as Serializer
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from time import time
 import json
 import redis
 import rq
-import secrets
+import sys
+
+# Columns of the logged in user that the request path reads. Passwords stay
+# out of redis and the counters are updated with SQL expressions, both are
+# loaded from the database only when a view reads them.
+SESSION_USER_COLUMNS = ('username', 'showname', 'image_file', 'email', 'bio', 'created_utc', 'filter_nsfw',
+    'admin_level', 'is_banned', 'last_message_read_time', 'last_notifs_read_time')
+
+_session_users = LRUCache(10000)
+
+def _session_user_key(user_id):
+    return 'session-user:{}'.format(user_id)
+
+# Bumped on every invalidation. A reader stores the row it loaded only if the
+# generation is still the one it saw before loading, so a row read before a
+# commit can not be cached after that commit invalidated it.
+def _session_user_generation_key(user_id):
+    return 'session-user-generation:{}'.format(user_id)
+
+_STORE_SESSION_USER = """
+if redis.call('GET', KEYS[2]) ~= (ARGV[1] ~= '' and ARGV[1] or false) then
+    return 0
+end
+for i = 3, #ARGV, 2 do
+    redis.call('HSET', KEYS[1], ARGV[i], ARGV[i + 1])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+return 1
+"""
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    """Returns the logged in user built from the session user cache, a short
+    lived map in every process in front of a redis hash, without querying
+    the database. The user is merged into the session without loading, so
+    relationships and writes through it work like on a queried user."""
+    user_id = int(user_id)
+    ttl = current_app.config['SESSION_USER_LOCAL_TTL']
+    columns = _session_users.get(user_id) if ttl else None
+    if columns is None:
+        columns = _cached_session_user(user_id)
+        if columns is None:
+            return None
+        if ttl:
+            _session_users.set(user_id, columns, ttl)
+    user = User(id=user_id, **columns)
+    make_transient_to_detached(user)
+    return db.session.merge(user, load=False)
+
+def _cached_session_user(user_id):
+    key = _session_user_key(user_id)
+    generation_key = _session_user_generation_key(user_id)
+    try:
+        pipe = current_app.redis.pipeline(transaction=False)
+        pipe.hgetall(key)
+        pipe.get(generation_key)
+        cached, generation = pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.error('Error while reading session user', exc_info=sys.exc_info())
+        return _load_session_user(user_id)
+    if cached:
+        columns = {name.decode(): json.loads(value) for name, value in cached.items()}
+        for name in SESSION_USER_COLUMNS:
+            if columns[name] is not None and isinstance(User.__table__.c[name].type, db.DateTime):
+                columns[name] = datetime.strptime(columns[name], '%Y-%m-%dT%H:%M:%S.%f')
+        return columns
+    columns = _load_session_user(user_id)
+    if columns is None:
+        return None
+    fields = []
+    for name, value in columns.items():
+        fields += [name, json.dumps(value.strftime('%Y-%m-%dT%H:%M:%S.%f') if isinstance(value, datetime) else value)]
+    try:
+        current_app.redis.eval(_STORE_SESSION_USER, 2, key, generation_key,
+            generation or '', current_app.config['SESSION_USER_TTL'], *fields)
+    except redis.exceptions.RedisError:
+        current_app.logger.error('Error while storing session user', exc_info=sys.exc_info())
+    return columns
+
+def _load_session_user(user_id):
+    row = db.session.query(*[getattr(User, name) for name in SESSION_USER_COLUMNS]).filter(User.id == user_id).first()
+    return dict(zip(SESSION_USER_COLUMNS, row)) if row is not None else None
+
+def _collect_session_users(session, flush_context):
+    changed = session.info.setdefault('session_users', set())
+    for obj in session.dirty | session.deleted:
+        if isinstance(obj, User) and any(get_history(obj, name).has_changes() for name in SESSION_USER_COLUMNS):
+            changed.add(obj.id)
+
+def _invalidate_session_users(session):
+    user_ids = session.info.pop('session_users', set())
+    if not user_ids:
+        return
+    # Other processes drop their copy when SESSION_USER_LOCAL_TTL runs out
+    for user_id in user_ids:
+        _session_users.delete(user_id)
+    try:
+        pipe = current_app.redis.pipeline()
+        for user_id in user_ids:
+            pipe.incr(_session_user_generation_key(user_id))
+            pipe.expire(_session_user_generation_key(user_id), current_app.config['SESSION_USER_TTL'])
+            pipe.delete(_session_user_key(user_id))
+        pipe.execute()
+    except redis.exceptions.RedisError:
+        current_app.logger.error('Error while invalidating session users', exc_info=sys.exc_info())
+
+def _discard_session_users(session):
+    session.info.pop('session_users', None)
+
+db.event.listen(db.session, 'after_flush', _collect_session_users)
+db.event.listen(db.session, 'after_commit', _invalidate_session_users)
+db.event.listen(db.session, 'after_rollback', _discard_session_users)
 
 class SearchableMixin(object):
+    # Boolean flags stored in the index to filter on, they are not searched
+    __search_filters__ = []
+
     @classmethod
-    def search(cls, expression, page, per_page):
-        ids, total = query_index(cls.__tablename__, expression, page, per_page)
-        if not ids or total == 0:
-            return cls.query.filter_by(id=0), 0
-        when = []
-        for i in range(len(ids)):
-            when.append((ids[i], i))
-        return cls.query.filter(cls.id.in_(ids)).order_by(db.case(when, value=cls.id)), total
+    def search(cls, expression, per_page, after=None, exclude=(), **filters):
+        """Returns a Search of this model for multi_search()."""
+        return Search(cls.__tablename__, expression, per_page, after, filters, list(exclude))
 
     @classmethod
-    def before_commit(cls, session):
-        session._changes = {
-            'add': list(session.new),
-            'update': list(session.dirty),
-            'delete': list(session.deleted)
-        }
+    def from_results(cls, results):
+        """Loads the objects of search Results in one query, in ranking order."""
+        if not results.ids:
+            return []
+        order = {id: i for i, id in enumerate(results.ids)}
+        return sorted(cls.query.filter(cls.id.in_(results.ids)), key=lambda obj: order[obj.id])
+
+    def search_document(self):
+        document = {field: getattr(self, field) for field in self.__searchable__}
+        document.update((field, bool(getattr(self, field))) for field in self.__search_filters__)
+        return document
 
     @classmethod
-    def after_commit(cls, session):
-        for obj in session._changes['add']:
+    def after_flush(cls, session, flush_context):
+        """Records index changes to the search outbox in the same transaction
+        as the change itself, a worker applies them to the index later.
+        Without SEARCH_OUTBOX the changed documents are kept to be indexed
+        once the transaction commits."""
+        if not current_app.search:
+            return
+        changes = []
+        for obj in session.new:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['update']:
+                changes.append((obj, 'index'))
+        for obj in session.dirty:
             if isinstance(obj, SearchableMixin):
-                add_to_index(obj.__tablename__, obj)
-        for obj in session._changes['delete']:
+                state = db.inspect(obj)
+                if any(state.attrs[field].history.has_changes()
+                        for field in obj.__searchable__ + obj.__search_filters__):
+                    changes.append((obj, 'index'))
+        for obj in session.deleted:
             if isinstance(obj, SearchableMixin):
-                remove_from_index(obj.__tablename__, obj)
-        session._changes = None
+                changes.append((obj, 'delete'))
+        if not changes:
+            return
+        if not current_app.config['SEARCH_OUTBOX']:
+            # Documents are read now, a committed session can not load them
+            session.info.setdefault('search_changes', []).extend(
+                (op, obj.__tablename__, obj.id, obj.search_document() if op == 'index' else None)
+                for obj, op in changes)
+            return
+        now = datetime.utcnow()
+        session.connection().execute(SearchOutbox.__table__.insert(), [
+            {'index': obj.__tablename__, 'doc_id': obj.id, 'op': op, 'created_utc': now}
+            for obj, op in changes])
+        session.info['search_outbox'] = True
 
     @classmethod
-    def reindex(cls):
-        for obj in cls.query:
-            add_to_index(cls.__tablename__, obj)
+    def after_commit(cls, session):
+        if session.info.pop('search_outbox', False):
+            SearchOutbox.schedule_drain()
+        operations = session.info.pop('search_changes', None)
+        if operations:
+            try:
+                bulk_index(operations)
+            except Exception:
+                # The index is behind until the next reindex
+                current_app.logger.error('Error while indexing', exc_info=sys.exc_info())
 
-db.event.listen(db.session, 'before_commit', SearchableMixin.before_commit)
+    @classmethod
+    def after_rollback(cls, session):
+        session.info.pop('search_outbox', None)
+        session.info.pop('search_changes', None)
+
+    @classmethod
+    def reindex(cls, workers=4, batch_size=1000):
+        """Rebuilds the search index from scratch into a new index, streaming
+        rows in id ranges across worker processes, then swaps it in. Returns
+        the number of documents indexed and the throughput in docs/sec."""
+        alias = cls.__tablename__
+        index = start_build(alias, cls.__searchable__, cls.__search_filters__)
+        started = time()
+        try:
+            low, high = db.session.query(db.func.min(cls.id), db.func.max(cls.id)).one()
+            step = batch_size * 10
+            jobs = [(alias, index, start, start + step, batch_size)
+                for start in range(low, high + 1, step)] if low is not None else []
+            if workers > 1:
+                with ProcessPoolExecutor(workers, initializer=_init_reindex_worker,
+                        initargs=(dict(current_app.config),)) as pool:
+                    indexed = sum(pool.map(_reindex_range, jobs))
+            else:
+                indexed = sum(map(_reindex_range, jobs))
+        except:
+            abort_build(alias, index)
+            raise
+        changed = finish_build(alias, index)
+        if changed:
+            # Copied rows may be older than changes indexed during the build,
+            # the outbox indexes their current version again
+            now = datetime.utcnow()
+            db.session.execute(SearchOutbox.__table__.insert(), [
+                {'index': alias, 'doc_id': id, 'op': 'index', 'created_utc': now} for id in changed])
+            db.session.commit()
+            SearchOutbox.schedule_drain()
+        elapsed = time() - started
+        return indexed, indexed / elapsed if elapsed else 0
+
+def _init_reindex_worker(config):
+    from src import create_app
+    app = create_app()
+    app.config.update(config)
+    app.app_context().push()
+
+def _reindex_range(job):
+    alias, index, start, stop, batch_size = job
+    model = next(model for model in SearchableMixin.__subclasses__() if model.__tablename__ == alias)
+    fields = model.__searchable__
+    flags = model.__search_filters__
+    rows = db.session.query(model.id, *[getattr(model, field) for field in fields + flags]).filter(
+        model.id >= start, model.id < stop).order_by(model.id).yield_per(batch_size)
+    indexed = 0
+    batch = []
+    for row in rows:
+        document = dict(zip(fields, row[1:]))
+        document.update(zip(flags, map(bool, row[1 + len(fields):])))
+        batch.append(('index', index, row[0], document))
+        if len(batch) == batch_size:
+            bulk_index(batch)
+            keep_building(alias)
+            indexed += len(batch)
+            batch = []
+    bulk_index(batch)
+    return indexed + len(batch)
+
+db.event.listen(db.session, 'after_flush', SearchableMixin.after_flush)
 db.event.listen(db.session, 'after_commit', SearchableMixin.after_commit)
+db.event.listen(db.session, 'after_rollback', SearchableMixin.after_rollback)
 
 followers = db.Table('followers',
     db.Column('follower_id', db.Integer, db.ForeignKey('user.id')),
-    db.Column('followed_id', db.Integer, db.ForeignKey('user.id'))
+    db.Column('followed_id', db.Integer, db.ForeignKey('user.id')),
+    db.Index('ix_followers_follower_id_followed_id', 'follower_id', 'followed_id', unique=True),
+    db.Index('ix_followers_followed_id', 'followed_id')
 )
 
 class User(SearchableMixin, UserMixin, db.Model):
@@ -73,6 +289,9 @@ class User(SearchableMixin, UserMixin, db.Model):
     filter_nsfw = db.Column(db.Boolean, nullable=False, default=False)
     admin_level = db.Column(db.Integer, nullable=False, default=0)
     is_banned = db.Column(db.Boolean, nullable=False, default=False)
+    tweet_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    follower_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    following_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     tweets = db.relationship('Tweet', backref='author', lazy="dynamic")
 
@@ -116,59 +335,195 @@ class User(SearchableMixin, UserMixin, db.Model):
             tweets = tweets.filter_by(is_nsfw=False)
         return tweets
 
+    def home_timeline(self, per_page, before=None, after=None):
+        """Returns the Page of the home timeline around the decoded cursor.
+        Served from the materialized timeline in redis, tweets of followed
+        accounts that are too big to fan out are pulled in at read time. Falls
+        back to followed_posts() past the cached window or if redis is down."""
+        try:
+            entries = self._timeline_entries()
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Error while reading timeline', exc_info=sys.exc_info())
+            entries = None
+        if entries is not None:
+            if after is not None:
+                cursor = (timeline.score(after[0]), after[1])
+                ids = [tweet_id for tweet_id, s in reversed(entries) if (s, tweet_id) > cursor]
+            else:
+                cursor = (timeline.score(before[0]), before[1]) if before is not None else None
+                ids = [tweet_id for tweet_id, s in entries if cursor is None or (s, tweet_id) < cursor]
+            tweets = []
+            for i in range(0, len(ids), per_page + 1):
+                tweets.extend(Tweet.by_ids(ids[i:i + per_page + 1], filter_nsfw=self.filter_nsfw))
+                if len(tweets) > per_page:
+                    break
+            has_more = len(tweets) > per_page
+            if after is not None:
+                return Page(tweets[:per_page][::-1], True, has_more)
+            if has_more or len(entries) < current_app.config['TIMELINE_LENGTH']:
+                return Page(tweets[:per_page], has_more, before is not None)
+        return paginate(self.followed_posts(), Tweet, per_page, before, after)
+
+    def _timeline_entries(self):
+        entries = timeline.read(self.id)
+        if entries is None:
+            entries = self.rebuild_timeline()
+        celebrities = timeline.celebrities()
+        if celebrities:
+            followed = [user_id for (user_id,) in db.session.query(followers.c.followed_id).filter(
+                followers.c.follower_id == self.id, followers.c.followed_id.in_(celebrities))]
+            if followed:
+                pulled = db.session.query(Tweet.id, Tweet.created_utc).filter(Tweet.userid.in_(followed)) \
+                    .order_by(Tweet.created_utc.desc()).limit(current_app.config['TIMELINE_LENGTH'])
+                entries = entries + [(tweet_id, timeline.score(created_utc)) for tweet_id, created_utc in pulled]
+        entries = sorted(dict(entries).items(), key=lambda e: (e[1], e[0]), reverse=True)
+        return entries[:current_app.config['TIMELINE_LENGTH']]
+
+    def rebuild_timeline(self):
+        followed = db.session.query(Tweet.id, Tweet.created_utc).join(
+            followers, (followers.c.followed_id == Tweet.userid)).filter(followers.c.follower_id == self.id)
+        own = db.session.query(Tweet.id, Tweet.created_utc).filter(Tweet.userid == self.id)
+        rows = followed.union(own).order_by(Tweet.created_utc.desc()).limit(current_app.config['TIMELINE_LENGTH'])
+        entries = [(tweet_id, timeline.score(created_utc)) for tweet_id, created_utc in rows]
+        timeline.store(self.id, entries)
+        return entries
+
     def follow(self, user):
-        if not self.is_following(user):
-            self.followed.append(user)
+        """Follows user unless already following, returns whether anything
+        changed. Concurrent calls insert one row, see insert_ignore()."""
+        # Core statements do not autoflush, the ids must be assigned
+        db.session.flush()
+        added = db.session.execute(insert_ignore(followers, follower_id=self.id, followed_id=user.id)).rowcount
+        if added:
+            self.following_count = User.following_count + added
+            user.follower_count = User.follower_count + added
+        return bool(added)
 
     def unfollow(self, user):
-        if self.is_following(user):
-            self.followed.remove(user)
+        db.session.flush()
+        removed = db.session.execute(followers.delete().where(db.and_(
+            followers.c.follower_id == self.id,
+            followers.c.followed_id == user.id))).rowcount
+        if removed:
+            self.following_count = User.following_count - removed
+            user.follower_count = User.follower_count - removed
+        return bool(removed)
 
     def is_following(self, user):
-        return self.followed.filter(followers.c.followed_id == user.id).count() > 0
+        return db.session.query(self.followed.filter(followers.c.followed_id == user.id).exists()).scalar()
+
+    def followed_ids(self, user_ids):
+        if not user_ids:
+            return set()
+        return {user_id for (user_id,) in db.session.query(followers.c.followed_id).filter(
+            followers.c.follower_id == self.id, followers.c.followed_id.in_(user_ids))}
 
     def get_reset_token(self, expires_sec=900):
         s = Serializer(current_app.config['SECRET_KEY'], expires_sec)
         return s.dumps({'user_id': self.id}).decode('utf-8')
 
     def like_tweet(self, tweet):
-        if not self.has_liked_tweet(tweet):
-            l = Like(userid=self.id, tweetid=tweet.id)
-            db.session.add(l)
+        """Likes tweet unless already liked, returns whether anything changed."""
+        db.session.flush()
+        added = db.session.execute(insert_ignore(Like.__table__, userid=self.id, tweetid=tweet.id)).rowcount
+        if added:
+            tweet.like_count = Tweet.like_count + added
+        return bool(added)
 
     def unlike_tweet(self, tweet):
-        if self.has_liked_tweet(tweet):
-            Like.query.filter(
-                Like.userid==self.id,
-                Like.tweetid==tweet.id).delete()
+        db.session.flush()
+        removed = Like.query.filter(
+            Like.userid==self.id,
+            Like.tweetid==tweet.id).delete()
+        if removed:
+            tweet.like_count = Tweet.like_count - removed
+        return bool(removed)
 
     def has_liked_tweet(self, tweet):
-        return Like.query.filter(
+        return db.session.query(Like.query.filter(
             Like.userid==self.id,
-            Like.tweetid==tweet.id).count() > 0
+            Like.tweetid==tweet.id).exists()).scalar()
 
     def new_messages(self):
+        return self.unread_counts()['messages']
+
+    def new_notifs(self):
+        return self.unread_counts()['notifs']
+
+    def count_new_messages(self):
         last_read_time = self.last_message_read_time or datetime(1900, 1, 1)
         return Message.query.filter_by(recipient=self).filter(Message.created_utc > last_read_time).count()
 
-    def new_notifs(self):
+    def count_new_notifs(self):
         last_read_time = self.last_notifs_read_time or datetime(1900, 1, 1)
         return Comment.query.filter_by(recipient=self).filter(Comment.created_utc > last_read_time, Comment.commenter_id != self.id).count()
 
+    def unread_counts(self):
+        """Returns the unread message and notification counts from the redis
+        counter cache, recounting them from the database if it is missing."""
+        key = 'unread:{}'.format(self.id)
+        try:
+            counts = current_app.redis.hgetall(key)
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Error while reading unread counts', exc_info=sys.exc_info())
+            return {'messages': self.count_new_messages(), 'notifs': self.count_new_notifs()}
+        if b'messages' in counts and b'notifs' in counts:
+            return {'messages': int(counts[b'messages']), 'notifs': int(counts[b'notifs'])}
+        counts = {'messages': self.count_new_messages(), 'notifs': self.count_new_notifs()}
+        try:
+            pipe = current_app.redis.pipeline()
+            pipe.hset(key, mapping=counts)
+            pipe.expire(key, current_app.config['UNREAD_TTL'])
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Error while storing unread counts', exc_info=sys.exc_info())
+        return counts
+
+    def incr_unread(self, name):
+        try:
+            current_app.redis.hincrby('unread:{}'.format(self.id), name, 1)
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Error while updating unread counts', exc_info=sys.exc_info())
+
+    def reset_unread(self, name):
+        try:
+            current_app.redis.hset('unread:{}'.format(self.id), name, 0)
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Error while updating unread counts', exc_info=sys.exc_info())
+
     def add_notification(self, name, data):
         self.notifications.filter_by(name=name).delete()
-        n = Notification(name=name, payload_json=json.dumps(data), user=self)
+        n = Notification(name=name, payload_json=json.dumps(data), user=self, timestamp=time())
         db.session.add(n)
+        db.session.info.setdefault('notifications', []).append(
+            (self.id, n, {'name': name, 'data': data, 'timestamp': n.timestamp}))
         return n
 
     def launch_task(self, name, description, *args, **kwargs):
         rq_job = current_app.task_queue.enqueue('src.tasks.' + name, self.id, *args, **kwargs)
         task = Task(id=rq_job.get_id(), name=name, description=description, user=self)
         db.session.add(task)
+        try:
+            pipe = current_app.redis.pipeline()
+            pipe.hset(Task.progress_key(self.id), mapping={task.id: 0, task.id + ':description': description})
+            pipe.expire(Task.progress_key(self.id), current_app.config['TASK_PROGRESS_TTL'])
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Error while storing task progress', exc_info=sys.exc_info())
         return task
 
     def get_tasks_in_progress(self):
-        return Task.query.filter_by(user=self, complete=False).all()
+        """Returns the running tasks of this user as TaskProgress, read from
+        the redis hash their workers report progress to."""
+        try:
+            fields = current_app.redis.hgetall(Task.progress_key(self.id))
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Error while reading task progress', exc_info=sys.exc_info())
+            return [TaskProgress(task.id, task.description, 0)
+                for task in Task.query.filter_by(user=self, complete=False)]
+        fields = {field.decode(): value.decode() for field, value in fields.items()}
+        return sorted(TaskProgress(field, fields[field + ':description'], int(value))
+            for field, value in fields.items() if field + ':description' in fields)
 
     def get_task_in_progress(self, name):
         return Task.query.filter_by(name=name, user=self, complete=False).all()
@@ -186,10 +541,12 @@ class User(SearchableMixin, UserMixin, db.Model):
         return '<User {}>'.format(self.username)
 
 class Tweet(SearchableMixin, db.Model):
-    __searchable__ = ['textbody']
+    __searchable__ = ['textbody_source']
+    __search_filters__ = ['is_nsfw']
+    __table_args__ = (db.Index('ix_tweet_userid_created_utc', 'userid', 'created_utc'),)
 
     id = db.Column(db.Integer, primary_key=True)
-    identifier = db.Column(db.String(32), nullable=False)
+    identifier = db.Column(db.String(32), nullable=False, unique=True, index=True)
     textbody_source = db.Column(db.String(500), nullable=False)
     textbody_markdown = db.Column(db.Text(), nullable=False)
     userid = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
@@ -201,64 +558,264 @@ class Tweet(SearchableMixin, db.Model):
     is_nsfw = db.Column(db.Boolean, default=False)
     is_edited = db.Column(db.Boolean, default=False)
     comment_path_counter = db.Column(db.Integer, default=1, autoincrement=True)
+    like_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    comment_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    render_version = db.Column(db.Integer)
 
     likes = db.relationship('Like', backref='tweet', lazy='dynamic')
 
+    @classmethod
+    def by_ids(cls, ids, filter_nsfw=False):
+        if not ids:
+            return []
+        tweets = cls.query.filter(cls.id.in_(ids))
+        if filter_nsfw:
+            tweets = tweets.filter_by(is_nsfw=False)
+        order = {tweet_id: i for i, tweet_id in enumerate(ids)}
+        return sorted(tweets, key=lambda tweet: order[tweet.id])
+
+    def set_textbody(self, source):
+        self.textbody_source = source
+        self.textbody_markdown = markup.render(source)
+        self.render_version = markup.VERSION
+
+    @classmethod
+    def rerender(cls, workers=4, batch_size=500):
+        """Renders every tweet made by an older version of the markup pipeline
+        again, streaming batches of rows through worker processes. A tweet
+        edited in the meantime is left alone. Returns the number of tweets
+        rendered and the throughput in tweets/sec."""
+        table = cls.__table__
+        stale = db.or_(cls.render_version == None, cls.render_version != markup.VERSION)
+        update = table.update().where(db.and_(stale,
+            table.c.id == db.bindparam('_id'), table.c.textbody_source == db.bindparam('_source'))).values(
+            textbody_markdown=db.bindparam('_html'), render_version=markup.VERSION)
+
+        def batches():
+            last = 0
+            while True:
+                rows = db.session.query(cls.id, cls.textbody_source).filter(
+                    stale, cls.id > last).order_by(cls.id).limit(batch_size).all()
+                if not rows:
+                    return
+                last = rows[-1][0]
+                yield rows
+
+        def save(rows, html):
+            # Rows edited, deleted or rendered by someone else since are not counted
+            params = [{'_id': id, '_source': source, '_html': body} for (id, source), body in zip(rows, html)]
+            if db.session.get_bind().dialect.supports_sane_multi_rowcount:
+                saved = db.session.execute(update, params).rowcount
+            else:
+                saved = sum(db.session.execute(update, p).rowcount for p in params)
+            db.session.commit()
+            return saved
+
+        rendered = 0
+        started = time()
+        if workers > 1:
+            with ProcessPoolExecutor(workers) as pool:
+                # Keep a few batches in flight, not the whole table
+                pending = deque()
+                for rows in batches():
+                    pending.append((rows, pool.submit(markup.render_many, [source for _, source in rows])))
+                    if len(pending) > workers * 2:
+                        rows, future = pending.popleft()
+                        rendered += save(rows, future.result())
+                for rows, future in pending:
+                    rendered += save(rows, future.result())
+        else:
+            for rows in batches():
+                rendered += save(rows, markup.render_many([source for _, source in rows]))
+        elapsed = time() - started
+        return rendered, rendered / elapsed if elapsed else 0
+
+    def fan_out(self):
+        """Pushes the tweet into the materialized timelines of its author and
+        followers. Authors with more than TIMELINE_FANOUT_LIMIT followers are
+        only marked, their tweets get pulled in when a timeline is read."""
+        is_celebrity = self.author.follower_count > current_app.config['TIMELINE_FANOUT_LIMIT']
+        user_ids = [self.userid]
+        if not is_celebrity:
+            user_ids += [user_id for (user_id,) in db.session.query(followers.c.follower_id).filter(
+                followers.c.followed_id == self.userid)]
+        try:
+            timeline.set_celebrity(self.userid, is_celebrity)
+            timeline.fan_out(user_ids, self.id, timeline.score(self.created_utc))
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Error while fanning out tweet', exc_info=sys.exc_info())
+
+    def schedule_fan_out(self):
+        """Puts a new tweet into the timeline of its author right away and
+        leaves the followers to a background job, so posting does not wait
+        on thousands of writes."""
+        try:
+            timeline.fan_out([self.userid], self.id, timeline.score(self.created_utc))
+            current_app.task_queue.enqueue('src.tasks.fan_out', self.id)
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Error while scheduling fan out', exc_info=sys.exc_info())
+
     @classmethod
     def get_identifier(cls):
-        while True:
-            ident = secrets.token_hex(nbytes=16)
-            if not cls.query.filter_by(identifier=ident).first():
-                return ident
+        return identifiers.generate()
 
     def __repr__(self):
         return '<Tweet {}>'.format(self.id)
 
+@db.event.listens_for(Tweet, 'after_insert')
+def count_tweet(mapper, connection, tweet):
+    connection.execute(User.__table__.update().where(User.id == tweet.userid).values(
+        tweet_count=User.tweet_count + 1))
+
+def insert_ignore(table, **values):
+    """Returns an INSERT of values into table that does nothing when it would
+    violate a unique constraint, so its rowcount tells whether a row was
+    added without checking first. Without values it can be executed with a
+    list of rows."""
+    insert = table.insert().values(**values) if values else table.insert()
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'postgresql':
+        insert = postgresql.insert(table)
+        return (insert.values(**values) if values else insert).on_conflict_do_nothing()
+    if dialect == 'sqlite':
+        return insert.prefix_with('OR IGNORE')
+    if dialect == 'mysql':
+        return insert.prefix_with('IGNORE')
+    return insert
+
 class Like(db.Model):
+    __table_args__ = (db.Index('ix_like_userid_tweetid', 'userid', 'tweetid', unique=True),)
+
     id = db.Column(db.Integer, primary_key=True)
     userid = db.Column(db.Integer, db.ForeignKey('user.id'))
-    tweetid = db.Column(db.Integer, db.ForeignKey('tweet.id'))
+    tweetid = db.Column(db.Integer, db.ForeignKey('tweet.id'), index=True)
 
     def __repr__(self):
         return '<Like {},{}>'.format(self.userid, self.tweetid)
 
 class Comment(db.Model):
     _N = 6
+    __table_args__ = (
+        db.Index('ix_comment_tweet_id_path', 'tweet_id', 'path'),
+        db.Index('ix_comment_author_id_created_utc', 'author_id', 'created_utc'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
-    identifier = db.Column(db.String(64), nullable=False)
+    identifier = db.Column(db.String(64), nullable=False, unique=True, index=True)
     tweet_id = db.Column(db.Integer, db.ForeignKey('tweet.id'), nullable=False)
     author_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) # author of post
     commenter_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False) # author of comment
     textbody = db.Column(db.String(400), nullable=False)
     created_utc = db.Column(db.DateTime, index=True, default=datetime.utcnow)
-    path = db.Column(db.Text, index=True)
-    parent_id = db.Column(db.Integer, db.ForeignKey('comment.id'))
+    path = db.Column(db.Text)
+    parent_id = db.Column(db.Integer, db.ForeignKey('comment.id'), index=True)
     replies = db.relationship('Comment', backref=db.backref('parent', remote_side=[id]),
         lazy='dynamic')
+    reply_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     def save(self):
+        """Adds the comment and notifies its recipient in a single
+        transaction. The path counter of the tweet is incremented by the
+        database, which keeps the tweet row locked until commit, so concurrent
+        comments never get the same path."""
+        notify = self.author.id != self.recipient.id
+        if notify:
+            # Read before the comment is flushed, a recount would include it
+            with db.session.no_autoflush:
+                unread = self.recipient.new_notifs() + 1
         db.session.add(self)
-        db.session.commit()
+        counter = Tweet.__table__.c.comment_path_counter
+        increment = Tweet.__table__.update().where(Tweet.__table__.c.id == self.tweet.id).values(
+            comment_path_counter=db.func.coalesce(counter, 1) + 1,
+            comment_count=Tweet.__table__.c.comment_count + 1)
+        if db.session.get_bind().dialect.name == 'postgresql':
+            n = db.session.execute(increment.returning(counter)).scalar()
+        else:
+            db.session.execute(increment)
+            n = db.session.execute(db.select([counter]).where(Tweet.__table__.c.id == self.tweet.id)).scalar()
         prefix = self.parent.path + '.' if self.parent else ''
-        self.tweet.comment_path_counter += 1
-        self.path = prefix + '{:0{}d}'.format(self.tweet.comment_path_counter, self._N)
+        self.path = prefix + self.path_segment(n)
+        if self.parent:
+            self.parent.reply_count = Comment.reply_count + 1
+        if notify:
+            self.recipient.add_notification('unread_notifs_count', unread)
         db.session.commit()
+        if notify:
+            self.recipient.incr_unread('notifs')
+
+    @classmethod
+    def path_segment(cls, n):
+        """Formats n as a path segment of _N digits. Larger numbers get ':' and
+        their number of digits as one base 36 digit in front, which sorts them
+        after every _N digit segment and after all shorter numbers, so paths
+        stay in order."""
+        digits = str(n)
+        if len(digits) <= cls._N:
+            return digits.zfill(cls._N)
+        return ':{}{}'.format('0123456789abcdefghijklmnopqrstuvwxyz'[len(digits)], digits)
 
     def level(self):
         return len(self.path)
 
+    @property
+    def depth(self):
+        return self.path.count('.')
+
+    @classmethod
+    def thread(cls, tweet, root=None, after=None, per_page=50, depth=None):
+        """Loads a window of the comment tree of tweet, or of the replies below
+        root, with one range query over path, which orders a tree depth first.
+        Comments more than depth levels down and the ones up to the path cursor
+        after are left out, except for the ancestors of the window, which are
+        marked .continued. Returns the top-level comments of the window with
+        their replies nested in .children, and the cursor of the next window."""
+        query = cls.query.filter(cls.tweet_id == tweet.id, cls.path != None)
+        levels = 0
+        if root is not None:
+            # '/' sorts right after '.', so this range is exactly the subtree of root
+            query = query.filter(cls.path > root.path + '.', cls.path < root.path + '/')
+            levels = root.depth + 1
+        if after:
+            query = query.filter(cls.path > after)
+        if depth is not None:
+            dots = db.func.length(cls.path) - db.func.length(db.func.replace(cls.path, '.', ''))
+            query = query.filter(dots < levels + depth)
+        comments = query.options(db.joinedload(cls.author)).order_by(cls.path).limit(per_page + 1).all()
+        next_cursor = comments[per_page - 1].path if len(comments) > per_page else None
+        window = comments[:per_page]
+        for comment in window:
+            comment.continued = False
+        if after and window:
+            # Replies whose parent is on an earlier page are nested under it
+            # again. Depth first order makes all such parents ancestors of the
+            # first comment of the window.
+            segments = window[0].path.split('.')
+            paths = ['.'.join(segments[:n]) for n in range(levels + 1, len(segments))]
+            if paths:
+                ancestors = cls.query.filter(cls.tweet_id == tweet.id, cls.path.in_(paths)).options(
+                    db.joinedload(cls.author)).order_by(cls.path).all()
+                for comment in ancestors:
+                    comment.continued = True
+                window = ancestors + window
+        roots = []
+        by_path = {}
+        for comment in window:
+            comment.children = []
+            by_path[comment.path] = comment
+            parent = by_path.get(comment.path.rpartition('.')[0])
+            (parent.children if parent else roots).append(comment)
+        return roots, next_cursor
+
     @classmethod
     def get_identifier(cls):
-        while True:
-            ident = secrets.token_hex(nbytes=32)
-            if not cls.query.filter_by(identifier=ident).first():
-                return ident
+        return identifiers.generate()
 
     def __repr__(self):
         return '<Comment {}>'.format(self.id)
 
 class Message(db.Model):
+    __table_args__ = (db.Index('ix_message_recipient_id_created_utc', 'recipient_id', 'created_utc'),)
+
     id = db.Column(db.Integer, primary_key=True)
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     recipient_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -269,6 +826,8 @@ class Message(db.Model):
         return '<Message {}>'.format(self.body)
 
 class Notification(db.Model):
+    __table_args__ = (db.Index('ix_notification_user_id_timestamp', 'user_id', 'timestamp'),)
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128), index=True)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
@@ -278,20 +837,148 @@ class Notification(db.Model):
     def get_data(self):
         return json.loads(str(self.payload_json))
 
+    @staticmethod
+    def channel(user_id):
+        return 'notifications:{}'.format(user_id)
+
+    def get_payload(self):
+        """Returns the notification as streams get it. The id orders streams
+        and resumes them, the timestamp is taken before commit and can be out
+        of order across processes."""
+        return {'id': self.id, 'name': self.name, 'data': self.get_data(), 'timestamp': self.timestamp}
+
+    @staticmethod
+    def after_commit(session):
+        for user_id, n, payload in session.info.pop('notifications', []):
+            # The identity is kept when a commit expires the attributes
+            identity = db.inspect(n).identity
+            payload['id'] = identity[0] if identity else None
+            try:
+                current_app.redis.publish(Notification.channel(user_id), json.dumps(payload))
+            except redis.exceptions.RedisError:
+                current_app.logger.error('Error while publishing notification', exc_info=sys.exc_info())
+
+    @staticmethod
+    def after_rollback(session):
+        session.info.pop('notifications', None)
+
+db.event.listen(db.session, 'after_commit', Notification.after_commit)
+db.event.listen(db.session, 'after_rollback', Notification.after_rollback)
+
+class SearchOutbox(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    index = db.Column(db.String(64), nullable=False)
+    doc_id = db.Column(db.Integer, nullable=False)
+    op = db.Column(db.String(6), nullable=False)
+    created_utc = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @staticmethod
+    def schedule_drain():
+        try:
+            if current_app.redis.set('search-outbox:scheduled', 1, nx=True, ex=60):
+                current_app.task_queue.enqueue('src.tasks.drain_search_outbox',
+                    retry=rq.Retry(max=5, interval=[1, 5, 30, 60, 300]))
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Error while scheduling search outbox drain', exc_info=sys.exc_info())
+
+    @classmethod
+    def drain(cls, batch_size=500):
+        """Applies the outbox to the search index in bulk, oldest first. Repeated
+        changes to a document are coalesced into its current state. Entries
+        are only removed once the index accepted them. Returns the number of
+        entries drained."""
+        models = {model.__tablename__: model for model in SearchableMixin.__subclasses__()}
+        drained = 0
+        while True:
+            entries = cls.query.order_by(cls.id).limit(batch_size).all()
+            if not entries:
+                return drained
+            ids = {}
+            for entry in entries:
+                ids.setdefault(entry.index, set()).add(entry.doc_id)
+            operations = []
+            for index, doc_ids in ids.items():
+                found = {obj.id: obj for obj in models[index].query.filter(models[index].id.in_(doc_ids))}
+                for doc_id in sorted(doc_ids):
+                    obj = found.get(doc_id)
+                    if obj is None:
+                        operations.append(('delete', index, doc_id, None))
+                    else:
+                        operations.append(('index', index, doc_id, obj.search_document()))
+            bulk_index(operations)
+            cls.query.filter(cls.id.in_([entry.id for entry in entries])).delete(synchronize_session=False)
+            db.session.commit()
+            drained += len(entries)
+
+    @classmethod
+    def stats(cls):
+        """Returns the queue depth and how far behind, in seconds, the search
+        index is."""
+        depth, oldest = db.session.query(db.func.count(cls.id), db.func.min(cls.created_utc)).one()
+        lag = (datetime.utcnow() - oldest).total_seconds() if oldest else 0
+        return {'depth': depth, 'lag': lag}
+
 class Task(db.Model):
     id = db.Column(db.String(36), primary_key=True)
     name = db.Column(db.String(128), index=True)
     description = db.Column(db.String(128))
-    user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), index=True)
     complete = db.Column(db.Boolean, default=False)
 
-    def get_rq_job(self):
-        try:
-            rq_job = rq.job.Job.fetch(self.id, connection=current_app.redis)
-        except (redis.exceptions.RedisError, rq.exceptions.NoSuchJobError):
-            return None
-        return rq_job
+    @staticmethod
+    def progress_key(user_id):
+        return 'tasks:{}'.format(user_id)
 
-    def get_progress(self):
-        job = self.get_rq_job()
-        return job.meta.get('progress', 0) if job is not None else 100
+    @staticmethod
+    def report_progress(task_id, user_id, progress, error=None):
+        """Stores the progress of a running task in redis and pushes it to the
+        user. Only a finished task touches the database, to mark it complete.
+        A task that failed reports 100 with the error to show."""
+        key = Task.progress_key(user_id)
+        data = {'task_id': task_id, 'progress': int(progress)}
+        if error:
+            data['error'] = error
+        payload = {'id': None, 'name': 'task_progress', 'data': data, 'timestamp': time()}
+        try:
+            pipe = current_app.redis.pipeline()
+            if progress >= 100:
+                pipe.hdel(key, task_id, task_id + ':description')
+            else:
+                pipe.hset(key, task_id, int(progress))
+                pipe.expire(key, current_app.config['TASK_PROGRESS_TTL'])
+            pipe.publish(Notification.channel(user_id), json.dumps(payload))
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Error while storing task progress', exc_info=sys.exc_info())
+        if progress >= 100:
+            Task.query.filter_by(id=task_id).update({'complete': True})
+            db.session.commit()
+
+TaskProgress = namedtuple('TaskProgress', ['id', 'description', 'progress'])
+
+def reconcile_counters(fix=True):
+    """Compares the denormalized counters with the rows they count and, if
+    fix is set, recounts every drifted one. Returns the number of drifted
+    counters."""
+    counters = [
+        (Tweet, Tweet.like_count, Like.tweetid),
+        (Tweet, Tweet.comment_count, Comment.tweet_id),
+        (Comment, Comment.reply_count, Comment.parent_id),
+        (User, User.tweet_count, Tweet.userid),
+        (User, User.follower_count, followers.c.followed_id),
+        (User, User.following_count, followers.c.follower_id),
+    ]
+    drifted = 0
+    for model, counter, key in counters:
+        actual = db.session.query(key.label('id'), db.func.count().label('n')).group_by(key).subquery()
+        n = db.func.coalesce(actual.c.n, 0)
+        rows = db.session.query(model.id, counter, n).outerjoin(actual, actual.c.id == model.id).filter(counter != n).all()
+        for id, stored, counted in rows:
+            current_app.logger.warning('{}.{} of {} is {}, counted {}'.format(
+                model.__name__, counter.key, id, stored, counted))
+            if fix:
+                recount = db.select([db.func.count()]).where(key == id).as_scalar()
+                model.query.filter(model.id == id).update({counter: recount}, synchronize_session=False)
+        drifted += len(rows)
+    db.session.commit()
+    return drifted
@@ -0,0 +1,69 @@
+from flask import abort
+from sqlalchemy import tuple_
+from datetime import datetime
+import base64
+import json
+
+class Page(object):
+    """A page of a listing ordered by (created_utc, id), newest first. Pages
+    are addressed by opaque cursors instead of page numbers, so no OFFSET
+    scan or COUNT(*) is needed to get any page."""
+
+    def __init__(self, items, has_next, has_prev):
+        self.items = items
+        self.has_next = has_next
+        self.has_prev = has_prev
+
+    @property
+    def next_cursor(self):
+        return encode_cursor(self.items[-1]) if self.has_next and self.items else None
+
+    @property
+    def prev_cursor(self):
+        return encode_cursor(self.items[0]) if self.has_prev and self.items else None
+
+def encode_cursor(item):
+    raw = '{}|{}'.format(item.created_utc.isoformat(), item.id)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_cursor(token):
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8')
+        created_utc, id = raw.split('|')
+        return datetime.fromisoformat(created_utc), int(id)
+    except (ValueError, UnicodeDecodeError):
+        abort(400)
+
+def paginate(query, model, per_page, before=None, after=None):
+    """Returns the page of query right before (older than) or right after
+    (newer than) the decoded cursor, or the newest page without a cursor."""
+    key = tuple_(model.created_utc, model.id)
+    query = query.order_by(None)
+    if after is not None:
+        items = query.filter(key > tuple_(*after)).order_by(
+            model.created_utc.asc(), model.id.asc()).limit(per_page + 1).all()
+        has_prev = len(items) > per_page
+        return Page(items[:per_page][::-1], True, has_prev)
+    if before is not None:
+        query = query.filter(key < tuple_(*before))
+    items = query.order_by(model.created_utc.desc(), model.id.desc()).limit(per_page + 1).all()
+    return Page(items[:per_page], len(items) > per_page, before is not None)
+
+def encode_search_cursor(after):
+    """Encodes the search_after cursors of several searches, by index name."""
+    raw = json.dumps(after, separators=(',', ':'), sort_keys=True)
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_search_cursor(token):
+    if not token:
+        return {}
+    try:
+        after = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8'))
+        if not isinstance(after, dict) or not all(value is None or (isinstance(value, list) and len(value) == 2
+                and all(isinstance(key, (int, float)) for key in value)) for value in after.values()):
+            raise ValueError(token)
+        return after
+    except (ValueError, UnicodeDecodeError):
+        abort(400)
@@ -0,0 +1,87 @@
+from flask import current_app
+from concurrent.futures import ProcessPoolExecutor, TimeoutError
+from concurrent.futures.process import BrokenProcessPool
+import bcrypt
+import os
+import threading
+
+# Hashing takes hundreds of milliseconds of CPU, so it runs in a pool of
+# PASSWORD_WORKERS processes instead of the request thread. At most
+# PASSWORD_QUEUE_DEPTH hashes wait or run at once per process, past that
+# callers get Saturated right away instead of queueing behind a login storm.
+# A slot is held until its hash is done, also when the caller stopped waiting.
+
+class Saturated(Exception):
+    pass
+
+def _hash(password, rounds):
+    return bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(rounds)).decode('utf-8')
+
+def _check(hashed, password):
+    try:
+        return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
+    except ValueError:
+        # Not a bcrypt hash
+        return False
+
+class Pool(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.executor = None
+        self.slots = None
+
+    def run(self, fn, *args):
+        config = current_app.config
+        if not config['PASSWORD_WORKERS']:
+            return fn(*args)
+        with self.lock:
+            if self.pid != os.getpid():
+                # A forked worker gets its own pool, the parent's processes are not its children
+                self.pid = os.getpid()
+                self.executor = ProcessPoolExecutor(config['PASSWORD_WORKERS'])
+                self.slots = threading.BoundedSemaphore(config['PASSWORD_QUEUE_DEPTH'])
+            executor, slots = self.executor, self.slots
+        if not slots.acquire(blocking=False):
+            raise Saturated()
+        try:
+            future = executor.submit(fn, *args)
+        except BrokenProcessPool:
+            slots.release()
+            self.restart(executor)
+            raise Saturated()
+        future.add_done_callback(lambda future: slots.release())
+        try:
+            return future.result(timeout=config['PASSWORD_TIMEOUT'])
+        except TimeoutError:
+            # Only drops it if it has not started, a running hash keeps its slot
+            future.cancel()
+            raise Saturated()
+        except BrokenProcessPool:
+            self.restart(executor)
+            raise Saturated()
+
+    def restart(self, executor):
+        """Replaces executor after one of its processes died, unless another
+        thread already did."""
+        with self.lock:
+            if self.executor is not executor:
+                return
+            self.executor = ProcessPoolExecutor(current_app.config['PASSWORD_WORKERS'])
+        executor.shutdown(wait=False)
+
+_pool = Pool()
+
+def generate(password):
+    """Returns the bcrypt hash of password with BCRYPT_LOG_ROUNDS rounds."""
+    return _pool.run(_hash, password, current_app.config['BCRYPT_LOG_ROUNDS'])
+
+def check(hashed, password):
+    return _pool.run(_check, hashed, password)
+
+def needs_rehash(hashed):
+    """Whether hashed was made with another cost than BCRYPT_LOG_ROUNDS."""
+    try:
+        return int(hashed.split('$')[2]) != current_app.config['BCRYPT_LOG_ROUNDS']
+    except (IndexError, ValueError):
+        return True
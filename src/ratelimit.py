@@ -0,0 +1,56 @@
+from flask import current_app, jsonify
+from flask_login import current_user
+from functools import wraps
+import redis
+import sys
+import time
+
+# Token bucket in a hash: refills rate tokens per second up to burst and
+# takes one per request. Returns whether the request is allowed and, if not,
+# the seconds until the next token.
+_TAKE = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(bucket[1]) or burst
+local ts = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'ts', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return {allowed, tostring((1 - tokens) / rate)}
+"""
+
+def take(name, key):
+    """Takes a token from the bucket of key for the RATE_LIMITS entry name.
+    Returns None if allowed, else the seconds to wait. Allows everything
+    when redis is down."""
+    rate, burst = current_app.config['RATE_LIMITS'][name]
+    try:
+        allowed, wait = current_app.redis.eval(_TAKE, 1, 'ratelimit:{}:{}'.format(name, key), rate, burst, time.time())
+    except redis.exceptions.RedisError:
+        current_app.logger.error('Error while rate limiting', exc_info=sys.exc_info())
+        return None
+    return None if allowed else float(wait)
+
+def limit(name):
+    """Rate limits a JSON view per logged in user, answering 429 when the
+    bucket is empty."""
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if current_user.is_authenticated:
+                wait = take(name, current_user.id)
+                if wait is not None:
+                    response = jsonify({"statuscode": -1, "status": "Too many requests"})
+                    response.status_code = 429
+                    response.headers['Retry-After'] = str(max(1, int(wait + 0.999)))
+                    return response
+            return f(*args, **kwargs)
+        return wrapper
+    return decorator
@@ -1,24 +1,295 @@
 from flask import current_app
+from elasticsearch import helpers
+from elasticsearch.helpers import BulkIndexError
+from collections import namedtuple
+from time import time
+import hashlib
+import json
+import re
+import redis
+import sqlite3
+import sys
+import threading
 
-def add_to_index(index, model):
-    if not current_app.elasticsearch:
-        return
-    payload = {}
-    for field in model.__searchable__:
-        payload[field] = getattr(model, field)
-    current_app.elasticsearch.index(index=index, id=model.id, body=payload)
+class ElasticsearchBackend(object):
+    def __init__(self, client):
+        self.client = client
+
+    def multi_query(self, searches):
+        body = []
+        for search in searches:
+            query = {'bool': {
+                'must': {'multi_match': {'query': search.query, 'fields': ['*'], 'lenient': True}},
+                'filter': [{'term': {field: value}} for field, value in sorted(search.filters.items())],
+                'must_not': [{'ids': {'values': [str(id) for id in search.exclude]}}]}}
+            request = {'query': query, 'size': search.per_page + 1,
+                'sort': [{'_score': 'desc'}, {'id': 'asc'}]}
+            if search.after:
+                request['search_after'] = search.after
+            body += [{'index': search.index}, request]
+        results = []
+        for search, response in zip(searches, self.client.msearch(body=body)['responses']):
+            if 'error' in response:
+                current_app.logger.error('Error while searching {}: {}'.format(search.index, response['error']))
+                results.append(None)
+                continue
+            hits = [(int(hit['_id']), hit['sort']) for hit in response['hits']['hits']]
+            results.append((hits, response['hits']['total']['value']))
+        return results
+
+    def bulk(self, operations):
+        actions = []
+        for op, index, id, payload in operations:
+            action = {'_op_type': op, '_index': index, '_id': id}
+            if op == 'index':
+                # id is copied into the document as a sort tiebreaker, sorting on _id is deprecated
+                action['_source'] = dict(payload, id=id)
+            actions.append(action)
+        _, errors = helpers.bulk(self.client, actions, raise_on_error=False)
+        # Deleting a document that was never indexed is not an error
+        errors = [error for error in errors if error.get('delete', {}).get('status') != 404]
+        if errors:
+            raise BulkIndexError('{} document(s) failed to index'.format(len(errors)), errors)
+
+    def create(self, index, fields=(), flags=()):
+        self.client.indices.create(index=index, body={'settings': {'refresh_interval': '-1'}})
+
+    def swap(self, alias, index):
+        indices = self.client.indices
+        indices.put_settings(index=index, body={'index': {'refresh_interval': None}})
+        indices.refresh(index=index)
+        actions = [{'add': {'index': index, 'alias': alias}}]
+        old = []
+        if indices.exists_alias(name=alias):
+            old = list(indices.get_alias(name=alias))
+            actions += [{'remove': {'index': name, 'alias': alias}} for name in old]
+        elif indices.exists(index=alias):
+            # An index created before aliases were used
+            actions.append({'remove_index': {'index': alias}})
+        indices.update_aliases(body={'actions': actions})
+        for name in old:
+            indices.delete(index=name)
+
+    def drop(self, index):
+        self.client.indices.delete(index=index, ignore=[404])
+
+class SQLiteBackend(object):
+    """Embedded full-text search on SQLite FTS5, used when ELASTICSEARCH_URL is
+    not set. Every index is an FTS5 table keyed by rowid = document id and
+    ranked with bm25. Aliases map index names to the table currently serving
+    them, so rebuilds can be swapped in like with elasticsearch."""
+
+    def __init__(self, path, max_hits=1000):
+        self.path = path
+        self.max_hits = max_hits
+        self.local = threading.local()
+
+    @property
+    def db(self):
+        if getattr(self.local, 'db', None) is None:
+            db = sqlite3.connect(self.path, timeout=30)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            db.execute('CREATE TABLE IF NOT EXISTS aliases (alias TEXT PRIMARY KEY, name TEXT NOT NULL)')
+            self.local.db = db
+        return self.local.db
+
+    def _table(self, index):
+        row = self.db.execute('SELECT name FROM aliases WHERE alias = ?', (index,)).fetchone()
+        return row[0] if row else index
+
+    def _exists(self, name):
+        return self.db.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (name,)).fetchone() is not None
+
+    def multi_query(self, searches):
+        results = []
+        for search in searches:
+            try:
+                results.append(self._query(search))
+            except sqlite3.Error:
+                current_app.logger.error('Error while searching {}'.format(search.index), exc_info=sys.exc_info())
+                results.append(None)
+        return results
+
+    def _query(self, search):
+        table = self._table(search.index)
+        # Match any of the words, like elasticsearch's multi_match does
+        terms = ' OR '.join('"{}"'.format(word) for word in re.findall(r'\w+', search.query))
+        if not terms or not self._exists(table):
+            return [], 0
+        where = ['"{0}" MATCH ?'.format(table)]
+        args = [terms]
+        for field, value in sorted(search.filters.items()):
+            # Not double quoted, SQLite reads a missing column in double quotes as a string
+            where.append('[{}] = ?'.format(field))
+            args.append(value)
+        if search.exclude:
+            where.append('rowid NOT IN ({})'.format(', '.join('?' * len(search.exclude))))
+            args += search.exclude
+        matches = 'FROM "{}" WHERE {}'.format(table, ' AND '.join(where))
+        # Counting stops at max_hits, like elasticsearch stops at
+        # track_total_hits, so common words stay fast. Ranking sees every match.
+        total, = self.db.execute('SELECT count(*) FROM (SELECT rowid {} LIMIT ?)'.format(matches),
+            args + [self.max_hits]).fetchone()
+        if search.after:
+            matches += ' AND (rank > ? OR (rank = ? AND rowid > ?))'
+            args += [search.after[0], search.after[0], search.after[1]]
+        rows = self.db.execute('SELECT rowid, rank {} ORDER BY rank, rowid LIMIT ?'.format(matches),
+            args + [search.per_page + 1]).fetchall()
+        return [(rowid, [rank, rowid]) for rowid, rank in rows], total
 
-def remove_from_index(index, model):
-    if not current_app.elasticsearch:
+    def _create(self, table, fields, flags):
+        # Flags like is_nsfw are stored for filtering, they are not tokenized
+        self.db.execute('CREATE VIRTUAL TABLE IF NOT EXISTS "{}" USING fts5({})'.format(table, ', '.join(
+            field + ' UNINDEXED' if field in flags else field for field in sorted(fields))))
+
+    def bulk(self, operations):
+        with self.db:
+            for op, index, id, payload in operations:
+                table = self._table(index)
+                if op == 'delete':
+                    if self._exists(table):
+                        self.db.execute('DELETE FROM "{}" WHERE rowid = ?'.format(table), (id,))
+                    continue
+                fields = sorted(payload)
+                self._create(table, fields, [field for field in fields if isinstance(payload[field], bool)])
+                self.db.execute('INSERT OR REPLACE INTO "{}" (rowid, {}) VALUES (?{})'.format(
+                    table, ', '.join(fields), ', ?' * len(fields)),
+                    [id] + ['' if payload[field] is None else payload[field] for field in fields])
+
+    def create(self, index, fields=(), flags=()):
+        """Creates the table of an index with the columns its documents have,
+        so an index that stays empty takes them later."""
+        if fields:
+            with self.db:
+                self._create(index, list(fields) + list(flags), flags)
+
+    def swap(self, alias, index):
+        with self.db:
+            old = self._table(alias)
+            self.db.execute('INSERT OR REPLACE INTO aliases (alias, name) VALUES (?, ?)', (alias, index))
+            if old != index and self._exists(old):
+                self.db.execute('DROP TABLE "{}"'.format(old))
+
+    def drop(self, index):
+        with self.db:
+            self.db.execute('DROP TABLE IF EXISTS "{}"'.format(index))
+
+Search = namedtuple('Search', ['index', 'query', 'per_page', 'after', 'filters', 'exclude'])
+Results = namedtuple('Results', ['ids', 'total', 'after', 'has_next'])
+
+def multi_search(searches):
+    """Runs several searches in one round trip to the backend and returns
+    their Results, in order. Each page is cached for SEARCH_CACHE_TTL seconds,
+    so only the searches that missed the cache reach the backend. Searches
+    the backend failed come back empty and uncached. Results.after
+    is the search_after cursor of the next page."""
+    if not current_app.search:
+        return [Results([], 0, None, False) for _ in searches]
+    try:
+        version = int(current_app.redis.get('search-version') or 0)
+        keys = ['search-cache:{}:{}'.format(version,
+            hashlib.sha1(json.dumps(search, sort_keys=True).encode()).hexdigest()) for search in searches]
+        cached = current_app.redis.mget(keys)
+    except redis.exceptions.RedisError:
+        current_app.logger.error('Error while reading search cache', exc_info=sys.exc_info())
+        keys = None
+        cached = [None] * len(searches)
+    results = [Results(*json.loads(value)) if value else None for value in cached]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if not missing:
+        return results
+    responses = current_app.search.multi_query([searches[i] for i in missing])
+    failed = set()
+    for i, response in zip(missing, responses):
+        if response is None:
+            # Failed searches show nothing this time but are not cached
+            failed.add(i)
+            results[i] = Results([], 0, searches[i].after, False)
+            continue
+        hits, total = response
+        hits, has_next = hits[:searches[i].per_page], len(hits) > searches[i].per_page
+        # Past the last page the cursor stays put, so it keeps returning nothing
+        after = list(hits[-1][1]) if hits else searches[i].after
+        results[i] = Results([id for id, _ in hits], total, after, has_next)
+    if keys:
+        try:
+            pipe = current_app.redis.pipeline()
+            for i in missing:
+                if i in failed:
+                    continue
+                pipe.setex(keys[i], current_app.config['SEARCH_CACHE_TTL'], json.dumps(results[i]))
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Error while writing search cache', exc_info=sys.exc_info())
+    return results
+
+def bulk_index(operations):
+    """Applies (op, index, id, payload) operations, op being 'index' or
+    'delete', in one batch. Raises if any of them failed."""
+    if not current_app.search or not operations:
         return
-    current_app.elasticsearch.delete(index=index, id=model.id)
-
-def query_index(index, query, page, per_page):
-    if not current_app.elasticsearch:
-        return [], 0
-    search = current_app.elasticsearch.search(
-        index=index,
-        body={'query': {'multi_match': {'query': query, 'fields': ['*']}},
-            'from': (page - 1) * per_page, 'size': per_page})
-    ids = [int(hit['_id']) for hit in search['hits']['hits']]
-    return ids, search['hits']['total']['value']
+    building = _building_indices({op[1] for op in operations})
+    # Changes made while an index is rebuilt go to both the live and the new index
+    current_app.search.bulk([(op, target, id, payload)
+        for op, index, id, payload in operations
+        for target in filter(None, (index, building.get(index)))])
+    if building:
+        # The rebuild may copy an older version of these documents over them,
+        # finish_build() returns them to be indexed once more
+        try:
+            pipe = current_app.redis.pipeline()
+            for op, index, id, payload in operations:
+                if index in building:
+                    pipe.sadd('search-build-changed:' + index, id)
+            pipe.execute()
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Error while recording index build changes', exc_info=sys.exc_info())
+
+def _building_indices(aliases):
+    try:
+        return {alias: target.decode() for alias, target in
+            ((alias, current_app.redis.get('search-build:' + alias)) for alias in aliases) if target}
+    except redis.exceptions.RedisError:
+        current_app.logger.error('Error while reading index builds', exc_info=sys.exc_info())
+        return {}
+
+def start_build(alias, fields=(), flags=()):
+    """Creates a fresh versioned index to rebuild alias into, for documents
+    with the searchable fields and boolean flags given. With
+    elasticsearch, refreshes are disabled on it until it is swapped in. The
+    build expires after SEARCH_BUILD_TTL seconds unless keep_building() is
+    called, so a rebuild that died does not get changes forever."""
+    index = '{}-{}'.format(alias, int(time() * 1000))
+    current_app.search.create(index, fields, flags)
+    pipe = current_app.redis.pipeline()
+    pipe.delete('search-build-changed:' + alias)
+    pipe.set('search-build:' + alias, index, ex=current_app.config['SEARCH_BUILD_TTL'])
+    pipe.execute()
+    return index
+
+def keep_building(alias):
+    current_app.redis.expire('search-build:' + alias, current_app.config['SEARCH_BUILD_TTL'])
+
+def finish_build(alias, index):
+    """Atomically points alias at index and drops the indices it pointed to
+    before, so searches never see a partial index. Cached search results are
+    invalidated. Returns the ids of the documents changed during the build."""
+    current_app.search.swap(alias, index)
+    pipe = current_app.redis.pipeline()
+    pipe.delete('search-build:' + alias)
+    pipe.smembers('search-build-changed:' + alias)
+    pipe.delete('search-build-changed:' + alias)
+    # Cached results may point at documents the new index no longer has
+    pipe.incr('search-version')
+    _, changed, _, _ = pipe.execute()
+    return sorted(int(id) for id in changed)
+
+def abort_build(alias, index):
+    """Stops sending changes to a failed rebuild and drops its index."""
+    try:
+        pipe = current_app.redis.pipeline()
+        pipe.delete('search-build:' + alias, 'search-build-changed:' + alias)
+        pipe.execute()
+    finally:
+        current_app.search.drop(index)
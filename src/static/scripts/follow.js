@@ -1,30 +1,58 @@
-
 const followBtnAll = document.querySelectorAll('#follow-btn');
 for (let i = 0; i < followBtnAll.length; i++) {
-    followBtnAll[i].addEventListener('click', function(e) {
-        e.preventDefault();
-        postlocation = '/user/follow';
-        let username = e.target.dataset.username;
-        let data = { username : username };
+    let followBtn = followBtnAll[i];
+    // State the server last confirmed and the state last sent to it, clicks
+    // only change what is shown
+    let confirmed = followBtn.value == 'Unfollow';
+    let sent = confirmed;
+    let sending = false;
+    let timer = null;
+
+    function show(following) {
+        followBtn.value = following ? 'Unfollow' : 'Follow';
+    }
 
-        fetch(postlocation, {
+    function failed() {
+        sent = confirmed;
+        show(confirmed);
+        console.log('Error occured');
+    }
+
+    // Sends what is shown unless it was sent already. One request is in
+    // flight at a time, when it returns what is shown is checked again.
+    function sync() {
+        let following = followBtn.value == 'Unfollow';
+        if (sending || following == sent) {
+            return;
+        }
+        sending = true;
+        sent = following;
+        fetch('/user/follow', {
           method: 'POST',
           headers: {
             'Content-Type': 'application/json'
           },
-          body: JSON.stringify(data)
+          body: JSON.stringify({ username: followBtn.dataset.username, following: following })
         })
         .then(response => response.json())
         .then(data => {
           if (data.statuscode == 0) {
-            if (followBtnAll[i].value == 'Follow') {
-                followBtnAll[i].value = 'Unfollow';
-            } else {
-                followBtnAll[i].value = 'Follow';
-            }
+            confirmed = data.following;
           } else {
-            console.log('Error occured');
+            failed();
           }
+        }, failed)
+        .then(() => {
+          sending = false;
+          sync();
         });
+    }
+
+    followBtn.addEventListener('click', function(e) {
+        e.preventDefault();
+        show(followBtn.value == 'Follow');
+        // Rapid clicks collapse into one request with the final state
+        clearTimeout(timer);
+        timer = setTimeout(sync, 400);
     });
 }
@@ -1,34 +1,67 @@
 const likeBtnAll = document.querySelectorAll('#like-btn');
 for (let i = 0; i < likeBtnAll.length; i++) {
-    likeBtnAll[i].addEventListener('click', function(e) {
-        e.preventDefault();
-        postlocation = '/tweet/like';
-        let ident = e.target.dataset.ident;
-        let data = { ident : ident };
+    let likeBtn = likeBtnAll[i];
+    let likeCounter = likeBtn.nextElementSibling;
+    // State the server last confirmed and the state last sent to it, clicks
+    // only change what is shown
+    let confirmed = likeBtn.dataset.liked == 'true';
+    let sent = confirmed;
+    let sending = false;
+    let timer = null;
+
+    function show(liked, likes) {
+        likeBtn.dataset.liked = liked;
+        likeBtn.src = liked ? likeBtn.dataset.likedSrc : likeBtn.dataset.unlikedSrc;
+        likeCounter.innerText = likes;
+    }
+
+    function failed() {
+        sent = confirmed;
+        if (likeBtn.dataset.liked != String(confirmed)) {
+            show(confirmed, Number(likeCounter.innerText) + (confirmed ? 1 : -1));
+        }
+        console.log('Error occured');
+    }
 
-        fetch(postlocation, {
+    // Sends what is shown unless it was sent already. One request is in
+    // flight at a time, when it returns what is shown is checked again.
+    function sync() {
+        let liked = likeBtn.dataset.liked == 'true';
+        if (sending || liked == sent) {
+            return;
+        }
+        sending = true;
+        sent = liked;
+        fetch('/tweet/like', {
           method: 'POST',
           headers: {
             'Content-Type': 'application/json'
           },
-          body: JSON.stringify(data)
+          body: JSON.stringify({ ident: likeBtn.dataset.ident, liked: liked })
         })
         .then(response => response.json())
         .then(data => {
           if (data.statuscode == 0) {
-            likeCounter = likeBtnAll[i].nextElementSibling;
-            likes = likeCounter.innerText;
-            if (data.status == "Unliked") {
-              likes = Number(likes) + 1;
-              likeBtnAll[i].src = '/static/images/liked.svg';
-            } else {
-              likes = Number(likes) - 1;
-              likeBtnAll[i].src = '/static/images/unliked.svg';
+            confirmed = data.liked;
+            if (likeBtn.dataset.liked == String(data.liked)) {
+              show(data.liked, data.like_count);
             }
-            likeCounter.innerText = likes;
           } else {
-            console.log('Error occured');
+            failed();
           }
+        }, failed)
+        .then(() => {
+          sending = false;
+          sync();
         });
+    }
+
+    likeBtn.addEventListener('click', function(e) {
+        e.preventDefault();
+        let liked = likeBtn.dataset.liked != 'true';
+        show(liked, Number(likeCounter.innerText) + (liked ? 1 : -1));
+        // Rapid clicks collapse into one request with the final state
+        clearTimeout(timer);
+        timer = setTimeout(sync, 400);
     });
 }
@@ -1,52 +1,106 @@
-from src import create_app, db
-from src.models import User, Tweet, Task
+from flask import url_for
+from src import create_app, db, exports, images, likes
+from src.models import User, Tweet, Task, SearchOutbox, reconcile_counters
 from src.email import send_email
+from src.users.utils import set_picture
 from rq import get_current_job
+import os
 import sys
-import time
-import json
 
 app = create_app()
 app.app_context().push()
 
-def _set_task_progress(progress):
+def _set_task_progress(progress, error=None):
     job = get_current_job()
     if job:
-        job.meta['progress'] = progress
-        job.save_meta()
-        task = Task.query.get(job.get_id())
-        task.user.add_notification('task_progress',
-            {'task_id': job.get_id(),
-            'progress': int(progress)})
-        if progress >= 100:
-            task.complete = True
-        db.session.commit()
+        # launch_task passes the user id as the first argument of every task
+        Task.report_progress(job.get_id(), job.args[0], progress, error)
 
 def export_posts(user_id):
     try:
         user = User.query.get(user_id)
         _set_task_progress(0)
-        data = []
-        i = 0
-        total_tweets = user.tweets.count()
-        for tweet in user.tweets.order_by(Tweet.created_utc.asc()):
-            data.append({'body': tweet.textbody,
-                        'created_utc': tweet.created_utc.isoformat() + 'Z'})
-            time.sleep(3)
-            i += 1
-            _set_task_progress(100 * i / total_tweets)
-
+        job = get_current_job()
+        task_id = job.get_id() if job else 'export-{}'.format(user_id)
+        exports.prune(app.config['EXPORT_TTL'])
+        filename = exports.path(task_id)
+        progress = exports.Progress(exports.count(user_id), _set_task_progress,
+            app.config['EXPORT_PROGRESS_STEP'], app.config['EXPORT_PROGRESS_INTERVAL'])
+        exports.write(user_id, filename, progress, app.config['EXPORT_BATCH_SIZE'])
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+        _set_task_progress(100, 'The export failed, please try again')
+        return
+    # Complete before the link is sent, export_download only serves complete tasks
+    _set_task_progress(100)
+    try:
+        if os.path.getsize(filename) <= app.config['EXPORT_ATTACHMENT_LIMIT']:
+            with open(filename, 'rb') as f:
+                attachments = [('posts.jsonl.gz', 'application/gzip', f.read())]
+            available = 'is attached'
+        else:
+            attachments = None
+            with app.test_request_context(base_url=app.config['BASE_URL']):
+                url = url_for('users.export_download', task_id=task_id, _external=True)
+            available = 'can be downloaded from {} for the next {} days'.format(url, app.config['EXPORT_TTL'] // (24 * 3600))
         send_email('Your tweet posts',
             sender='noreply@demo.com',
             recipients=[user.email],
             text_body=f'''
                 Dear {user.username},
 
-                The archive of your posts that you requested is available.
+                The archive of your posts that you requested {available}.
                 ''',
-            attachments=[('posts.json', 'application/json', json.dumps({'posts': data}, indent=4))],
+            attachments=attachments,
             sync=True)
     except:
         app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+        _set_task_progress(100, 'The export could not be emailed, please try again')
+
+def process_picture(user_id, name):
+    try:
+        images.process(name)
+        set_picture(User.query.get(user_id), name)
+        db.session.commit()
+    except:
+        db.session.rollback()
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
     finally:
         _set_task_progress(100)
+
+def fan_out(tweet_id):
+    try:
+        tweet = Tweet.query.get(tweet_id)
+        if tweet is not None:
+            tweet.fan_out()
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+def reconcile(fix=True):
+    try:
+        drifted = reconcile_counters(fix)
+        app.logger.info('Reconciled counters, {} drifted'.format(drifted))
+    except:
+        app.logger.error('Unhandled exception', exc_info=sys.exc_info())
+
+def drain_search_outbox():
+    app.redis.delete('search-outbox:scheduled')
+    try:
+        drained = SearchOutbox.drain()
+        app.logger.info('Drained {} search outbox entries, {}'.format(drained, SearchOutbox.stats()))
+    except:
+        db.session.rollback()
+        app.logger.error('Error while draining search outbox {}'.format(SearchOutbox.stats()), exc_info=sys.exc_info())
+        raise
+
+def flush_likes():
+    app.redis.delete('likes:flush-scheduled')
+    try:
+        flushed = likes.flush()
+        app.logger.info('Flushed {} likes'.format(flushed))
+    except:
+        app.logger.error('Error while flushing likes', exc_info=sys.exc_info())
+    finally:
+        # Picks up what a failed or skipped flush left behind
+        if app.redis.exists(likes.PENDING, likes.FLUSHING):
+            likes.schedule_flush()
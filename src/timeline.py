@@ -0,0 +1,62 @@
+from flask import current_app
+from datetime import datetime
+
+# Adds a tweet to every follower timeline that is already materialized and
+# trims it. Cold timelines are skipped, they get rebuilt on their next read.
+_FAN_OUT = """
+for i, key in ipairs(KEYS) do
+    if redis.call('EXISTS', key) == 1 then
+        redis.call('ZADD', key, ARGV[1], ARGV[2])
+        redis.call('ZREMRANGEBYRANK', key, 0, -tonumber(ARGV[3]) - 1)
+    end
+end
+return 0
+"""
+
+def _key(user_id):
+    return 'timeline:{}'.format(user_id)
+
+def score(created_utc):
+    return (created_utc - datetime(1970, 1, 1)).total_seconds()
+
+def fan_out(user_ids, tweet_id, tweet_score):
+    keys = [_key(user_id) for user_id in user_ids]
+    if keys:
+        current_app.redis.eval(_FAN_OUT, len(keys), *keys, tweet_score, tweet_id,
+            current_app.config['TIMELINE_LENGTH'])
+
+def read(user_id):
+    """Returns the cached timeline as (tweet_id, score) pairs, newest first,
+    or None if the timeline of this user is not materialized."""
+    key = _key(user_id)
+    pipe = current_app.redis.pipeline()
+    pipe.zrevrange(key, 0, -1, withscores=True)
+    pipe.expire(key, current_app.config['TIMELINE_TTL'])
+    entries, exists = pipe.execute()
+    if not exists:
+        return None
+    return [(int(member), s) for member, s in entries if member != b'0']
+
+def store(user_id, entries):
+    key = _key(user_id)
+    pipe = current_app.redis.pipeline()
+    pipe.delete(key)
+    if entries:
+        pipe.zadd(key, {str(tweet_id): s for tweet_id, s in entries})
+    else:
+        # Keep an empty timeline materialized so it is not rebuilt on every read
+        pipe.zadd(key, {'0': 0})
+    pipe.expire(key, current_app.config['TIMELINE_TTL'])
+    pipe.execute()
+
+def invalidate(user_id):
+    current_app.redis.delete(_key(user_id))
+
+def celebrities():
+    return {int(user_id) for user_id in current_app.redis.smembers('timeline:celebrities')}
+
+def set_celebrity(user_id, is_celebrity):
+    if is_celebrity:
+        current_app.redis.sadd('timeline:celebrities', user_id)
+    else:
+        current_app.redis.srem('timeline:celebrities', user_id)
@@ -1,11 +1,12 @@
-from flask import Blueprint, render_template, redirect, url_for, request, jsonify
+from flask import Blueprint, render_template, redirect, url_for, request, jsonify, current_app
 from flask_login import login_required, current_user
 from datetime import datetime
-from src import db
+import redis
+import sys
+from src import db, likes, ratelimit
 from src.models import User, Tweet, Like, Comment
 from src.tweets.forms import CreateTweetForm, CreateCommentForm
-import markdown2
-import bleach
+from src.tweets.utils import hydrate_tweets, hydrate_comments
 
 tweets = Blueprint('tweets', __name__)
 
@@ -15,11 +16,11 @@ def tweet_create():
     form = CreateTweetForm()
     if form.validate_on_submit():
         time = datetime.utcnow()
-        markdown = markdown2.markdown(form.textbody.data)
-        bleached_markdown = bleach.clean(markdown, tags=['b', 'i', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'abbr', 'acronym', 'p', 'code', 'blockquote', 'table', 'tr', 'td', 'br', 'ol', 'li', 'pre', 'div', 'span', 'em', 'strong', 'cite', 'col', 'colgroup', 'datalist', 'dd', 'dt', 'dl', 'q', 's', 'small', 'sub', 'sup', 'td', 'tbody', 'th', 'thead', 'u'])
-        tweet = Tweet(identifier=Tweet.get_identifier(), textbody_source=form.textbody.data, textbody_markdown=bleached_markdown, author=current_user, created_utc=time, is_nsfw=form.is_nsfw.data)
+        tweet = Tweet(identifier=Tweet.get_identifier(), author=current_user, created_utc=time, is_nsfw=form.is_nsfw.data)
+        tweet.set_textbody(form.textbody.data)
         db.session.add(tweet)
         db.session.commit()
+        tweet.schedule_fan_out()
         return redirect(url_for('main.home'))
     return render_template('tweets/tweet_create.html', title='Create a tweet', form=form)
 
@@ -27,8 +28,11 @@ def tweet_create():
 @login_required
 def tweet_show(ident):
     tweet = Tweet.query.filter_by(identifier=ident).first_or_404()
-    comments = tweet.comments.filter(Comment.parent == None).all()
-    return render_template('tweets/tweet.html', tweet=tweet, comments=comments, showCreateComment=True)
+    comments, next_path = Comment.thread(tweet, after=request.args.get('after'),
+        per_page=current_app.config['COMMENTS_PER_PAGE'], depth=current_app.config['COMMENT_THREAD_DEPTH'])
+    next_url = url_for('tweets.tweet_show', ident=ident, after=next_path) if next_path else None
+    return render_template('tweets/tweet.html', tweet=tweet, comments=comments, showCreateComment=True,
+        next_url=next_url, **hydrate_tweets([tweet], current_user), **hydrate_comments(comments))
 
 @tweets.route("/tweet/<string:ident>/edit", methods=['GET', 'POST'])
 @login_required
@@ -38,8 +42,7 @@ def tweet_edit(ident):
         abort(403)
     form = CreateTweetForm()
     if form.validate_on_submit():
-        tweet.textbody_source = form.textbody.data
-        tweet.textbody_markdown = markdown2.markdown(form.textbody.data)
+        tweet.set_textbody(form.textbody.data)
         edited_time = datetime.utcnow()
         tweet.edited_utc = edited_time
         tweet.is_edited = True
@@ -52,23 +55,37 @@ def tweet_edit(ident):
     return render_template('tweets/tweet_create.html', form=form, is_editing=True)
 
 @tweets.route("/tweet/like", methods=['POST'])
+@ratelimit.limit('like')
 def tweet_like():
     if not current_user.is_authenticated:
         response = {"statuscode": -1, "status": "Permission denied"}
         return jsonify(response)
 
-    tweet_ident = request.json['ident']
-    tweet = Tweet.query.filter_by(identifier=tweet_ident).first()
+    data = request.get_json(silent=True) or {}
+    liked = data.get('liked')
+    tweet = Tweet.query.filter_by(identifier=data.get('ident')).first()
     if not tweet:
         response = {"statuscode": -1, "status": "Tweet not found"}
+    elif not isinstance(liked, bool):
+        response = {"statuscode": -1, "status": "liked must be true or false"}
+    elif current_app.config['LIKE_BUFFER']:
+        try:
+            _, like_count = likes.set_state(current_user.id, tweet, liked)
+        except redis.exceptions.RedisError:
+            # Writing to SQL now could be undone by an older buffered state
+            current_app.logger.error('Error while buffering like', exc_info=sys.exc_info())
+            response = jsonify({"statuscode": -1, "status": "Try again later"})
+            response.status_code = 503
+            return response
+        response = {"statuscode": 0, "status": "Liked" if liked else "Unliked", "liked": liked,
+            "like_count": like_count}
     else:
-        if current_user.has_liked_tweet(tweet):
-            current_user.unlike_tweet(tweet)
-            response = {"statuscode": 0, "status": "Liked"}
-        else:
-            current_user.like_tweet(tweet)
-            response = {"statuscode": 0, "status": "Unliked"}
-        db.session.commit()
+        # Sets the state instead of toggling it, so repeated requests are harmless
+        changed = current_user.like_tweet(tweet) if liked else current_user.unlike_tweet(tweet)
+        if changed:
+            db.session.commit()
+        response = {"statuscode": 0, "status": "Liked" if liked else "Unliked", "liked": liked,
+            "like_count": tweet.like_count}
     return jsonify(response)
 
 @tweets.route("/tweet/sticky", methods=['POST'])
@@ -99,8 +116,6 @@ def comment_create(ident):
     if form.validate_on_submit():
         comment = Comment(textbody=form.textbody.data, identifier=Comment.get_identifier(), tweet=tweet, author=current_user, recipient=tweet.author)
         comment.save()
-        tweet.author.add_notification('unread_notifs_count', tweet.author.new_notifs())
-        db.session.commit()
         return redirect(url_for('tweets.tweet_show', ident=ident))
     return render_template('tweets/comment_create.html', form=form)
 
@@ -108,7 +123,10 @@ def comment_create(ident):
 @login_required
 def comment_replies(ident):
     comment = Comment.query.filter_by(identifier=ident).first_or_404()
-    return render_template('tweets/replies.html', comment=comment)
+    comment.children, next_path = Comment.thread(comment.tweet, root=comment, after=request.args.get('after'),
+        per_page=current_app.config['COMMENTS_PER_PAGE'], depth=current_app.config['COMMENT_THREAD_DEPTH'])
+    next_url = url_for('tweets.comment_replies', ident=ident, after=next_path) if next_path else None
+    return render_template('tweets/replies.html', comment=comment, next_url=next_url, **hydrate_comments([comment]))
 
 @tweets.route("/comment/<string:ident>/reply", methods=['GET', 'POST'])
 @login_required
@@ -118,7 +136,5 @@ def comment_reply(ident):
     if form.validate_on_submit():
         comment = Comment(textbody=form.textbody.data, identifier=Comment.get_identifier(), tweet=p_comment.tweet, author=current_user, recipient=p_comment.tweet.author, parent=p_comment)
         comment.save()
-        p_comment.author.add_notification('unread_notifs_count', p_comment.author.new_notifs())
-        db.session.commit()
         return redirect(url_for('tweets.comment_replies', ident=p_comment.identifier))
     return render_template('tweets/comment_create.html', form=form, is_reply=True)
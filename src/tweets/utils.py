@@ -0,0 +1,92 @@
+from flask import current_app
+from markupsafe import Markup
+from sqlalchemy.orm.attributes import set_committed_value
+from src import db, likes
+from src.cache import FragmentCache
+from src.models import User, Like
+import hashlib
+import redis
+import sys
+
+# Bump when tweet_card.html or comment_card.html change, cached cards are
+# keyed by it.
+CARD_VERSION = 2
+# Card templates mark where the viewer specific parts go with HOLE.
+HOLE = '<!--hole-->'
+
+_cards = FragmentCache(10000)
+
+def hydrate_tweets(tweets, viewer):
+    """Loads everything tweets/tweets.html needs for a list of tweets with a
+    fixed number of queries and returns it as template context. Like counts
+    are read from Tweet.like_count, plus the likes still buffered in redis
+    with LIKE_BUFFER."""
+    ids = [tweet.id for tweet in tweets]
+    if not ids:
+        return {'liked_ids': set(), 'cards': {}}
+
+    missing = {tweet.userid for tweet in tweets if 'author' not in tweet.__dict__}
+    if missing:
+        authors = {user.id: user for user in User.query.filter(User.id.in_(missing))}
+        for tweet in tweets:
+            if tweet.userid in authors:
+                set_committed_value(tweet, 'author', authors[tweet.userid])
+
+    liked_ids = set()
+    if viewer.is_authenticated:
+        liked_ids = {tweet_id for (tweet_id,) in db.session.query(Like.tweetid).filter(
+            Like.userid == viewer.id, Like.tweetid.in_(ids))}
+    if current_app.config['LIKE_BUFFER']:
+        try:
+            deltas = likes.deltas(ids)
+            for tweet in tweets:
+                if deltas[tweet.id]:
+                    set_committed_value(tweet, 'like_count', tweet.like_count + deltas[tweet.id])
+            if viewer.is_authenticated:
+                for tweet_id, liked in likes.states(viewer.id, ids).items():
+                    (liked_ids.add if liked else liked_ids.discard)(tweet_id)
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Error while reading buffered likes', exc_info=sys.exc_info())
+    return {'liked_ids': liked_ids, 'cards': render_cards('tweets/tweet_card.html', 'tweet', tweets, tweet_version)}
+
+def hydrate_comments(comments):
+    """Returns the template context tweets/comments.html needs for comments
+    and the replies nested in their .children."""
+    flat = []
+    stack = list(comments)
+    while stack:
+        comment = stack.pop()
+        flat.append(comment)
+        stack.extend(getattr(comment, 'children', []))
+    return {'comment_cards': render_cards('tweets/comment_card.html', 'comment', flat, comment_version)}
+
+def tweet_version(tweet):
+    author = tweet.author
+    return (tweet.edited_utc, tweet.is_edited, tweet.render_version, tweet.like_count, tweet.comment_count,
+        tweet.stickied, tweet.is_banned, author.username, author.showname, author.image_file)
+
+def comment_version(comment):
+    author = comment.author
+    return (author.username, author.showname, author.image_file)
+
+def render_cards(template, name, objects, version):
+    """Returns the viewer independent parts of the card of every object, split
+    at HOLE, by id. Cards are rendered from template, which gets the object
+    as name and no current_user, or taken from the fragment cache. version
+    must return everything the card shows that can change, so a changed
+    object gets a new key and its old card is never read again."""
+    keys = {}
+    for obj in objects:
+        digest = hashlib.sha1(repr((CARD_VERSION,) + version(obj)).encode('utf-8')).hexdigest()
+        keys[obj.id] = 'card:{}:{}:{}'.format(name, obj.identifier, digest)
+    cards = _cards.get_many(list(set(keys.values())))
+    rendered = {}
+    if len(cards) < len(keys):
+        card_template = current_app.jinja_env.get_template(template)
+        moment = current_app.extensions['moment']
+        for obj in objects:
+            if keys[obj.id] not in cards and keys[obj.id] not in rendered:
+                rendered[keys[obj.id]] = card_template.render({name: obj, 'moment': moment})
+        _cards.set_many(rendered, current_app.config['CARD_CACHE_TTL'])
+        cards.update(rendered)
+    return {id: [Markup(part) for part in cards[key].split(HOLE)] for id, key in keys.items()}
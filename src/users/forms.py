@@ -30,7 +30,7 @@ class LoginForm(FlaskForm):
     submit = SubmitField('Login')
 
 class UserSettingsForm(FlaskForm):
-    picture = FileField('Update Profile Picture', validators=[FileAllowed(['jpg', 'png'])])
+    picture = FileField('Update Profile Picture', validators=[FileAllowed(['jpg', 'jpeg', 'png', 'webp', 'gif'])])
     showname = StringField('Showname', validators=[DataRequired(), Length(min=2, max=20)])
     email = StringField('Email', validators=[Optional(), Email()])
     bio = TextAreaField('Bio', validators=[Length(max=200), Optional()])
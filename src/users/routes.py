@@ -1,10 +1,17 @@
-from flask import Blueprint, render_template, redirect, flash, url_for, request, jsonify, abort, current_app
+from flask import Blueprint, render_template, redirect, flash, url_for, request, jsonify, abort, current_app, Response, stream_with_context, send_file
 from flask_login import current_user, login_user, login_required, logout_user
 from datetime import datetime
-from src import db, bcrypt
-from src.models import User, Tweet, Message, Notification, Comment
+from src import db, timeline, exports, images, passwords, ratelimit
+from src.models import User, Tweet, Message, Notification, Comment, Task
 from src.users.forms import SignupForm, LoginForm, UserSettingsForm, RequestResetForm, ResetPasswordForm, MessageForm
 from src.users.utils import save_picture, send_reset_email
+from src.pagination import decode_cursor, paginate
+from src.tweets.utils import hydrate_tweets, hydrate_comments
+import json
+import os
+import redis
+import sys
+import time
 
 users = Blueprint('users', __name__)
 
@@ -14,8 +21,8 @@ def signup():
         return redirect(url_for('main.home'))
     form = SignupForm()
     if form.validate_on_submit():
+        hashed_password = passwords.generate(form.password.data)
         try:
-            hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
             time = datetime.utcnow()
             user = User(username=form.username.data, showname=form.showname.data, email=form.email.data, password=hashed_password, created_utc=time)
             db.session.add(user)
@@ -33,7 +40,11 @@ def login():
     form = LoginForm()
     if form.validate_on_submit():
         user = User.query.filter_by(username=form.username.data).first()
-        if user and bcrypt.check_password_hash(user.password, form.password.data):
+        if user and passwords.check(user.password, form.password.data):
+            if passwords.needs_rehash(user.password):
+                # BCRYPT_LOG_ROUNDS changed, the password is only known now
+                user.password = passwords.generate(form.password.data)
+                db.session.commit()
             login_user(user, remember=form.remember_me.data)
             next_page = request.args.get('next')
             flash('Successfully logged in', 'success')
@@ -52,18 +63,19 @@ def logout():
 @login_required
 def user_profile(username):
     user = User.query.filter_by(username=username).first_or_404()
-    page = request.args.get('page', 1, type=int)
-    tweets = user.tweets.filter_by(stickied=False).order_by(Tweet.created_utc.desc())
+    tweets = user.tweets.filter_by(stickied=False)
     if current_user.filter_nsfw:
         tweets = tweets.filter_by(is_nsfw=False)
-    tweets = tweets.paginate(
-        page, current_app.config['TWEETS_PER_PAGE'], False)
-    next_url = url_for('users.user_profile', username=username.id, page=tweets.next_num) if tweets.has_next else None
-    prev_url = url_for('users.user_profile', username=username.id, page=tweets.prev_num) if tweets.has_prev else None
+    tweets = paginate(tweets, Tweet, current_app.config['TWEETS_PER_PAGE'],
+        before=decode_cursor(request.args.get('before')), after=decode_cursor(request.args.get('after')))
+    next_url = url_for('users.user_profile', username=username, before=tweets.next_cursor) if tweets.has_next else None
+    prev_url = url_for('users.user_profile', username=username, after=tweets.prev_cursor) if tweets.has_prev else None
     stickytweets = user.tweets.filter_by(stickied=True).order_by(Tweet.created_utc.desc())
     if current_user.filter_nsfw:
         stickytweets = stickytweets.filter_by(is_nsfw=False)
-    return render_template('users/profile.html', user=user, tweets=tweets.items, next_url=next_url, prev_url=prev_url, stickytweets=stickytweets.all())
+    stickytweets = stickytweets.all()
+    return render_template('users/profile.html', user=user, tweets=tweets.items, next_url=next_url, prev_url=prev_url, stickytweets=stickytweets,
+        **hydrate_tweets(stickytweets + tweets.items, current_user))
 
 @users.route("/user/settings", methods=['GET', 'POST'])
 def user_setting():
@@ -73,8 +85,12 @@ def user_setting():
     form = UserSettingsForm()
     if form.validate_on_submit():
         if form.picture.data:
-            picture_file = save_picture(form.picture.data, current_user.image_file)
-            current_user.image_file = picture_file
+            try:
+                if save_picture(current_user, form.picture.data):
+                    flash('Your new picture will show up once it is processed', 'info')
+            except images.PictureError as e:
+                form.picture.errors.append(str(e))
+                return render_template('users/settings.html', user=current_user, form=form)
         current_user.showname = form.showname.data
         current_user.email = form.email.data
         current_user.bio = form.bio.data
@@ -89,23 +105,29 @@ def user_setting():
     return render_template('users/settings.html', user=current_user, form=form)
 
 @users.route("/user/follow", methods=['POST'])
+@ratelimit.limit('follow')
 def user_follow():
     if not current_user.is_authenticated:
         response = {"statuscode": -1, "status": "Permission denied"}
         return jsonify(response)
 
-    master_username = request.json['username']
-    user = User.query.filter_by(username=master_username).first()
+    data = request.get_json(silent=True) or {}
+    following = data.get('following')
+    user = User.query.filter_by(username=data.get('username')).first()
     if not user or current_user.id == user.id:
         response = {"statuscode": -1, "status": "User not found or can't follow yourself"}
+    elif not isinstance(following, bool):
+        response = {"statuscode": -1, "status": "following must be true or false"}
     else:
-        if current_user.is_following(user):
-            current_user.unfollow(user)
-            response = {"statuscode": 0, "status": "Following"}
-        else:
-            current_user.follow(user)
-            response = {"statuscode": 0, "status": "Unfollowed"}
-        db.session.commit()
+        # Sets the state instead of toggling it, so repeated requests are harmless
+        changed = current_user.follow(user) if following else current_user.unfollow(user)
+        if changed:
+            db.session.commit()
+            try:
+                timeline.invalidate(current_user.id)
+            except redis.exceptions.RedisError:
+                current_app.logger.error('Error while invalidating timeline', exc_info=sys.exc_info())
+        response = {"statuscode": 0, "status": "Following" if following else "Not following", "following": following}
     return jsonify(response)
 
 @users.route("/reset_password", methods=['GET', 'POST'])
@@ -115,7 +137,9 @@ def reset_request():
     form = RequestResetForm()
     if form.validate_on_submit():
         user = User.query.filter_by(email=form.email.data).first()
-        send_reset_email(user)
+        if not send_reset_email(user):
+            flash('We could not send the email right now, please try again later', 'warning')
+            return render_template('reset_request.html', title='Reset Password', form=form), 503
         flash('An email has been sent with instructions to reset your password. Check your email inbox', 'info')
         return redirect(url_for('users.login'))
     return render_template('reset_request.html', title='Reset Password', form=form)
@@ -130,8 +154,7 @@ def reset_token(token):
         return redirect(url_for('users.reset_request'))
     form = ResetPasswordForm()
     if form.validate_on_submit():
-        hashed_password = bcrypt.generate_password_hash(form.password.data).decode('utf-8')
-        user.password = hashed_password
+        user.password = passwords.generate(form.password.data)
         db.session.commit()
         flash('Your password has been changd! Login Now', 'success')
         return redirect(url_for('users.login'))
@@ -143,10 +166,13 @@ def send_message(recipient):
     user = User.query.filter_by(username=recipient).first_or_404()
     form = MessageForm()
     if form.validate_on_submit():
+        # Read before the message is added, a recount would include it
+        unread = user.new_messages() + 1
         msg = Message(author=current_user, recipient=user, body=form.message.data)
         db.session.add(msg)
-        user.add_notification('unread_message_count', user.new_messages())
+        user.add_notification('unread_message_count', unread)
         db.session.commit()
+        user.incr_unread('messages')
         flash('Your message has been sent', 'success')
         return redirect(url_for('users.user_profile', username=user.username))
     return render_template('users/send_message.html', form=form, recipient=recipient)
@@ -157,8 +183,12 @@ def messages():
     current_user.last_message_read_time = datetime.utcnow()
     current_user.add_notification('unread_message_count', 0)
     db.session.commit()
-    messages = current_user.messages_received.order_by(Message.created_utc.desc()).all()
-    return render_template('users/messages.html', messages=messages)
+    current_user.reset_unread('messages')
+    messages = paginate(current_user.messages_received, Message, current_app.config['TWEETS_PER_PAGE'],
+        before=decode_cursor(request.args.get('before')), after=decode_cursor(request.args.get('after')))
+    next_url = url_for('users.messages', before=messages.next_cursor) if messages.has_next else None
+    prev_url = url_for('users.messages', after=messages.prev_cursor) if messages.has_prev else None
+    return render_template('users/messages.html', messages=messages.items, next_url=next_url, prev_url=prev_url)
 
 @users.route('/notifs')
 @login_required
@@ -166,21 +196,84 @@ def notifs():
     current_user.last_notifs_read_time = datetime.utcnow()
     current_user.add_notification('unread_notifs_count', 0)
     db.session.commit()
-    comments = current_user.comments_received.filter(Comment.commenter_id != current_user.id).order_by(Comment.created_utc.desc()).all()
-    return render_template('users/notifs.html', comments=comments)
+    current_user.reset_unread('notifs')
+    comments = paginate(current_user.comments_received.filter(Comment.commenter_id != current_user.id), Comment,
+        current_app.config['TWEETS_PER_PAGE'],
+        before=decode_cursor(request.args.get('before')), after=decode_cursor(request.args.get('after')))
+    next_url = url_for('users.notifs', before=comments.next_cursor) if comments.has_next else None
+    prev_url = url_for('users.notifs', after=comments.prev_cursor) if comments.has_prev else None
+    return render_template('users/notifs.html', comments=comments.items, next_url=next_url, prev_url=prev_url,
+        **hydrate_comments(comments.items))
 
 
+def _notifications_after(last):
+    """Returns the task progress of the user and its notifications after the
+    id last, as stream payloads. Ids are taken before commit, so one can land
+    after a higher one: notifications from the last NOTIFICATION_RESUME_WINDOW
+    seconds are included too. Every notification is the latest state of its
+    name, getting one again is harmless."""
+    # Task progress is only kept in redis, every backlog starts with it
+    progress = [{
+        'id': None,
+        'name': 'task_progress',
+        'data': {'task_id': task.id, 'progress': task.progress},
+        'timestamp': None
+        } for task in current_user.get_tasks_in_progress()]
+    recent = time.time() - current_app.config['NOTIFICATION_RESUME_WINDOW']
+    notifications = current_user.notifications.filter(
+        db.or_(Notification.id > last, Notification.timestamp > recent)).order_by(Notification.id.asc())
+    return progress + [n.get_payload() for n in notifications]
+
 @users.route('/notifications')
 @login_required
 def notifications():
-    since = request.args.get('since', 0.0, type=float)
-    notifications = current_user.notifications.filter(
-        Notification.timestamp > since).order_by(Notification.timestamp.asc())
-    return jsonify([{
-        'name': n.name,
-        'data': n.get_data(),
-        'timestamp': n.timestamp
-        } for n in notifications])
+    return jsonify(_notifications_after(request.args.get('after', 0, type=int)))
+
+@users.route('/notifications/stream')
+@login_required
+def notification_stream():
+    last = request.headers.get('Last-Event-ID', type=int) or request.args.get('after', 0, type=int)
+    pubsub = current_app.redis.pubsub(ignore_subscribe_messages=True)
+    try:
+        pubsub.subscribe(Notification.channel(current_user.id))
+    except redis.exceptions.RedisError:
+        current_app.logger.error('Error while subscribing to notifications', exc_info=sys.exc_info())
+        abort(503)
+    # Subscribed before reading the backlog, so nothing committed in between is lost
+    backlog = _notifications_after(last)
+    db.session.remove()
+    timeout = current_app.config['NOTIFICATION_STREAM_TIMEOUT']
+    keepalive = current_app.config['NOTIFICATION_KEEPALIVE']
+
+    def event(payload):
+        # Task progress has no id, the browser keeps the last one it got
+        id = 'id: {}\n'.format(payload['id']) if payload.get('id') is not None else ''
+        return '{}event: {}\ndata: {}\n\n'.format(id, payload['name'], json.dumps(payload['data']))
+
+    def stream():
+        # Published notifications can arrive in any order, only the ones the
+        # backlog already sent are skipped
+        sent = {payload['id'] for payload in backlog if payload['id'] is not None}
+        deadline = time.time() + timeout
+        try:
+            yield 'retry: 3000\n\n'
+            for payload in backlog:
+                yield event(payload)
+            while time.time() < deadline:
+                message = pubsub.get_message(timeout=min(keepalive, deadline - time.time()))
+                if message is None:
+                    yield ': keepalive\n\n'
+                    continue
+                payload = json.loads(message['data'])
+                if payload.get('id') not in sent:
+                    yield event(payload)
+        except redis.exceptions.RedisError:
+            current_app.logger.error('Error while streaming notifications', exc_info=sys.exc_info())
+        finally:
+            pubsub.close()
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @users.route('/export_posts')
 @login_required
@@ -194,3 +287,13 @@ def export_posts():
         current_user.launch_task('export_posts', 'Exporting tweets')
         db.session.commit()
     return redirect(url_for('users.user_profile', user_id=current_user.id))
+
+@users.route('/export_posts/<string:task_id>')
+@login_required
+def export_download(task_id):
+    task = Task.query.filter_by(id=task_id, user=current_user, name='export_posts', complete=True).first_or_404()
+    filename = exports.path(task.id)
+    if not os.path.exists(filename):
+        abort(404)
+    return send_file(filename, mimetype='application/gzip', as_attachment=True,
+        attachment_filename='posts.jsonl.gz')
@@ -1,34 +1,37 @@
 from flask import current_app, url_for, render_template
 import os
-import binascii
 import sys
-from PIL import Image
+from src import images
 from src.email import send_email
 
-def save_picture(form_picture, old_picture_fn):
-    random_hex = binascii.hexlify(os.urandom(3)).hex()
-    _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
-    picture_path = os.path.join(current_app.root_path, 'static/profile_pics', picture_fn)
-
-    output_size = (125, 125)
-    i = Image.open(form_picture)
-    i.thumbnail(output_size)
-    i.save(picture_path)
+def save_picture(user, form_picture):
+    """Stores an uploaded profile picture and switches the user to it once it
+    is processed, returning whether that is still pending. Raises
+    images.PictureError for pictures that are refused."""
+    name = images.store(form_picture)
+    if images.is_processed(name):
+        set_picture(user, name)
+        return False
+    user.launch_task('process_picture', 'Processing your picture', name)
+    return True
 
+def set_picture(user, name):
+    old_picture_fn = user.image_file
+    user.image_file = name
+    # Pictures from before content addressing belong to a single user
     try:
-        if old_picture_fn != 'default.jpg':
-            path = os.path.join(current_app.root_path, 'static/profile_pics', old_picture_fn)
-            os.remove(path)
-    except:
-        app.logger.error('Error while deleting old picture', exc_info=sys.exc_info())
-
-    return picture_fn
+        if '.' in old_picture_fn and old_picture_fn != 'default.jpg':
+            os.remove(images.path(old_picture_fn))
+    except OSError:
+        current_app.logger.error('Error while deleting old picture', exc_info=sys.exc_info())
 
 def send_reset_email(user):
+    """Queues the password reset email of user and returns whether there
+    was room for it."""
     token = user.get_reset_token()
-    send_email('Reset Your Password',
+    return send_email('Reset Your Password',
         sender='noreply@demo.com',
         recipients=[user.email],
-        text_body=render_template('reset_password.txt', user=user, token=token)
+        text_body=render_template('reset_password.txt', user=user, token=token),
+        timeout=0
         )
@@ -1,11 +1,39 @@
 #!/flask/bin/python
 
 from datetime import datetime, timedelta
+from unittest import mock
+import collections
 import unittest
-from src import create_app
-from src.models import db, User, Tweet, Comment
+from src import create_app, timeline, identifiers, markup, exports, images, assets, passwords, ratelimit, likes, models
+from src.cache import LRUCache
+from src.email import Sender
+from PIL import Image
+from src.tweets import utils as tweet_utils
+from src.users.utils import set_picture
+from src.models import db, User, Tweet, Like, Comment, Message, Notification, SearchOutbox, Task, reconcile_counters, load_user
+from src.pagination import decode_cursor, paginate
+from src.search import bulk_index, start_build, finish_build, multi_search, ElasticsearchBackend, SQLiteBackend
+from elasticsearch import Transport
+from flask import jsonify, url_for
+from flask_mail import Message as MailMessage
+from flask_wtf.csrf import generate_csrf
+import fakeredis
+import gzip
+import io
+import json
+import os
+import re
+import rq
+import shutil
+import smtplib
+import tempfile
+import threading
+import time
 
 app = create_app()
+app.search = None
+# Tests reuse user ids across databases, so nothing may outlive a test
+app.config['SESSION_USER_LOCAL_TTL'] = 0
 app.app_context().push()
 
 class UserModelCase(unittest.TestCase):
@@ -13,6 +41,7 @@ class UserModelCase(unittest.TestCase):
         app.config['TESTING'] = True
         app.config['WTF_CSRF_ENABLED'] = False
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.redis = fakeredis.FakeStrictRedis()
         db.create_all()
 
     def tearDown(self):
@@ -31,6 +60,7 @@ class UserModelCase(unittest.TestCase):
         u1.follow(u2)
         db.session.commit()
         self.assertTrue(u1.is_following(u2))
+        self.assertEqual((u1.following_count, u2.follower_count), (1, 1))
         self.assertEqual(u1.followed.count(), 1)
         self.assertEqual(u1.followed.first().username, 'susan')
         self.assertEqual(u2.followers.count(), 1)
@@ -39,6 +69,7 @@ class UserModelCase(unittest.TestCase):
         u1.unfollow(u2)
         db.session.commit()
         self.assertFalse(u1.is_following(u2))
+        self.assertEqual((u1.following_count, u2.follower_count), (0, 0))
         self.assertEqual(u1.followed.count(), 0)
         self.assertEqual(u2.followers.count(), 0)
 
@@ -50,10 +81,10 @@ class UserModelCase(unittest.TestCase):
         db.session.add_all([u1, u2, u3, u4])
 
         now = datetime.utcnow()
-        t1 = Tweet(textbody="post from john", author=u1, created_utc=now + timedelta(seconds=1))
-        t2 = Tweet(textbody="post from susan", author=u2, created_utc=now + timedelta(seconds=4))
-        t3 = Tweet(textbody="post from mary", author=u3, created_utc=now + timedelta(seconds=3))
-        t4 = Tweet(textbody="post from david", author=u4, created_utc=now + timedelta(seconds=2))
+        t1 = Tweet(identifier=Tweet.get_identifier(), textbody_source="post from john", textbody_markdown="post from john", author=u1, created_utc=now + timedelta(seconds=1))
+        t2 = Tweet(identifier=Tweet.get_identifier(), textbody_source="post from susan", textbody_markdown="post from susan", author=u2, created_utc=now + timedelta(seconds=4))
+        t3 = Tweet(identifier=Tweet.get_identifier(), textbody_source="post from mary", textbody_markdown="post from mary", author=u3, created_utc=now + timedelta(seconds=3))
+        t4 = Tweet(identifier=Tweet.get_identifier(), textbody_source="post from david", textbody_markdown="post from david", author=u4, created_utc=now + timedelta(seconds=2))
         db.session.add_all([t1, t2, t3, t4])
         db.session.commit()
 
@@ -77,7 +108,7 @@ class UserModelCase(unittest.TestCase):
         db.session.add(u1)
 
         now = datetime.utcnow()
-        t1 = Tweet(textbody="post from bijay", author=u1, created_utc=now)
+        t1 = Tweet(identifier=Tweet.get_identifier(), textbody_source="post from bijay", textbody_markdown="post from bijay", author=u1, created_utc=now)
         db.session.add(t1)
         db.session.commit()
 
@@ -87,11 +118,1880 @@ class UserModelCase(unittest.TestCase):
         db.session.commit()
 
         self.assertEqual(t1.likes.count(), 1)
+        self.assertEqual(t1.like_count, 1)
 
         u1.unlike_tweet(t1)
         db.session.commit()
 
         self.assertEqual(t1.likes.count(), 0)
+        self.assertEqual(t1.like_count, 0)
+
+    def test_reconcile_counters(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        u2 = User(username='susan', showname='susan', password='jpfkdjsd')
+        db.session.add_all([u1, u2])
+        t1 = Tweet(identifier=Tweet.get_identifier(), textbody_source="post from susan", textbody_markdown="post from susan", author=u2)
+        db.session.add(t1)
+        db.session.commit()
+        u1.follow(u2)
+        u1.like_tweet(t1)
+        db.session.commit()
+        self.assertEqual(reconcile_counters(), 0)
+
+        u2.follower_count = 5
+        t1.like_count = 0
+        db.session.commit()
+        self.assertEqual(reconcile_counters(fix=False), 2)
+        self.assertEqual(reconcile_counters(), 2)
+        self.assertEqual(reconcile_counters(), 0)
+        self.assertEqual((u2.follower_count, u2.tweet_count, t1.like_count), (1, 1, 1))
+
+class TimelineCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.redis = fakeredis.FakeStrictRedis()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def tweet(self, author, text, created_utc):
+        t = Tweet(identifier=Tweet.get_identifier(), textbody_source=text, textbody_markdown=text,
+            author=author, created_utc=created_utc)
+        db.session.add(t)
+        db.session.commit()
+        t.fan_out()
+        return t
+
+    def test_timeline_matches_followed_posts(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        u2 = User(username='susan', showname='susan', password='jpfkdjsd')
+        u3 = User(username='mary', showname='mary', password='jpfkdjsd')
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        db.session.commit()
+
+        now = datetime.utcnow()
+        t1 = self.tweet(u1, 'post from john', now + timedelta(seconds=1))
+        t2 = self.tweet(u2, 'post from susan', now + timedelta(seconds=2))
+        self.tweet(u3, 'post from mary', now + timedelta(seconds=3))
+
+        # cold timeline gets rebuilt from the database
+        self.assertEqual(u1.home_timeline(20).items, [t2, t1])
+        # warm timeline receives new tweets through fan-out
+        t4 = self.tweet(u2, 'another post from susan', now + timedelta(seconds=4))
+        self.assertEqual(u1.home_timeline(20).items, [t4, t2, t1])
+        self.assertEqual(u1.home_timeline(20).items, u1.followed_posts().all())
+
+        page = u1.home_timeline(2)
+        self.assertEqual((page.items, page.has_next, page.has_prev), ([t4, t2], True, False))
+        page = u1.home_timeline(2, before=decode_cursor(page.next_cursor))
+        self.assertEqual((page.items, page.has_next, page.has_prev), ([t1], False, True))
+        page = u1.home_timeline(2, after=decode_cursor(page.prev_cursor))
+        self.assertEqual((page.items, page.has_next, page.has_prev), ([t4, t2], True, False))
+
+    def test_fan_out_is_scheduled(self):
+        app.task_queue = rq.Queue('kura-tasks', connection=app.redis)
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        u2 = User(username='susan', showname='susan', password='jpfkdjsd')
+        db.session.add_all([u1, u2])
+        u1.follow(u2)
+        db.session.commit()
+        u1.home_timeline(20)
+        u2.home_timeline(20)
+        t = Tweet(identifier=Tweet.get_identifier(), textbody_source='post', textbody_markdown='post', author=u2)
+        db.session.add(t)
+        db.session.commit()
+        t.schedule_fan_out()
+        self.assertEqual([tweet_id for tweet_id, _ in timeline.read(u2.id)], [t.id])
+        self.assertEqual(timeline.read(u1.id), [])
+        job = app.task_queue.jobs[0]
+        self.assertEqual((job.func_name, job.args), ('src.tasks.fan_out', (t.id,)))
+        t.fan_out()
+        self.assertEqual([tweet_id for tweet_id, _ in timeline.read(u1.id)], [t.id])
+
+    def test_timeline_pulls_celebrities(self):
+        app.config['TIMELINE_FANOUT_LIMIT'] = 1
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        u2 = User(username='susan', showname='susan', password='jpfkdjsd')
+        u3 = User(username='mary', showname='mary', password='jpfkdjsd')
+        db.session.add_all([u1, u2, u3])
+        u1.follow(u2)
+        u3.follow(u2)
+        db.session.commit()
+        try:
+            self.assertEqual(u1.home_timeline(20).items, [])
+            t1 = self.tweet(u2, 'post from susan', datetime.utcnow())
+            self.assertEqual(timeline.read(u1.id), [])
+            self.assertEqual(u1.home_timeline(20).items, [t1])
+        finally:
+            app.config['TIMELINE_FANOUT_LIMIT'] = 10000
+
+class UnreadCountsCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.redis = fakeredis.FakeStrictRedis()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_unread_counts(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        u2 = User(username='susan', showname='susan', password='jpfkdjsd')
+        db.session.add_all([u1, u2])
+        db.session.add(Message(author=u1, recipient=u2, body='hello'))
+        db.session.commit()
+
+        # missing cache is recounted from the database
+        self.assertEqual(u2.unread_counts(), {'messages': 1, 'notifs': 0})
+        db.session.add(Message(author=u1, recipient=u2, body='hello again'))
+        db.session.commit()
+        u2.incr_unread('messages')
+        self.assertEqual(u2.new_messages(), 2)
+
+        u2.last_message_read_time = datetime.utcnow()
+        db.session.commit()
+        u2.reset_unread('messages')
+        self.assertEqual(u2.new_messages(), 0)
+        app.redis.flushdb()
+        self.assertEqual(u2.new_messages(), 0)
+
+    def test_send_message_commits_once(self):
+        app.config['SECRET_KEY'] = 'testing'
+        app.config['WTF_CSRF_ENABLED'] = False
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        u2 = User(username='susan', showname='susan', password='jpfkdjsd')
+        db.session.add_all([u1, u2])
+        db.session.add(Message(author=u1, recipient=u2, body='hello'))
+        db.session.commit()
+        user_id, recipient_id = u1.id, u2.id
+        commits = []
+        def count(session):
+            commits.append(session)
+        db.event.listen(db.session, 'after_commit', count)
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as session:
+                    session['_user_id'] = str(user_id)
+                    session['_fresh'] = True
+                response = client.post('/send_message/susan', data={'message': 'hello again'})
+        finally:
+            db.event.remove(db.session, 'after_commit', count)
+            app.config['WTF_CSRF_ENABLED'] = True
+        self.assertEqual((response.status_code, len(commits)), (302, 1))
+        u2 = User.query.get(recipient_id)
+        self.assertEqual(u2.new_messages(), 2)
+        self.assertEqual(u2.notifications.filter_by(name='unread_message_count').one().get_data(), 2)
+
+    def test_comment_commits_once(self):
+        app.config['SECRET_KEY'] = 'testing'
+        app.config['WTF_CSRF_ENABLED'] = False
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        u2 = User(username='susan', showname='susan', password='jpfkdjsd')
+        db.session.add_all([u1, u2])
+        db.session.flush()
+        tweet = Tweet(identifier='t1', textbody_source='post', textbody_markdown='post', author=u2)
+        db.session.add(tweet)
+        db.session.commit()
+        user_id, recipient_id = u1.id, u2.id
+        commits = []
+        def count(session):
+            commits.append(session)
+        db.event.listen(db.session, 'after_commit', count)
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as session:
+                    session['_user_id'] = str(user_id)
+                    session['_fresh'] = True
+                response = client.post('/tweet/t1/comment/create', data={'textbody': 'hello'})
+        finally:
+            db.event.remove(db.session, 'after_commit', count)
+            app.config['WTF_CSRF_ENABLED'] = True
+        self.assertEqual((response.status_code, len(commits)), (302, 1))
+        u2 = User.query.get(recipient_id)
+        self.assertEqual(u2.new_notifs(), 1)
+        self.assertEqual(u2.notifications.filter_by(name='unread_notifs_count').one().get_data(), 1)
+
+class NotificationStreamCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'testing'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.config['NOTIFICATION_STREAM_TIMEOUT'] = 0.5
+        app.config['NOTIFICATION_KEEPALIVE'] = 0.1
+        app.redis = fakeredis.FakeStrictRedis()
+        db.create_all()
+
+    def tearDown(self):
+        app.config['NOTIFICATION_STREAM_TIMEOUT'] = 300
+        app.config['NOTIFICATION_KEEPALIVE'] = 15
+        db.session.remove()
+        db.drop_all()
+
+    def stream(self, user_id, push, headers=None):
+        timer = threading.Timer(0.2, push)
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session['_user_id'] = str(user_id)
+                session['_fresh'] = True
+            timer.start()
+            response = client.get('/notifications/stream', headers=headers or {})
+            body = response.get_data(as_text=True)
+        timer.join()
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        return body
+
+    def test_stream_replays_and_pushes(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        db.session.add(u1)
+        db.session.commit()
+        old = u1.add_notification('unread_message_count', 1)
+        old.timestamp = time.time() - 3600
+        db.session.commit()
+        old_id = old.id
+        new = u1.add_notification('unread_notifs_count', 2)
+        db.session.commit()
+        new_id = new.id
+        user_id = u1.id
+        u1.launch_task('export_posts', 'Exporting tweets')
+        db.session.commit()
+        task_id = Task.query.one().id
+
+        def push():
+            app.redis.publish(Notification.channel(user_id), json.dumps({'id': None, 'name': 'task_progress',
+                'data': {'task_id': 'x', 'progress': 50}, 'timestamp': time.time()}))
+        body = self.stream(user_id, push, {'Last-Event-ID': str(old_id)})
+        self.assertNotIn('event: unread_message_count', body)
+        self.assertIn('id: {}\nevent: unread_notifs_count\ndata: 2'.format(new_id), body)
+        # Progress only kept in redis is part of the backlog
+        self.assertIn('event: task_progress\ndata: {{"task_id": "{}", "progress": 0}}'.format(task_id), body)
+        self.assertIn('event: task_progress\ndata: {"task_id": "x", "progress": 50}', body)
+        self.assertIn(': keepalive', body)
+
+    def test_published_with_id(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        db.session.add(u1)
+        db.session.commit()
+        pubsub = app.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(Notification.channel(u1.id))
+        n = u1.add_notification('unread_notifs_count', 3)
+        db.session.commit()
+        messages = [pubsub.get_message(timeout=0.1) for _ in range(3)]
+        pubsub.close()
+        message = next(message for message in messages if message)
+        self.assertEqual(json.loads(message['data'])['id'], n.id)
+
+    def test_out_of_order_events_are_kept(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        db.session.add(u1)
+        db.session.commit()
+        newer = u1.add_notification('unread_notifs_count', 2)
+        db.session.commit()
+        newer_id = newer.id
+        user_id = u1.id
+
+        def push():
+            # Stamped and numbered before the backlog's notification, published after it
+            app.redis.publish(Notification.channel(user_id), json.dumps({'id': newer_id - 1,
+                'name': 'unread_message_count', 'data': 1, 'timestamp': time.time() - 10}))
+            app.redis.publish(Notification.channel(user_id), json.dumps({'id': newer_id,
+                'name': 'unread_notifs_count', 'data': 2, 'timestamp': time.time()}))
+        body = self.stream(user_id, push)
+        self.assertIn('id: {}\nevent: unread_message_count\ndata: 1'.format(newer_id - 1), body)
+        self.assertEqual(body.count('event: unread_notifs_count'), 1)
+
+class FakeIndices(object):
+    def __init__(self):
+        self.indices = set()
+        self.aliases = {}
+
+    def create(self, index, body=None):
+        self.indices.add(index)
+
+    def put_settings(self, index, body):
+        pass
+
+    def refresh(self, index):
+        pass
+
+    def exists(self, index):
+        return index in self.indices
+
+    def exists_alias(self, name):
+        return name in self.aliases.values()
+
+    def get_alias(self, name):
+        return {index: {} for index, alias in self.aliases.items() if alias == name}
+
+    def update_aliases(self, body):
+        for action in body['actions']:
+            op, args = next(iter(action.items()))
+            if op == 'add':
+                self.aliases[args['index']] = args['alias']
+            elif op == 'remove':
+                del self.aliases[args['index']]
+            else:
+                self.indices.remove(args['index'])
+
+    def delete(self, index, ignore=()):
+        if index in self.indices or 404 not in ignore:
+            self.indices.remove(index)
+
+class FakeElasticsearch(object):
+    """Records bulk requests and answers them like elasticsearch would."""
+
+    transport = Transport([{}])
+
+    def __init__(self):
+        self.operations = []
+        self.searches = []
+        self.responses = []
+        self.indices = FakeIndices()
+
+    def msearch(self, body, *args, **kwargs):
+        self.searches.append(body)
+        return {'responses': self.responses}
+
+    def bulk(self, body, *args, **kwargs):
+        lines = [json.loads(line) for line in body.strip().split('\n')]
+        items = []
+        while lines:
+            action = lines.pop(0)
+            op, meta = next(iter(action.items()))
+            source = lines.pop(0) if op == 'index' else None
+            self.operations.append((op, meta['_index'], int(meta['_id']), source))
+            items.append({op: {'_index': meta['_index'], '_id': meta['_id'], 'status': 200}})
+        return {'errors': False, 'items': items}
+
+class SearchOutboxCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.redis = fakeredis.FakeStrictRedis()
+        app.task_queue = rq.Queue('kura-tasks', connection=app.redis)
+        app.search = ElasticsearchBackend(FakeElasticsearch())
+        app.config['SEARCH_OUTBOX'] = True
+        db.create_all()
+
+    def tearDown(self):
+        app.search = None
+        app.config['SEARCH_OUTBOX'] = False
+        db.session.remove()
+        db.drop_all()
+
+    def test_outbox_is_drained_in_bulk(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        db.session.add(u1)
+        db.session.commit()
+        t1 = Tweet(identifier=Tweet.get_identifier(), textbody_source='first', textbody_markdown='first', author=u1)
+        db.session.add(t1)
+        db.session.commit()
+        t1.textbody_source = 'edited'
+        db.session.commit()
+        # changes to fields that are not searchable are not queued
+        u1.bio = 'bio'
+        db.session.commit()
+
+        self.assertEqual(SearchOutbox.stats()['depth'], 3)
+        self.assertEqual(len(app.task_queue), 1)
+        self.assertEqual(app.search.client.operations, [])
+
+        self.assertEqual(SearchOutbox.drain(), 3)
+        self.assertEqual(sorted(app.search.client.operations), [
+            ('index', 'tweet', t1.id, {'textbody_source': 'edited', 'is_nsfw': False, 'id': t1.id}),
+            ('index', 'user', u1.id, {'username': 'john', 'showname': 'john', 'id': u1.id})])
+        self.assertEqual(SearchOutbox.stats(), {'depth': 0, 'lag': 0})
+
+class ReindexCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.redis = fakeredis.FakeStrictRedis()
+        db.create_all()
+
+    def tearDown(self):
+        app.search = None
+        db.session.remove()
+        db.drop_all()
+
+    def test_reindex_swaps_alias(self):
+        users = [User(username='user{}'.format(i), showname='user', password='jpfkdjsd') for i in range(25)]
+        db.session.add_all(users)
+        db.session.commit()
+        es = FakeElasticsearch()
+        app.search = ElasticsearchBackend(es)
+        es.indices.create('user')
+
+        indexed, rate = User.reindex(workers=1, batch_size=2)
+        self.assertEqual(indexed, 25)
+        self.assertGreater(rate, 0)
+        (index, alias), = es.indices.aliases.items()
+        self.assertEqual(es.indices.indices, {index})
+        self.assertEqual(alias, 'user')
+        self.assertEqual(sorted(op[2] for op in es.operations), [user.id for user in users])
+        self.assertTrue(all(op[1] == index for op in es.operations))
+
+        # a second rebuild replaces the first one
+        User.reindex(workers=1, batch_size=10)
+        self.assertNotIn(index, es.indices.indices)
+        self.assertEqual(len(es.indices.aliases), 1)
+
+    def test_changes_during_rebuild_reach_both_indices(self):
+        es = FakeElasticsearch()
+        app.search = ElasticsearchBackend(es)
+        index = start_build('user')
+        bulk_index([('delete', 'user', 1, None)])
+        self.assertEqual(es.operations, [('delete', 'user', 1, None), ('delete', index, 1, None)])
+        self.assertEqual(finish_build('user', index), [1])
+
+    def test_failed_rebuild_is_dropped(self):
+        db.session.add(User(username='john', showname='john', password='jpfkdjsd'))
+        db.session.commit()
+        es = FakeElasticsearch()
+        app.search = ElasticsearchBackend(es)
+        with mock.patch('src.models._reindex_range', side_effect=RuntimeError('crash')):
+            with self.assertRaises(RuntimeError):
+                User.reindex(workers=1)
+        self.assertEqual((es.indices.indices, app.redis.keys('search-build*')), (set(), []))
+        bulk_index([('delete', 'user', 1, None)])
+        self.assertEqual(es.operations, [('delete', 'user', 1, None)])
+
+    def test_changes_during_rebuild_are_indexed_again(self):
+        app.task_queue = rq.Queue('kura-tasks', connection=app.redis)
+        users = [User(username='user{}'.format(i), showname='user', password='jpfkdjsd') for i in range(3)]
+        db.session.add_all(users)
+        db.session.commit()
+        user_id = users[1].id
+        app.search = ElasticsearchBackend(FakeElasticsearch())
+        reindex_range = models._reindex_range
+        def copy_after_change(job):
+            # A change indexed before the copy of the same row reaches the new index
+            bulk_index([('index', 'user', user_id, {'username': 'renamed', 'showname': 'user'})])
+            return reindex_range(job)
+        with mock.patch('src.models._reindex_range', copy_after_change):
+            User.reindex(workers=1)
+        self.assertEqual([(entry.index, entry.doc_id) for entry in SearchOutbox.query], [('user', user_id)])
+        self.assertEqual(len(app.task_queue), 1)
+
+class SQLiteSearchCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.redis = fakeredis.FakeStrictRedis()
+        app.task_queue = rq.Queue('kura-tasks', connection=app.redis)
+        app.search = SQLiteBackend(':memory:')
+        db.create_all()
+
+    def tearDown(self):
+        app.search = None
+        db.session.remove()
+        db.drop_all()
+
+    def test_search_ranks_filters_and_pages(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        tweets = [Tweet(identifier=Tweet.get_identifier(), textbody_source=text, textbody_markdown=text, author=u1,
+            is_nsfw=text.endswith('nsfw')) for text in ('cats and dogs', 'cats cats cats', 'only dogs', 'cats nsfw')]
+        db.session.add_all(tweets)
+        db.session.commit()
+        SearchOutbox.drain()
+
+        results, = multi_search([Tweet.search('cats', 10, is_nsfw=False)])
+        self.assertEqual(results.total, 2)
+        self.assertEqual(Tweet.from_results(results), [tweets[1], tweets[0]])
+        results, = multi_search([Tweet.search('"dogs" OR', 10)])
+        self.assertEqual(results.total, 2)
+
+        ranked, = multi_search([Tweet.search('cats', 10)])
+        ids, after = [], None
+        while True:
+            results, = multi_search([Tweet.search('cats', 1, after)])
+            ids += results.ids
+            after = results.after
+            if not results.has_next:
+                break
+        self.assertEqual(ids, ranked.ids)
+
+        db.session.delete(tweets[1])
+        tweets[2].textbody_source = 'cats now'
+        db.session.commit()
+        SearchOutbox.drain()
+        app.redis.flushdb()
+        results, = multi_search([Tweet.search('cats', 10, is_nsfw=False)])
+        self.assertEqual(sorted(results.ids), [tweets[0].id, tweets[2].id])
+
+    def test_results_are_cached_until_reindex(self):
+        users = [User(username='user{}'.format(i), showname='user', password='jpfkdjsd') for i in range(5)]
+        db.session.add_all(users)
+        db.session.commit()
+        self.assertEqual(User.reindex(workers=1, batch_size=2)[0], 5)
+        with mock.patch.object(app.search, 'multi_query', wraps=app.search.multi_query) as multi_query:
+            search = User.search('user', 2, exclude=[users[0].id])
+            first, = multi_search([search])
+            self.assertEqual(first.total, 4)
+            self.assertEqual(multi_search([search]), [first])
+            self.assertEqual(multi_query.call_count, 1)
+
+            old = app.search._table('user')
+            User.reindex(workers=1, batch_size=2)
+            self.assertNotEqual(app.search._table('user'), old)
+            self.assertFalse(app.search._exists(old))
+            multi_search([search])
+            self.assertEqual(multi_query.call_count, 2)
+
+    def test_errors_are_not_cached(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        db.session.add_all([u1, Tweet(identifier=Tweet.get_identifier(), textbody_source='cats',
+            textbody_markdown='cats', author=u1)])
+        db.session.commit()
+        SearchOutbox.drain()
+        # A filter on a column the index does not have yet fails
+        failed, found = multi_search([Tweet.search('cats', 10, is_hidden=False), Tweet.search('cats', 10)])
+        self.assertEqual((failed.total, found.total), (0, 1))
+        with mock.patch.object(app.search, 'multi_query', wraps=app.search.multi_query) as multi_query:
+            multi_search([Tweet.search('cats', 10, is_hidden=False), Tweet.search('cats', 10)])
+            self.assertEqual(len(multi_query.call_args[0][0]), 1)
+
+    def test_empty_rebuild_takes_documents(self):
+        self.assertEqual(User.reindex(workers=1)[0], 0)
+        db.session.add(User(username='john', showname='john', password='jpfkdjsd'))
+        db.session.commit()
+        self.assertEqual(multi_search([User.search('john', 10)])[0].total, 1)
+
+    def test_indexed_on_commit(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        db.session.add(u1)
+        db.session.commit()
+        u1.username = 'johnny'
+        db.session.commit()
+        # Without SEARCH_OUTBOX nothing waits for a worker
+        self.assertEqual((SearchOutbox.query.count(), len(app.task_queue)), (0, 0))
+        self.assertEqual(multi_search([User.search('johnny', 10)])[0].total, 1)
+        db.session.delete(u1)
+        db.session.commit()
+        self.assertEqual(app.search.multi_query([User.search('johnny', 10)])[0][1], 0)
+
+    def test_every_match_is_ranked(self):
+        app.search.max_hits = 2
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        texts = ['cats cats cats', 'cats and dogs', 'dogs and cats', 'a cat named cats']
+        tweets = [Tweet(identifier=Tweet.get_identifier(), textbody_source=text, textbody_markdown=text, author=u1)
+            for text in texts]
+        db.session.add_all(tweets)
+        db.session.commit()
+        SearchOutbox.drain()
+        results, = multi_search([Tweet.search('cats', 1)])
+        # The oldest match ranks first even though only two matches are counted
+        self.assertEqual((results.ids, results.total), ([tweets[0].id], 2))
+
+    def test_search_page(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        u2 = User(username='johnny', showname='john', password='jpfkdjsd')
+        db.session.add_all([u1, u2] + [Tweet(identifier=Tweet.get_identifier(), textbody_source='john',
+            textbody_markdown='john', author=u2) for _ in range(4)])
+        db.session.commit()
+        SearchOutbox.drain()
+        app.config['SECRET_KEY'] = 'testing'
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session['_user_id'] = str(u1.id)
+                session['_fresh'] = True
+            response = client.get('/search?q=john')
+            self.assertEqual(response.status_code, 200)
+            self.assertIn(b'johnny', response.data)
+            self.assertIn(b'after=', response.data)
+            self.assertEqual(client.get('/search?q=john&after=bad').status_code, 400)
+
+class ElasticsearchSearchCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.redis = fakeredis.FakeStrictRedis()
+
+    def tearDown(self):
+        app.search = None
+
+    def test_searches_share_one_request(self):
+        es = FakeElasticsearch()
+        app.search = ElasticsearchBackend(es)
+        es.responses = [
+            {'hits': {'total': {'value': 7}, 'hits': [{'_id': str(i), 'sort': [1.5, i]} for i in (4, 2, 9)]}},
+            {'error': {'type': 'index_not_found_exception'}, 'status': 404}]
+        tweets, users = multi_search([Tweet.search('cats', 2, [2.0, 1], is_nsfw=False),
+            User.search('cats', 2, exclude=[3])])
+        self.assertEqual(tweets, (([4, 2], 7, [1.5, 2], True)))
+        self.assertEqual(users.ids, [])
+        (body,) = es.searches
+        self.assertEqual(body[0], {'index': 'tweet'})
+        self.assertEqual(body[1]['search_after'], [2.0, 1])
+        self.assertEqual(body[1]['size'], 3)
+        self.assertEqual(body[1]['query']['bool']['filter'], [{'term': {'is_nsfw': False}}])
+        self.assertEqual(body[3]['query']['bool']['must_not'], [{'ids': {'values': ['3']}}])
+
+        # The failed search is not cached, the next call asks again
+        es.responses = es.responses[1:]
+        multi_search([User.search('cats', 2, exclude=[3])])
+        self.assertEqual(len(es.searches), 2)
+
+class PaginationCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_keyset_pagination(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        now = datetime.utcnow()
+        # two tweets share a timestamp, the id breaks the tie
+        tweets = [Tweet(identifier=Tweet.get_identifier(), textbody_source='post', textbody_markdown='post',
+            author=u1, created_utc=now + timedelta(seconds=min(i, 3))) for i in range(5)]
+        db.session.add_all(tweets)
+        db.session.commit()
+        newest_first = sorted(tweets, key=lambda t: (t.created_utc, t.id), reverse=True)
+
+        seen = []
+        page = paginate(u1.tweets, Tweet, 2)
+        while True:
+            seen.extend(page.items)
+            if not page.has_next:
+                break
+            page = paginate(u1.tweets, Tweet, 2, before=decode_cursor(page.next_cursor))
+        self.assertEqual(seen, newest_first)
+
+        page = paginate(u1.tweets, Tweet, 2, after=decode_cursor(page.prev_cursor))
+        self.assertEqual(page.items, newest_first[2:4])
+        self.assertTrue(page.has_prev)
+        self.assertTrue(page.has_next)
+
+class IdentifierCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'testing'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.redis = fakeredis.FakeStrictRedis()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_identifiers_are_unique_and_time_ordered(self):
+        generated = []
+        def worker():
+            with app.app_context():
+                generated.append([identifiers.generate() for _ in range(5000)])
+        workers = [threading.Thread(target=worker) for _ in range(4)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        # every thread sees its own identifiers in creation order
+        for batch in generated:
+            self.assertEqual(sorted(batch), batch)
+        everything = [identifier for batch in generated for identifier in batch]
+        self.assertEqual(len(set(everything)), len(everything))
+        self.assertTrue(all(len(identifier) == identifiers.LENGTH for identifier in everything))
+        created = identifiers.created_utc(everything[-1])
+        self.assertLess(abs(created - datetime.utcnow()), timedelta(seconds=5))
+
+    def test_nodes_are_leased(self):
+        generators = [identifiers.Generator() for _ in range(3)]
+        for generator in generators:
+            generator.next()
+        self.assertEqual(len({generator.node for generator in generators}), 3)
+        self.assertEqual(len(app.redis.keys('identifiers:node:*')), 3)
+        # A lease that expired and was taken by another process is replaced
+        first = generators[0]
+        app.redis.set('identifiers:node:{}'.format(first.node), 'other')
+        first.renewed -= app.config['IDENTIFIER_NODE_TTL']
+        node = first.node
+        first.next()
+        self.assertNotEqual(first.node, node)
+        self.assertEqual(app.redis.get('identifiers:node:{}'.format(first.node)), first.token.encode())
+
+    def test_no_free_node_fails(self):
+        pipe = app.redis.pipeline()
+        for node in range(1024):
+            pipe.set('identifiers:node:{}'.format(node), 'other')
+        pipe.execute()
+        with self.assertRaises(identifiers.NodesExhausted):
+            identifiers.Generator().next()
+
+    def test_old_identifiers_still_resolve(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        old = Tweet(identifier='0f' * 16, textbody_source='old', textbody_markdown='old', author=u1)
+        new = Tweet(identifier=Tweet.get_identifier(), textbody_source='new', textbody_markdown='new', author=u1)
+        db.session.add_all([old, new])
+        db.session.commit()
+        self.assertIsNone(identifiers.created_utc(old.identifier))
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session['_user_id'] = str(u1.id)
+                session['_fresh'] = True
+            self.assertEqual(client.get('/tweet/{}'.format(old.identifier)).status_code, 200)
+            self.assertEqual(client.get('/tweet/{}'.format(new.identifier)).status_code, 200)
+
+class MarkupCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.redis = fakeredis.FakeStrictRedis()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_render_sanitizes_and_caches(self):
+        html = markup.render('**bold** <script>alert(1)</script>')
+        self.assertIn('<strong>bold</strong>', html)
+        self.assertNotIn('<script>', html)
+        hits = markup._cache.hits
+        self.assertEqual(markup.render('**bold** <script>alert(1)</script>'), html)
+        self.assertEqual(markup._cache.hits, hits + 1)
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        cache = LRUCache(2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual((cache.get('a'), cache.get('b'), cache.get('c')), (1, None, 3))
+
+    def test_rerender_stale_tweets(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        stale = [Tweet(identifier=Tweet.get_identifier(), textbody_source='*{}*'.format(i),
+            textbody_markdown='<script></script>', author=u1) for i in range(5)]
+        current = Tweet(identifier=Tweet.get_identifier(), author=u1)
+        current.set_textbody('current')
+        db.session.add_all(stale + [current])
+        db.session.commit()
+
+        rendered, rate = Tweet.rerender(workers=1, batch_size=2)
+        self.assertEqual(rendered, 5)
+        self.assertEqual([t.textbody_markdown for t in stale], ['<p><em>{}</em></p>\n'.format(i) for i in range(5)])
+        self.assertTrue(all(t.render_version == markup.VERSION for t in stale))
+        self.assertEqual(Tweet.rerender(workers=1)[0], 0)
+
+    def test_rerender_counts_updated_rows(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        stale = [Tweet(identifier=Tweet.get_identifier(), textbody_source='*{}*'.format(i),
+            textbody_markdown='', author=u1) for i in range(3)]
+        db.session.add_all(stale)
+        db.session.commit()
+        edited_id = stale[1].id
+        render_many = markup.render_many
+        def edit_while_rendering(sources):
+            # Edited after its source was read, its rendering is thrown away
+            db.session.execute(Tweet.__table__.update().where(Tweet.__table__.c.id == edited_id).values(
+                textbody_source='edited'))
+            return render_many(sources)
+        with mock.patch('src.models.markup.render_many', edit_while_rendering):
+            self.assertEqual(Tweet.rerender(workers=1)[0], 2)
+
+class CommentThreadCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.redis = fakeredis.FakeStrictRedis()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def comment(self, tweet, user, parent=None):
+        comment = Comment(textbody='comment', identifier=Comment.get_identifier(), tweet=tweet, author=user,
+            recipient=tweet.author, parent=parent)
+        comment.save()
+        return comment
+
+    def test_thread(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        t1 = Tweet(identifier=Tweet.get_identifier(), textbody_source='post', textbody_markdown='post', author=u1)
+        db.session.add(t1)
+        db.session.commit()
+        c1 = self.comment(t1, u1)
+        c2 = self.comment(t1, u1)
+        c3 = self.comment(t1, u1, parent=c1)
+        c4 = self.comment(t1, u1, parent=c3)
+        c5 = self.comment(t1, u1, parent=c1)
+        self.assertEqual((c1.reply_count, c3.reply_count, c2.reply_count), (2, 1, 0))
+
+        roots, cursor = Comment.thread(t1)
+        self.assertEqual((roots, cursor), ([c1, c2], None))
+        self.assertEqual((c1.children, c3.children, c2.children), ([c3, c5], [c4], []))
+
+        roots, cursor = Comment.thread(t1, depth=2)
+        self.assertEqual(c3.children, [])
+        self.assertEqual([c.id for c in roots], [c1.id, c2.id])
+
+        roots, cursor = Comment.thread(t1, root=c1, depth=1)
+        self.assertEqual((roots, c3.children), ([c3, c5], []))
+
+        # pages break anywhere in the tree
+        roots, cursor = Comment.thread(t1, per_page=3)
+        self.assertEqual((roots, c1.children, c3.children), ([c1], [c3], [c4]))
+        # replies whose parent was on an earlier page stay nested under it
+        roots, cursor = Comment.thread(t1, after=cursor, per_page=3)
+        self.assertEqual((roots, cursor), ([c1, c2], None))
+        self.assertEqual((c1.continued, c1.children, c2.continued), (True, [c5], False))
+        roots, cursor = Comment.thread(t1, after=c4.path, per_page=3)
+        self.assertEqual((roots, c1.children), ([c1, c2], [c5]))
+        roots, cursor = Comment.thread(t1, root=c1, after=c3.path)
+        self.assertEqual((roots, c3.continued, c3.children), ([c3, c5], True, [c4]))
+
+class CommentPathCase(unittest.TestCase):
+    def setUp(self):
+        # A file, so every thread gets its own connection and locking is real
+        self.directory = tempfile.mkdtemp()
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(self.directory, 'comments.db')
+        app.redis = fakeredis.FakeStrictRedis()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.directory)
+
+    def test_path_segments_sort_numerically(self):
+        numbers = [1, 2, 999999, 1000000, 1000001, 9999999, 10000000, 123456789, 999999999, 1000000000, 10 ** 12]
+        segments = [Comment.path_segment(n) for n in numbers]
+        self.assertEqual(sorted(segments), segments)
+        self.assertEqual(segments[:2], ['000001', '000002'])
+        self.assertEqual(segments[-3:-1], [':9999999999', ':a1000000000'])
+        # a reply sorts between its parent and the parent's next sibling
+        self.assertLess(segments[3] + '.' + segments[0], segments[4])
+
+    def test_concurrent_comments_get_unique_ordered_paths(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        t1 = Tweet(identifier=Tweet.get_identifier(), textbody_source='post', textbody_markdown='post', author=u1)
+        db.session.add(t1)
+        db.session.commit()
+        # start right below the overflow of 6 digit segments
+        t1.comment_path_counter = 999000
+        db.session.commit()
+        tweet_id = t1.id
+        threads, per_thread = 8, 150
+        errors = []
+
+        def worker():
+            with app.app_context():
+                try:
+                    tweet = Tweet.query.get(tweet_id)
+                    parents = [None]
+                    for i in range(per_thread):
+                        comment = Comment(textbody='comment', identifier=Comment.get_identifier(), tweet=tweet,
+                            author=tweet.author, recipient=tweet.author, parent=parents[i % len(parents)])
+                        comment.save()
+                        parents.append(comment)
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    db.session.remove()
+
+        workers = [threading.Thread(target=worker) for _ in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        db.session.remove()
+        tweet = Tweet.query.get(tweet_id)
+        comments = Comment.query.order_by(Comment.path).all()
+        self.assertEqual(len(comments), threads * per_thread)
+        self.assertEqual(tweet.comment_count, threads * per_thread)
+        self.assertEqual(tweet.comment_path_counter, 999000 + threads * per_thread)
+        self.assertEqual(len({comment.path for comment in comments}), len(comments))
+        # ordered by path, every comment comes after its parent, within its subtree
+        position = {comment.id: i for i, comment in enumerate(comments)}
+        replies = collections.Counter(comment.parent_id for comment in comments)
+        for i, comment in enumerate(comments):
+            if comment.parent_id:
+                parent = comments[position[comment.parent_id]]
+                self.assertLess(position[parent.id], i)
+                self.assertTrue(comment.path.startswith(parent.path + '.'))
+            self.assertEqual(comment.reply_count, replies[comment.id])
+
+class QueryPlanCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.redis = fakeredis.FakeStrictRedis()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def record_statements(self, workload):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            if not executemany and statement.lstrip().split(None, 1)[0] in ('SELECT', 'UPDATE', 'DELETE'):
+                statements.append((statement, parameters))
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            workload()
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        return statements
+
+    def full_scans(self, statements):
+        tables = set(db.metadata.tables)
+        cursor = db.session.connection().connection.cursor()
+        scans = []
+        for statement, parameters in statements:
+            for row in cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters).fetchall():
+                match = re.match(r'SCAN (?:TABLE )?"?(\w+)"?', row[-1])
+                if match and match.group(1) in tables and 'USING' not in row[-1]:
+                    scans.append((row[-1], statement))
+        return scans
+
+    def test_model_queries_use_indexes(self):
+        def workload():
+            u1 = User(username='john', showname='john', password='jpfkdjsd')
+            u2 = User(username='susan', showname='susan', password='jpfkdjsd')
+            db.session.add_all([u1, u2])
+            db.session.commit()
+            t1 = Tweet(identifier=Tweet.get_identifier(), textbody_source='post', textbody_markdown='post', author=u2)
+            db.session.add(t1)
+            db.session.commit()
+            u1.follow(u2)
+            u1.like_tweet(t1)
+            db.session.commit()
+            u1.is_following(u2)
+            u1.followed_ids([u2.id])
+            u1.has_liked_tweet(t1)
+            t1.fan_out()
+            u1.home_timeline(20)
+            paginate(u1.followed_posts(), Tweet, 20)
+            paginate(u2.tweets, Tweet, 20)
+            Tweet.query.filter_by(identifier=t1.identifier).first()
+            c1 = Comment(textbody='comment', identifier=Comment.get_identifier(), tweet=t1, author=u1,
+                recipient=u2)
+            c1.save()
+            Comment(textbody='reply', identifier=Comment.get_identifier(), tweet=t1, author=u2,
+                recipient=u2, parent=c1).save()
+            Comment.query.filter_by(identifier=c1.identifier).first()
+            Comment.thread(t1)
+            Comment.thread(t1, root=c1, depth=2)
+            db.session.add(Message(author=u1, recipient=u2, body='hi'))
+            u2.add_notification('unread_message_count', 1)
+            db.session.commit()
+            u2.count_new_messages()
+            u2.count_new_notifs()
+            paginate(u2.messages_received, Message, 20)
+            u2.notifications.filter(Notification.timestamp > 0).order_by(Notification.timestamp).all()
+            u2.get_tasks_in_progress()
+            u1.unlike_tweet(t1)
+            u1.unfollow(u2)
+            db.session.commit()
+
+        statements = self.record_statements(workload)
+        self.assertGreater(len(statements), 30)
+        self.assertEqual(self.full_scans(statements), [])
+
+class FragmentCacheCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'testing'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.redis = fakeredis.FakeStrictRedis()
+        tweet_utils._cards.local.clear()
+        db.create_all()
+        self.u1 = User(username='john', showname='john', password='jpfkdjsd')
+        self.u2 = User(username='susan', showname='susan', password='jpfkdjsd')
+        db.session.add_all([self.u1, self.u2])
+        db.session.flush()
+        self.tweet = Tweet(identifier=Tweet.get_identifier(), author=self.u1)
+        self.tweet.set_textbody('hello')
+        db.session.add(self.tweet)
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def get(self, user, url):
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session['_user_id'] = str(user.id)
+                session['_fresh'] = True
+            response = client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response.get_data(as_text=True)
+
+    def test_cards_are_shared_and_invalidated(self):
+        url = '/tweet/{}'.format(self.tweet.identifier)
+        self.get(self.u1, url)
+        self.assertEqual(len(app.redis.keys('card:tweet:*')), 1)
+        with mock.patch.object(tweet_utils._cards, 'set_many') as set_many:
+            self.get(self.u2, url)
+        set_many.assert_not_called()
+
+        self.u2.like_tweet(self.tweet)
+        db.session.commit()
+        page = self.get(self.u2, url)
+        self.assertEqual(len(app.redis.keys('card:tweet:*')), 2)
+        self.assertIn('liked.svg', page)
+        self.assertRegex(page, r'like-counter">\s*1\s*<')
+
+    def test_viewer_parts_are_not_cached(self):
+        url = '/tweet/{}'.format(self.tweet.identifier)
+        self.assertIn('value="Sticky"', self.get(self.u1, url))
+        page = self.get(self.u2, url)
+        self.assertNotIn('value="Sticky"', page)
+        self.assertNotIn('/edit', page)
+        self.assertIn('hello', page)
+        card, = app.redis.mget(app.redis.keys('card:tweet:*'))
+        self.assertNotIn(b'Sticky', card)
+
+    def test_comment_cards(self):
+        comment = Comment(textbody='first', identifier=Comment.get_identifier(), tweet=self.tweet,
+            author=self.u2, recipient=self.u1)
+        comment.save()
+        page = self.get(self.u1, '/tweet/{}'.format(self.tweet.identifier))
+        self.assertIn('first', page)
+        self.assertEqual(len(app.redis.keys('card:comment:*')), 1)
+        self.u2.showname = 'susanna'
+        db.session.commit()
+        self.assertIn('susanna', self.get(self.u1, '/tweet/{}'.format(self.tweet.identifier)))
+
+class ExportCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'testing'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        self.directory = tempfile.mkdtemp()
+        app.config['EXPORT_PATH'] = self.directory
+        app.redis = fakeredis.FakeStrictRedis()
+        db.create_all()
+        self.u1 = User(username='john', showname='john', password='jpfkdjsd')
+        self.u2 = User(username='susan', showname='susan', password='jpfkdjsd')
+        db.session.add_all([self.u1, self.u2])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        shutil.rmtree(self.directory)
+
+    def test_write(self):
+        tweets = [Tweet(identifier=Tweet.get_identifier(), textbody_source='post {}'.format(i),
+            textbody_markdown='post', author=self.u1) for i in range(7)]
+        db.session.add_all(tweets)
+        db.session.commit()
+        other = Tweet(identifier=Tweet.get_identifier(), textbody_source='other', textbody_markdown='other',
+            author=self.u2)
+        db.session.add(other)
+        db.session.commit()
+        Comment(textbody='nice', identifier=Comment.get_identifier(), tweet=other, author=self.u1,
+            recipient=self.u2).save()
+        self.u1.like_tweet(other)
+        db.session.commit()
+
+        reports = []
+        progress = exports.Progress(exports.count(self.u1.id), reports.append, 50, 3600)
+        filename = exports.path('task')
+        self.assertEqual(exports.write(self.u1.id, filename, progress, batch_size=3), 9)
+        with gzip.open(filename, 'rt') as f:
+            records = [json.loads(line) for line in f]
+        self.assertEqual([r['body'] for r in records if r['type'] == 'tweet'], ['post {}'.format(i) for i in range(7)])
+        self.assertEqual([(r['body'], r['tweet']) for r in records if r['type'] == 'comment'], [('nice', other.identifier)])
+        self.assertEqual([r['tweet'] for r in records if r['type'] == 'like'], [other.identifier])
+        self.assertEqual(os.listdir(self.directory), ['task.jsonl.gz'])
+        # Batches end at 3, 6, 7, 8 and 9 records, only 6 is 50 percent past the last report
+        self.assertEqual([round(percent) for percent in reports], [67])
+
+    def test_download(self):
+        task = Task(id='task', name='export_posts', description='Exporting tweets', user=self.u1, complete=True)
+        db.session.add(task)
+        db.session.commit()
+        exports.write(self.u1.id, exports.path(task.id))
+        for user, status in [(self.u2, 404), (self.u1, 200)]:
+            with app.test_client() as client:
+                with client.session_transaction() as session:
+                    session['_user_id'] = str(user.id)
+                    session['_fresh'] = True
+                response = client.get('/export_posts/task')
+                self.assertEqual(response.status_code, status)
+                response.close()
+
+class TaskProgressCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.redis = fakeredis.FakeStrictRedis()
+        app.task_queue = rq.Queue('kura-tasks', connection=app.redis)
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def test_progress(self):
+        u = User(username='john', showname='john', password='jpfkdjsd')
+        db.session.add(u)
+        db.session.commit()
+        task = u.launch_task('export_posts', 'Exporting tweets')
+        db.session.commit()
+        self.assertEqual(u.get_tasks_in_progress(), [(task.id, 'Exporting tweets', 0)])
+
+        pubsub = app.redis.pubsub()
+        pubsub.subscribe(Notification.channel(u.id))
+        self.assertEqual(pubsub.get_message(timeout=1)['type'], 'subscribe')
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            Task.report_progress(task.id, u.id, 40.5)
+            self.assertEqual(u.get_tasks_in_progress(), [(task.id, 'Exporting tweets', 40)])
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(statements, [])
+        payload = json.loads(pubsub.get_message(timeout=1)['data'])
+        self.assertEqual(payload['data'], {'task_id': task.id, 'progress': 40})
+
+        Task.report_progress(task.id, u.id, 100)
+        self.assertEqual(u.get_tasks_in_progress(), [])
+        self.assertTrue(Task.query.get(task.id).complete)
+
+    def test_failure(self):
+        u = User(username='john', showname='john', password='jpfkdjsd')
+        db.session.add(u)
+        db.session.commit()
+        task = u.launch_task('export_posts', 'Exporting tweets')
+        db.session.commit()
+        pubsub = app.redis.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(Notification.channel(u.id))
+        Task.report_progress(task.id, u.id, 100, 'The export failed')
+        messages = [pubsub.get_message(timeout=0.1) for _ in range(3)]
+        pubsub.close()
+        payload = json.loads(next(message for message in messages if message)['data'])
+        self.assertEqual(payload['data'], {'task_id': task.id, 'progress': 100, 'error': 'The export failed'})
+        self.assertEqual(u.get_tasks_in_progress(), [])
+
+class FakeConnection(object):
+    def __init__(self, sent, failures):
+        self.sent = sent
+        self.failures = failures
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def send(self, msg):
+        if self.failures:
+            self.failures.pop()
+            raise smtplib.SMTPServerDisconnected('gone')
+        self.sent.append(msg.recipients[0])
+
+class EmailCase(unittest.TestCase):
+    def setUp(self):
+        app.config['EMAIL_RETRY_DELAY'] = 0
+
+    def test_sender(self):
+        sent = []
+        failures = [True]
+        connections = []
+        def connect():
+            connections.append(FakeConnection(sent, failures))
+            return connections[-1]
+        sender = Sender()
+        with mock.patch('src.email.mail.connect', connect):
+            for i in range(20):
+                self.assertTrue(sender.submit(MailMessage(recipients=['user{}@demo.com'.format(i)], sender='a@demo.com')))
+            sender.queue.join()
+        self.assertEqual(sorted(sent), sorted('user{}@demo.com'.format(i) for i in range(20)))
+        # One connection per worker, plus the one that failed
+        self.assertLessEqual(len(connections), app.config['EMAIL_WORKERS'] + 1)
+
+    def test_backpressure(self):
+        app.config.update(EMAIL_QUEUE_SIZE=1, EMAIL_QUEUE_TIMEOUT=0.01)
+        sender = Sender()
+        blocked = threading.Event()
+        def connect():
+            blocked.wait()
+            return FakeConnection([], [])
+        with mock.patch('src.email.mail.connect', connect):
+            results = [sender.submit(MailMessage(recipients=['a@demo.com'], sender='a@demo.com')) for _ in range(5)]
+            blocked.set()
+            sender.queue.join()
+        app.config.update(EMAIL_QUEUE_SIZE=1000, EMAIL_QUEUE_TIMEOUT=5)
+        self.assertIn(False, results)
+
+    def test_reset_request_when_full(self):
+        app.config.update(TESTING=True, WTF_CSRF_ENABLED=False, SQLALCHEMY_DATABASE_URI='sqlite://')
+        app.redis = fakeredis.FakeStrictRedis()
+        db.create_all()
+        try:
+            db.session.add(User(username='john', showname='john', email='john@demo.com', password='x'))
+            db.session.commit()
+            with mock.patch('src.email._sender.submit', return_value=False) as submit:
+                with app.test_client() as client:
+                    response = client.post('/reset_password', data={'email': 'john@demo.com'})
+            # The request does not wait for room in the queue
+            self.assertEqual(submit.call_args[0][1], 0)
+            self.assertEqual(response.status_code, 503)
+            self.assertIn('try again later', response.get_data(as_text=True))
+        finally:
+            app.config['WTF_CSRF_ENABLED'] = True
+            db.session.remove()
+            db.drop_all()
+
+class PictureCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        app.config['IMAGE_PATH'] = os.path.join(self.directory, 'pictures')
+        app.config['IMAGE_UPLOAD_PATH'] = os.path.join(self.directory, 'uploads')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def upload(self, size, format='PNG', color='red'):
+        f = io.BytesIO()
+        Image.new('RGB', size, color).save(f, format)
+        f.seek(0)
+        return f
+
+    def test_store_and_process(self):
+        name = images.store(self.upload((300, 260)))
+        self.assertRegex(name, '^[0-9a-f]{16}$')
+        self.assertFalse(images.is_processed(name))
+        images.process(name)
+        self.assertTrue(images.is_processed(name))
+        self.assertEqual(os.listdir(app.config['IMAGE_UPLOAD_PATH']), [])
+        with Image.open(os.path.join(app.config['IMAGE_PATH'], images.variant(name, 64, 'jpeg'))) as image:
+            self.assertEqual(image.size, (64, 64))
+        # The same upload gets the same name and is not stored again
+        self.assertEqual(images.store(self.upload((300, 260))), name)
+        self.assertEqual(os.listdir(app.config['IMAGE_UPLOAD_PATH']), [])
+        self.assertNotEqual(images.store(self.upload((300, 260), color='blue')), name)
+
+    def test_small_picture_is_not_upscaled(self):
+        name = images.store(self.upload((300, 100)))
+        self.assertRegex(name, '^[0-9a-f]{16}-100$')
+        images.process(name)
+        self.assertTrue(images.is_processed(name))
+        self.assertEqual(images.widths(name), (64, 100))
+        with Image.open(images.path(images.variant(name, 100, 'jpeg'))) as image:
+            self.assertEqual(image.size, (100, 100))
+        self.assertEqual(images.url(name, 256), images.URL + images.variant(name, 100, 'jpeg'))
+        html = images.picture(name, 64)
+        self.assertIn('{} 100w'.format(images.variant(name, 100, 'jpeg')), html)
+        self.assertNotIn('128w', html)
+        self.assertNotIn('256w', html)
+
+    def test_limits(self):
+        app.config['IMAGE_MAX_PIXELS'] = 100 * 100
+        try:
+            with self.assertRaises(images.PictureError):
+                images.store(self.upload((101, 100)))
+        finally:
+            app.config['IMAGE_MAX_PIXELS'] = 40 * 1000 * 1000
+        app.config['IMAGE_MAX_BYTES'] = 100
+        try:
+            with self.assertRaises(images.PictureError):
+                images.store(self.upload((100, 100)))
+        finally:
+            app.config['IMAGE_MAX_BYTES'] = 8 * 1024 * 1024
+        with self.assertRaises(images.PictureError):
+            images.store(io.BytesIO(b'not a picture'))
+
+    def test_picture(self):
+        self.assertEqual(images.picture('abc123.jpg', 64, **{'class': 'tweet-profile'}),
+            '<img src="/static/profile_pics/abc123.jpg" class="tweet-profile">')
+        html = images.picture('0123456789abcdef', 64)
+        self.assertIn('src="/static/profile_pics/0123456789abcdef-64.jpg"', html)
+        self.assertIn('/static/profile_pics/0123456789abcdef-256.jpg 256w', html)
+
+    def test_served_from_image_path(self):
+        name = images.store(self.upload((300, 200)))
+        images.process(name)
+        with app.test_client() as client:
+            response = client.get(images.url(name, 64))
+            self.assertEqual(response.status_code, 200)
+            self.assertIn('immutable', response.headers['Cache-Control'])
+            with open(images.path(images.variant(name, 64, 'jpeg')), 'rb') as f:
+                self.assertEqual(response.get_data(), f.read())
+            response.close()
+
+    def test_old_picture_is_deleted(self):
+        os.makedirs(app.config['IMAGE_PATH'])
+        with open(images.path('abc123.jpg'), 'wb') as f:
+            f.write(b'picture')
+        user = User(username='john', showname='john', password='x', image_file='abc123.jpg')
+        set_picture(user, '0123456789abcdef')
+        self.assertEqual(user.image_file, '0123456789abcdef')
+        self.assertFalse(os.path.exists(images.path('abc123.jpg')))
+
+class AssetsCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.directory = tempfile.mkdtemp()
+        app.config['STATIC_BUILD_PATH'] = self.directory
+        assets.build(app.static_folder, self.directory)
+        assets.load(app)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        app.extensions['assets'] = {}
+
+    def test_fingerprinted(self):
+        with app.test_request_context():
+            url = url_for('static', filename='styles/layout.css')
+        self.assertRegex(url, r'^/static/dist/styles/layout\.[0-9a-f]{12}\.css$')
+        with open(os.path.join(app.static_folder, 'styles', 'layout.css'), 'rb') as f:
+            original = f.read()
+        with app.test_client() as client:
+            response = client.get(url, headers={'Accept-Encoding': 'gzip, deflate'})
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(response.mimetype, 'text/css')
+            self.assertIn('immutable', response.headers['Cache-Control'])
+            self.assertEqual(gzip.decompress(response.get_data()), original)
+            response.close()
+            response = client.get(url)
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(response.get_data(), original)
+            response.close()
+            # Unbuilt names are still served
+            response = client.get('/static/styles/layout.css')
+            self.assertEqual(response.status_code, 200)
+            self.assertNotIn('immutable', response.headers.get('Cache-Control', ''))
+            response.close()
+
+    def test_compress(self):
+        data = list(range(1000))
+        with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            plain = jsonify(data)
+            compressed = assets.compress(jsonify(data))
+        self.assertGreater(len(plain.get_data()), app.config['COMPRESS_MIN_SIZE'])
+        self.assertEqual(compressed.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(compressed.get_data()), plain.get_data())
+        self.assertIn('Accept-Encoding', compressed.headers['Vary'])
+
+    def test_secrets_are_not_compressed(self):
+        with app.test_client() as client:
+            response = client.get('/login', headers={'Accept-Encoding': 'gzip'})
+        self.assertGreater(len(response.get_data()), app.config['COMPRESS_MIN_SIZE'])
+        self.assertNotIn('Content-Encoding', response.headers)
+        with app.test_request_context(headers={'Accept-Encoding': 'gzip'}):
+            generate_csrf()
+            response = assets.compress(jsonify(list(range(1000))))
+        self.assertNotIn('Content-Encoding', response.headers)
+
+class SessionUserCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'testing'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.redis = fakeredis.FakeStrictRedis()
+        db.create_all()
+        u = User(username='john', showname='john', password='jpfkdjsd')
+        db.session.add(u)
+        db.session.commit()
+        self.user_id = u.id
+        db.session.remove()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def user_queries(self):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            with app.test_client() as client:
+                with client.session_transaction() as session:
+                    session['_user_id'] = str(self.user_id)
+                    session['_fresh'] = True
+                self.assertEqual(client.get('/notifications').status_code, 200)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+            db.session.remove()
+        return [statement for statement in statements if 'FROM user' in statement]
+
+    def test_cached(self):
+        self.assertEqual(len(self.user_queries()), 1)
+        self.assertEqual(self.user_queries(), [])
+        user = load_user(self.user_id)
+        self.assertEqual(user.username, 'john')
+        # Columns that are not cached are loaded when read
+        self.assertEqual(user.password, 'jpfkdjsd')
+
+    def test_write_through_and_invalidate(self):
+        self.user_queries()
+        user = load_user(self.user_id)
+        self.assertEqual(user.showname, 'john')
+        user.showname = 'johnny'
+        user.last_notifs_read_time = datetime(2020, 5, 1, 12, 30)
+        db.session.commit()
+        db.session.remove()
+        self.assertEqual(User.query.get(self.user_id).showname, 'johnny')
+        db.session.remove()
+        self.assertEqual(app.redis.exists('session-user:{}'.format(self.user_id)), 0)
+        self.assertEqual(len(self.user_queries()), 1)
+        user = load_user(self.user_id)
+        self.assertEqual((user.showname, user.last_notifs_read_time), ('johnny', datetime(2020, 5, 1, 12, 30)))
+
+    def test_stale_row_is_not_cached(self):
+        load_session_user = models._load_session_user
+        def load_then_unban(user_id):
+            columns = load_session_user(user_id)
+            # Another request unbans the user after this one read the row
+            with app.app_context():
+                user = User.query.get(user_id)
+                user.is_banned = False
+                db.session.commit()
+                db.session.remove()
+            return columns
+        user = User.query.get(self.user_id)
+        user.is_banned = True
+        db.session.commit()
+        db.session.remove()
+        with mock.patch('src.models._load_session_user', load_then_unban):
+            self.assertTrue(load_user(self.user_id).is_banned)
+        db.session.remove()
+        self.assertEqual(app.redis.exists('session-user:{}'.format(self.user_id)), 0)
+        self.assertFalse(load_user(self.user_id).is_banned)
+        db.session.remove()
+        self.assertFalse(load_user(self.user_id).is_banned)
+
+    def test_local_cache(self):
+        app.config['SESSION_USER_LOCAL_TTL'] = 60
+        try:
+            self.user_queries()
+            app.redis.flushdb()
+            self.assertEqual(self.user_queries(), [])
+            user = load_user(self.user_id)
+            user.showname = 'johnny'
+            db.session.commit()
+            self.assertEqual(load_user(self.user_id).showname, 'johnny')
+        finally:
+            app.config['SESSION_USER_LOCAL_TTL'] = 0
+            db.session.remove()
+
+class PasswordCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'testing'
+        app.config['WTF_CSRF_ENABLED'] = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.config['BCRYPT_LOG_ROUNDS'] = 4
+        app.config['PASSWORD_WORKERS'] = 0
+        app.redis = fakeredis.FakeStrictRedis()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        app.config['WTF_CSRF_ENABLED'] = True
+        app.config['BCRYPT_LOG_ROUNDS'] = 12
+
+    def test_hash(self):
+        hashed = passwords.generate('secret')
+        self.assertTrue(passwords.check(hashed, 'secret'))
+        self.assertFalse(passwords.check(hashed, 'wrong'))
+        self.assertFalse(passwords.check('jpfkdjsd', 'jpfkdjsd'))
+        self.assertFalse(passwords.needs_rehash(hashed))
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        self.assertTrue(passwords.needs_rehash(hashed))
+
+    def test_pool(self):
+        app.config.update(PASSWORD_WORKERS=1, PASSWORD_QUEUE_DEPTH=1)
+        pool = passwords.Pool()
+        try:
+            hashed = pool.run(passwords._hash, 'secret', 4)
+            self.assertTrue(pool.run(passwords._check, hashed, 'secret'))
+            started = threading.Event()
+            def slow():
+                with app.app_context():
+                    started.set()
+                    pool.run(time.sleep, 0.5)
+            thread = threading.Thread(target=slow)
+            thread.start()
+            started.wait()
+            time.sleep(0.1)
+            with self.assertRaises(passwords.Saturated):
+                pool.run(passwords._check, hashed, 'secret')
+            thread.join()
+        finally:
+            pool.executor.shutdown()
+            app.config.update(PASSWORD_WORKERS=0, PASSWORD_QUEUE_DEPTH=16)
+
+    def test_pool_timeout_keeps_slot(self):
+        app.config.update(PASSWORD_WORKERS=1, PASSWORD_QUEUE_DEPTH=1, PASSWORD_TIMEOUT=0.1)
+        pool = passwords.Pool()
+        try:
+            pool.run(abs, 1)
+            with self.assertRaises(passwords.Saturated):
+                pool.run(time.sleep, 0.5)
+            # The sleep still runs, so nothing else is queued behind it
+            app.config['PASSWORD_TIMEOUT'] = 5
+            with self.assertRaises(passwords.Saturated):
+                pool.run(abs, 1)
+            time.sleep(0.6)
+            self.assertEqual(pool.run(abs, -1), 1)
+        finally:
+            pool.executor.shutdown()
+            app.config.update(PASSWORD_WORKERS=0, PASSWORD_QUEUE_DEPTH=16, PASSWORD_TIMEOUT=5)
+
+    def test_pool_restarts_when_broken(self):
+        app.config.update(PASSWORD_WORKERS=1, PASSWORD_QUEUE_DEPTH=1)
+        pool = passwords.Pool()
+        try:
+            with self.assertRaises(passwords.Saturated):
+                pool.run(os._exit, 1)
+            self.assertEqual(pool.run(abs, -1), 1)
+        finally:
+            pool.executor.shutdown()
+            app.config.update(PASSWORD_WORKERS=0, PASSWORD_QUEUE_DEPTH=16)
+
+    def test_rehash_on_login(self):
+        u = User(username='john', showname='john', password=passwords.generate('secret'))
+        db.session.add(u)
+        db.session.commit()
+        app.config['BCRYPT_LOG_ROUNDS'] = 5
+        with app.test_client() as client:
+            response = client.post('/login', data={'username': 'john', 'password': 'secret'})
+        self.assertEqual(response.status_code, 302)
+        db.session.remove()
+        hashed = User.query.filter_by(username='john').first().password
+        self.assertTrue(hashed.startswith('$2b$05$'))
+        self.assertTrue(passwords.check(hashed, 'secret'))
+
+    def test_saturated(self):
+        u = User(username='john', showname='john', password=passwords.generate('secret'))
+        db.session.add(u)
+        db.session.commit()
+        with mock.patch.object(passwords._pool, 'run', side_effect=passwords.Saturated):
+            with app.test_client() as client:
+                response = client.post('/login', data={'username': 'john', 'password': 'secret'})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+class ToggleCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'testing'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.redis = fakeredis.FakeStrictRedis()
+        db.create_all()
+        self.u1 = User(username='john', showname='john', password='jpfkdjsd')
+        self.u2 = User(username='susan', showname='susan', password='jpfkdjsd')
+        db.session.add_all([self.u1, self.u2])
+        db.session.flush()
+        self.tweet = Tweet(identifier=Tweet.get_identifier(), textbody_source='post', textbody_markdown='post',
+            author=self.u2)
+        db.session.add(self.tweet)
+        db.session.commit()
+        self.user_id, self.other_id = self.u1.id, self.u2.id
+        self.ident = self.tweet.identifier
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def post(self, url, data):
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session['_user_id'] = str(self.user_id)
+                session['_fresh'] = True
+            response = client.post(url, json=data)
+        db.session.remove()
+        return response
+
+    def test_like_sets_state(self):
+        for _ in range(2):
+            data = self.post('/tweet/like', {'ident': self.ident, 'liked': True}).get_json()
+            self.assertEqual((data['statuscode'], data['liked'], data['like_count']), (0, True, 1))
+        self.assertEqual(Like.query.count(), 1)
+        for _ in range(2):
+            data = self.post('/tweet/like', {'ident': self.ident, 'liked': False}).get_json()
+            self.assertEqual((data['statuscode'], data['liked'], data['like_count']), (0, False, 0))
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(self.post('/tweet/like', {'ident': self.ident}).get_json()['statuscode'], -1)
+
+    def test_follow_sets_state(self):
+        for _ in range(2):
+            data = self.post('/user/follow', {'username': 'susan', 'following': True}).get_json()
+            self.assertEqual((data['statuscode'], data['following']), (0, True))
+        u2 = User.query.filter_by(username='susan').first()
+        self.assertEqual((u2.follower_count, u2.followers.count()), (1, 1))
+        self.post('/user/follow', {'username': 'susan', 'following': False})
+        u2 = User.query.filter_by(username='susan').first()
+        self.assertEqual((u2.follower_count, u2.followers.count()), (0, 0))
+
+    def test_like_twice_inserts_once(self):
+        self.assertTrue(self.u1.like_tweet(self.tweet))
+        self.assertFalse(self.u1.like_tweet(self.tweet))
+        db.session.commit()
+        self.assertEqual((self.tweet.like_count, Like.query.count()), (1, 1))
+        self.assertTrue(self.u1.unlike_tweet(self.tweet))
+        self.assertFalse(self.u1.unlike_tweet(self.tweet))
+        db.session.commit()
+        self.assertEqual((self.tweet.like_count, Like.query.count()), (0, 0))
+
+    def test_rate_limit(self):
+        limits = app.config['RATE_LIMITS']
+        app.config['RATE_LIMITS'] = dict(limits, like=(1, 3))
+        try:
+            statuses = [self.post('/tweet/like', {'ident': self.ident, 'liked': True}).status_code for _ in range(4)]
+            self.assertEqual(statuses, [200, 200, 200, 429])
+            response = self.post('/tweet/like', {'ident': self.ident, 'liked': True})
+            self.assertEqual(response.headers['Retry-After'], '1')
+            # Another user has a bucket of its own
+            self.user_id = self.other_id
+            self.assertEqual(self.post('/tweet/like', {'ident': self.ident, 'liked': True}).status_code, 200)
+        finally:
+            app.config['RATE_LIMITS'] = limits
+
+    def test_bucket_refills(self):
+        app.config['RATE_LIMITS'] = dict(app.config['RATE_LIMITS'], test=(2, 2))
+        with mock.patch('src.ratelimit.time.time', return_value=1000.0):
+            self.assertEqual([ratelimit.take('test', 1) for _ in range(3)][:2], [None, None])
+            self.assertAlmostEqual(ratelimit.take('test', 1), 0.5)
+        with mock.patch('src.ratelimit.time.time', return_value=1000.5):
+            self.assertIsNone(ratelimit.take('test', 1))
+            self.assertIsNotNone(ratelimit.take('test', 1))
+
+class LikeBufferCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'testing'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.config['LIKE_BUFFER'] = True
+        app.redis = fakeredis.FakeStrictRedis()
+        app.task_queue = rq.Queue('kura-tasks', connection=app.redis)
+        db.create_all()
+        users = [User(username='user{}'.format(i), showname='user', password='x') for i in range(5)]
+        db.session.add_all(users)
+        db.session.flush()
+        self.tweets = [Tweet(identifier=Tweet.get_identifier(), textbody_source='post', textbody_markdown='post',
+            author=users[0]) for _ in range(3)]
+        db.session.add_all(self.tweets)
+        db.session.commit()
+        self.user_ids = [user.id for user in users]
+        self.tweet_ids = [tweet.id for tweet in self.tweets]
+
+    def tearDown(self):
+        app.config['LIKE_BUFFER'] = False
+        db.session.remove()
+        db.drop_all()
+
+    def like(self, user_id, tweet_id, liked):
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session['_user_id'] = str(user_id)
+                session['_fresh'] = True
+            data = client.post('/tweet/like', json={'ident': Tweet.query.get(tweet_id).identifier, 'liked': liked}).get_json()
+        db.session.remove()
+        return data
+
+    def test_like_is_buffered(self):
+        user_id, tweet_id = self.user_ids[1], self.tweet_ids[0]
+        self.assertEqual(self.like(user_id, tweet_id, True)['like_count'], 1)
+        self.assertEqual(self.like(self.user_ids[2], tweet_id, True)['like_count'], 2)
+        self.assertEqual(self.like(user_id, tweet_id, True)['like_count'], 2)
+        self.assertEqual((Like.query.count(), Tweet.query.get(tweet_id).like_count), (0, 0))
+        self.assertEqual(rq.registry.ScheduledJobRegistry(queue=app.task_queue).count, 1)
+
+        tweet = Tweet.query.get(tweet_id)
+        with app.test_request_context():
+            context = tweet_utils.hydrate_tweets([tweet], User.query.get(user_id))
+        self.assertEqual((tweet.like_count, context['liked_ids']), (2, {tweet_id}))
+        db.session.remove()
+
+        self.assertEqual(likes.flush(), 2)
+        self.assertEqual((Like.query.count(), Tweet.query.get(tweet_id).like_count), (2, 2))
+        self.assertEqual(likes.deltas([tweet_id]), {tweet_id: 0})
+        self.assertEqual(self.like(user_id, tweet_id, False)['like_count'], 1)
+        self.assertEqual(likes.flush(), 1)
+        self.assertEqual(Tweet.query.get(tweet_id).likes.count(), 1)
+
+    def test_toggle_back_is_not_flushed(self):
+        user_id, tweet_id = self.user_ids[1], self.tweet_ids[0]
+        self.like(user_id, tweet_id, True)
+        self.assertEqual(self.like(user_id, tweet_id, False)['like_count'], 0)
+        self.assertEqual(likes.snapshot(), {})
+        self.assertEqual(likes.flush(), 0)
+
+    def test_failed_flush_is_replayed(self):
+        self.like(self.user_ids[1], self.tweet_ids[0], True)
+        self.like(self.user_ids[2], self.tweet_ids[0], True)
+        with mock.patch('src.likes.Tweet.query') as query:
+            query.filter.side_effect = RuntimeError('crash')
+            with self.assertRaises(RuntimeError):
+                likes.flush()
+        self.assertEqual(Like.query.count(), 0)
+        # Changes made while the failed flush waits see its state
+        self.assertEqual(self.like(self.user_ids[2], self.tweet_ids[0], False)['like_count'], 1)
+        self.assertEqual(self.like(self.user_ids[3], self.tweet_ids[0], True)['like_count'], 2)
+        self.assertEqual(likes.flush(), 4)
+        self.assertEqual(set(db.session.query(Like.userid)), {(self.user_ids[1],), (self.user_ids[3],)})
+        self.assertEqual(Tweet.query.get(self.tweet_ids[0]).like_count, 2)
+
+    def test_flush_between_read_and_set(self):
+        user_id, tweet_id = self.user_ids[1], self.tweet_ids[0]
+        self.like(user_id, tweet_id, True)
+        evaluate = app.redis.eval
+        def flush_first(script, *args):
+            # The like table was read, a flush commits the like before the buffer is written
+            if script == likes._SET and not flushed:
+                flushed.append(likes.flush())
+            return evaluate(script, *args)
+        flushed = []
+        with mock.patch.object(app.redis, 'eval', flush_first):
+            self.assertEqual(self.like(user_id, tweet_id, False)['like_count'], 0)
+        self.assertEqual(flushed, [1])
+        self.assertEqual(likes.flush(), 1)
+        self.assertEqual(Like.query.count(), 0)
+        self.assertEqual(Tweet.query.get(tweet_id).like_count, 0)
+
+    def test_read_again_after_many_flushes(self):
+        user_id, tweet_id = self.user_ids[1], self.tweet_ids[0]
+        evaluate = app.redis.eval
+        calls = []
+        def flush_twice(script, *args):
+            if script == likes._SET:
+                if not calls:
+                    app.redis.incr(likes.GENERATION, 2)
+                calls.append(script)
+            return evaluate(script, *args)
+        with mock.patch.object(app.redis, 'eval', flush_twice):
+            self.assertEqual(self.like(user_id, tweet_id, True)['like_count'], 1)
+        # Two flushes committed since the read, so the like table is read again
+        self.assertEqual(len(calls), 2)
+
+    def test_replay_is_idempotent(self):
+        entries = {(self.user_ids[1], self.tweet_ids[0]): True, (self.user_ids[2], self.tweet_ids[0]): False}
+        for _ in range(2):
+            likes.apply(entries, 1)
+        self.assertEqual((Like.query.count(), Tweet.query.get(self.tweet_ids[0]).like_count), (1, 1))
+
+    def test_converges(self):
+        random = __import__('random').Random(7)
+        expected = {}
+        for i in range(60):
+            user_id, tweet_id = random.choice(self.user_ids), random.choice(self.tweet_ids)
+            liked = random.random() < 0.6
+            self.like(user_id, tweet_id, liked)
+            expected[(user_id, tweet_id)] = liked
+            if i % 20 == 19:
+                entries = likes.snapshot()
+                likes.flush()
+                self.assertEqual(likes.check(entries), ({}, []))
+        self.assertEqual(set(db.session.query(Like.userid, Like.tweetid)),
+            {pair for pair, liked in expected.items() if liked})
+        for tweet in Tweet.query:
+            self.assertEqual(tweet.like_count, sum(1 for (_, t), liked in expected.items() if liked and t == tweet.id))
+        Like.query.delete()
+        db.session.commit()
+        diverged, miscounted = likes.check(expected)
+        self.assertEqual(diverged, {pair: True for pair, liked in expected.items() if liked})
+        self.assertEqual(miscounted, sorted({t for (_, t), liked in expected.items() if liked}))
+
+class QueryCountCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        app.config['SECRET_KEY'] = 'testing'
+        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+        app.redis = fakeredis.FakeStrictRedis()
+        db.create_all()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def count_queries(self, client, url):
+        statements = []
+        def before_cursor_execute(conn, cursor, statement, *args):
+            statements.append(statement)
+        db.event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+        try:
+            response = client.get(url)
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+        self.assertEqual(response.status_code, 200)
+        return len(statements)
+
+    def add_tweets(self, users, n):
+        now = datetime.utcnow()
+        for i in range(n):
+            t = Tweet(identifier=Tweet.get_identifier(), textbody_source='post', textbody_markdown='post',
+                author=users[i % len(users)], created_utc=now + timedelta(seconds=i))
+            db.session.add(t)
+            db.session.flush()
+            for user in users[:i % 3]:
+                user.like_tweet(t)
+        db.session.commit()
+
+    def test_constant_queries_per_page(self):
+        users = [User(username='user{}'.format(i), showname='user', password='jpfkdjsd') for i in range(4)]
+        db.session.add_all(users)
+        for user in users[1:]:
+            users[0].follow(user)
+        db.session.commit()
+        viewer_id = users[0].id
+        viewer_name = users[0].username
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session['_user_id'] = str(viewer_id)
+                session['_fresh'] = True
+            urls = ['/home', '/user/{}/profile'.format(viewer_name)]
+            self.add_tweets(users, 3)
+            app.redis.flushdb()
+            client.get('/home')
+            few = [self.count_queries(client, url) for url in urls]
+            self.add_tweets(users, 40)
+            app.redis.flushdb()
+            client.get('/home')
+            many = [self.count_queries(client, url) for url in urls]
+        self.assertEqual(few, many)
+
+    def test_constant_queries_per_thread(self):
+        u1 = User(username='john', showname='john', password='jpfkdjsd')
+        t1 = Tweet(identifier=Tweet.get_identifier(), textbody_source='post', textbody_markdown='post', author=u1)
+        db.session.add(t1)
+        db.session.commit()
+        user_id, tweet_id, url = u1.id, t1.id, '/tweet/{}'.format(t1.identifier)
+
+        def add_comments(n):
+            tweet = Tweet.query.get(tweet_id)
+            parents = [None]
+            for i in range(n):
+                comment = Comment(textbody='comment', identifier=Comment.get_identifier(), tweet=tweet,
+                    author=tweet.author, recipient=tweet.author, parent=parents[i % len(parents)])
+                comment.save()
+                parents.append(comment)
+
+        with app.test_client() as client:
+            with client.session_transaction() as session:
+                session['_user_id'] = str(user_id)
+                session['_fresh'] = True
+            add_comments(3)
+            client.get(url)
+            db.session.remove()
+            few = self.count_queries(client, url)
+            add_comments(20)
+            db.session.remove()
+            many = self.count_queries(client, url)
+        self.assertEqual(few, many)
 
 if __name__ == '__main__':
     unittest.main(verbosity=2)